@@ -0,0 +1,14 @@
+"""
+Offline benchmarks of the gateways and of `SirenePipeline`.
+
+Local stand-ins are started for every server (cf `benchmarks.servers`), files of the
+requested sizes are generated, and every case (cf `benchmarks.cases`) runs in its own
+process. Results (MB/s, CPU time, peak RSS) are written as JSON, to be compared
+across versions:
+
+```bash
+pip install -e .[bench]
+python -m benchmarks run --sizes 1M,1G,4G --output after.json
+python -m benchmarks compare before.json after.json
+```
+"""
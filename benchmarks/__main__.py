@@ -0,0 +1,158 @@
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+from minicli import cli, run as clirun
+
+from benchmarks.cases import CASES, REMOTE_DIR, measure
+from benchmarks.servers import DataGouvFrServer, FileServer, S3Server, SFTPServer
+
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+LISTING = """<?xml version="1.0" encoding="UTF-8"?>
+<ns2:ServiceDepotRetrait xmlns:ns2="http://xml.insee.fr/schema/outils">
+    <Fichiers>
+        <id>{name}</id>
+        <URI>{url}</URI>
+    </Fichiers>
+</ns2:ServiceDepotRetrait>"""
+
+
+def _parse_size(size: str) -> int:
+    size = size.strip().upper()
+    if size[-1] in UNITS:
+        return int(float(size[:-1]) * UNITS[size[-1]])
+    return int(size)
+
+
+def _generate(data_dir: Path, size: int) -> Path:
+    """Incompressible file of `size` bytes, reused across runs"""
+    path = data_dir / f"bench-{size}.bin"
+    if not path.exists() or path.stat().st_size != size:
+        with open(path, "wb") as f:
+            remaining = size
+            while remaining:
+                block = os.urandom(min(remaining, 8 * 1024 * 1024))
+                f.write(block)
+                remaining -= len(block)
+    return path
+
+
+def _version() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def _clean(path: Path):
+    shutil.rmtree(path, ignore_errors=True)
+    path.mkdir(parents=True)
+
+
+@cli
+def run(sizes="1M,64M,512M", cases=",".join(CASES), output="benchmark.json", data_dir=""):
+    """Run gateways and the SIRENE pipeline against local servers
+
+    :sizes: comma separated sizes of the generated files, eg 1M,1G,4G
+    :cases: comma separated cases to run
+    :output: path of the JSON results
+    :data_dir: where to keep generated files between runs, a temporary directory by default
+    """
+    cases = cases.split(",")
+    unknown = set(cases) - set(CASES)
+    if unknown:
+        raise SystemExit(f"Unknown case(s): {', '.join(unknown)}")
+    tmp = Path(tempfile.mkdtemp(prefix="sweeper-bench-"))
+    data_dir = Path(data_dir) if data_dir else tmp / "data"
+    data_dir.mkdir(parents=True, exist_ok=True)
+    sftp_root = tmp / "sftp"
+    workdir = tmp / "work"
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "bench")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "bench")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+    file_server = FileServer(data_dir)
+    datagouvfr = DataGouvFrServer()
+    sftp = SFTPServer(sftp_root)
+    s3 = S3Server("bench") if "s3" in cases else None
+    servers = {
+        "http": file_server.url,
+        "datagouvfr": datagouvfr.url,
+        "sftp": sftp.port,
+        "s3": s3.url if s3 else None,
+        "s3_bucket": "bench",
+    }
+    results = []
+    try:
+        for size in map(_parse_size, sizes.split(",")):
+            path = _generate(data_dir, size)
+            (data_dir / f"{path.name}.xml").write_text(
+                LISTING.format(name=path.name, url=f"{file_server.url}/{path.name}")
+            )
+            for case in cases:
+                _clean(workdir)
+                _clean(sftp_root / REMOTE_DIR.lstrip("/"))
+                # a new process per case, for its own CPU time and peak RSS
+                with ProcessPoolExecutor(
+                    max_workers=1, mp_context=multiprocessing.get_context("spawn"),
+                ) as executor:
+                    result = executor.submit(measure, case, path, servers, workdir).result()
+                print(
+                    f"{case:>15} {size / 1024 ** 2:>10.1f} MB {result['mb_per_s']:>10.1f} MB/s "
+                    f"{result['cpu_seconds']:>8.2f}s CPU {result['peak_rss_mb']:>8.1f} MB RSS",
+                    flush=True,
+                )
+                results.append(result)
+    finally:
+        file_server.close()
+        datagouvfr.close()
+        sftp.close()
+        if s3:
+            s3.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+    Path(output).write_text(json.dumps({
+        "date": datetime.utcnow().isoformat(),
+        **_version(),
+        "results": results,
+    }, indent=2))
+
+
+@cli
+def compare(before, after):
+    """Compare two JSON results of `run`, by case and size
+
+    :before: path of the reference results
+    :after: path of the results to compare
+    """
+    before, after = (
+        {(r["case"], r["size"]): r for r in json.loads(Path(p).read_text())["results"]}
+        for p in (before, after)
+    )
+    print(f"{'case':>15} {'size':>13} {'MB/s':>17} {'CPU':>17} {'peak RSS':>17}")
+    for key in sorted(before.keys() & after.keys()):
+        b, a = before[key], after[key]
+        columns = [
+            f"{b[m]:>7.2f} → {a[m]:>7.2f}"
+            for m in ("mb_per_s", "cpu_seconds", "peak_rss_mb")
+        ]
+        print(f"{key[0]:>15} {key[1] / 1024 ** 2:>10.1f} MB {' '.join(columns)}")
+
+
+if __name__ == "__main__":
+    clirun()
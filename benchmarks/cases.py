@@ -0,0 +1,175 @@
+"""
+Benchmark cases, each run in a fresh process so that its CPU time and peak RSS can be measured.
+
+A case moves a generated file through a gateway, or through `SirenePipeline` end to end,
+using the servers of `benchmarks.servers`.
+"""
+import logging
+import os
+import resource
+import sys
+import time
+
+from pathlib import Path
+
+import paramiko
+import requests
+
+from requests.adapters import HTTPAdapter
+
+from sweeper.utils.http import make_session
+
+SSH_HOST = "127.0.0.1"
+DATAGOUVFR_URL = "https://www.data.gouv.fr"
+REMOTE_DIR = "/data"
+
+
+class _RedirectAdapter(HTTPAdapter):
+    """Send the requests for `prefix` to `target` instead"""
+
+    def __init__(self, prefix: str, target: str, **kwargs):
+        super().__init__(**kwargs)
+        self.prefix = prefix
+        self.target = target
+
+    def send(self, request, **kwargs):
+        request.url = self.target + request.url[len(self.prefix):]
+        return super().send(request, **kwargs)
+
+
+def _session(servers: dict) -> requests.Session:
+    """HTTP session sending data.gouv.fr requests to the fake one"""
+    session = make_session()
+    session.mount(DATAGOUVFR_URL, _RedirectAdapter(DATAGOUVFR_URL, servers["datagouvfr"]))
+    return session
+
+
+def _ssh_pool(servers: dict):
+    """SSH pool holding a connection to the local SFTP server, cf `SSHPool.get`"""
+    from sweeper.gateways.ssh import SSHPool
+
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(
+        SSH_HOST, port=servers["sftp"], username="root", password="bench",
+        look_for_keys=False, allow_agent=False,
+    )
+    pool = SSHPool()
+    pool.clients[(SSH_HOST, "root")] = client
+    return pool
+
+
+def http(path: Path, servers: dict, workdir: Path, segments=1):
+    from sweeper.gateways.http import HTTPDownloadGateway
+
+    gw = HTTPDownloadGateway(
+        lambda *args, **kwargs: True, workdir, session=make_session(), segments=segments,
+        min_segment_size=8 * 1024 * 1024,
+    )
+    gw.download(f"{servers['http']}/{path.name}", path.name)
+
+
+def http_segmented(path: Path, servers: dict, workdir: Path):
+    http(path, servers, workdir, segments=4)
+
+
+def ssh(path: Path, servers: dict, workdir: Path):
+    pool = _ssh_pool(servers)
+    gw = pool.get(SSH_HOST)
+    try:
+        gw.upload(path, f"{REMOTE_DIR}/{path.name}")
+    finally:
+        gw.teardown()
+        pool.close()
+
+
+def s3(path: Path, servers: dict, workdir: Path):
+    from sweeper.gateways.s3 import S3Gateway
+
+    S3Gateway(servers["s3_bucket"], s3_endpoint_url=servers["s3"]).upload(path, path.name)
+
+
+def datagouvfr(path: Path, servers: dict, workdir: Path):
+    from sweeper.gateways.datagouvfr import DataGouvFrGateway
+
+    gw = DataGouvFrGateway("bench", session=_session(servers), max_parallel_chunks=4)
+    gw.upload_replace_resource("bench", "resource_id", path)
+
+
+def sirene(path: Path, servers: dict, workdir: Path):
+    """`SirenePipeline` run through `sweeper run`, listing a single file"""
+    from sweeper.sync import _run
+
+    os.environ["DATABASE_URL"] = f"sqlite:///{workdir / 'jobs.db'}"
+    config = {
+        "main": {"tmp_dir": str(workdir / "tmp")},
+        "sirene": {
+            "backend": "sweeper.pipelines.sirene:SirenePipeline",
+            "config": {
+                "demo": False,
+                "source_url": f"{servers['http']}/{path.name}.xml",
+                "dataset_id": "bench",
+                "destination_host": SSH_HOST,
+                "destination_dir": REMOTE_DIR,
+                "mapping": {path.name: "resource_id"},
+            },
+            "secrets": {
+                key: "SWEEPER_BENCH_UNSET"
+                for key in ("basicauth_user", "basicauth_password", "datagouvfr_token")
+            },
+        },
+    }
+    connections = {"session": _session(servers), "ssh_pool": _ssh_pool(servers)}
+    try:
+        errors = _run("sirene", config, connections=connections)
+    finally:
+        connections["session"].close()
+        connections["ssh_pool"].close()
+    if errors:
+        raise Exception(f"SirenePipeline registered {errors} error(s)")
+
+
+CASES = {
+    "http": http,
+    "http_segmented": http_segmented,
+    "ssh": ssh,
+    "s3": s3,
+    "datagouvfr": datagouvfr,
+    "sirene": sirene,
+}
+
+
+def _peak_rss() -> int:
+    """Peak RSS of this process in bytes"""
+    # on Linux, ru_maxrss is inherited from the parent process, VmHWM is not
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB elsewhere
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def measure(case: str, path: Path, servers: dict, workdir: Path) -> dict:
+    """Run `case` on `path`, returns its wall and CPU times and peak RSS"""
+    logging.basicConfig(level=logging.WARNING)
+    baseline_rss = _peak_rss()
+    cpu = time.process_time()
+    start = time.perf_counter()
+    CASES[case](path, servers, workdir)
+    seconds = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    size = path.stat().st_size
+    return {
+        "case": case,
+        "size": size,
+        "seconds": seconds,
+        "mb_per_s": size / seconds / 1024 ** 2,
+        "cpu_seconds": cpu,
+        "baseline_rss_mb": baseline_rss / 1024 ** 2,
+        "peak_rss_mb": _peak_rss() / 1024 ** 2,
+    }
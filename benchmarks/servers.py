@@ -0,0 +1,301 @@
+"""
+Local stand-ins for the servers the gateways talk to, run in the benchmark's main process.
+
+- `FileServer`: HTTP file server with `Range`, `If-Range` and conditional requests
+- `DataGouvFrServer`: fake data.gouv.fr API, accepting (chunked) uploads and resource updates
+- `SFTPServer`: paramiko SSH server with an SFTP subsystem over a local directory
+- `S3Server`: moto S3 server (requires `moto[server]`)
+"""
+import json
+import logging
+import os
+import re
+import socket
+import threading
+
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import paramiko
+
+log = logging.getLogger(__name__)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class _HTTPServer():
+    """Threaded HTTP server on a random local port, serving `handler`"""
+    handler = None
+
+    def __init__(self):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self.handler)
+        self.httpd.daemon_threads = True
+        self.httpd.bench = self
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_empty(self, status: int, headers: dict = None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _send_json(self, data: dict):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self) -> int:
+        """Read and discard the request body, returns its size"""
+        remaining = int(self.headers.get("Content-Length", 0))
+        size = remaining
+        while remaining:
+            chunk = self.rfile.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+        return size - remaining
+
+
+class _FileHandler(_Handler):
+
+    def do_HEAD(self):
+        self._serve(body=False)
+
+    def do_GET(self):
+        self._serve(body=True)
+
+    def _serve(self, body: bool):
+        path = self.server.bench.root / self.path.split("?")[0].lstrip("/")
+        if not path.is_file():
+            return self._send_empty(404)
+        st = path.stat()
+        size = st.st_size
+        etag = f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+        last_modified = formatdate(st.st_mtime, usegmt=True)
+        if self.headers.get("If-None-Match") == etag:
+            return self._send_empty(304, {"ETag": etag})
+        status, start, end = 200, 0, size - 1
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if match and self.headers.get("If-Range", etag) in (etag, last_modified):
+            start = int(match.group(1))
+            end = min(int(match.group(2) or size - 1), size - 1)
+            if start >= size:
+                return self._send_empty(416, {"Content-Range": f"bytes */{size}"})
+            status = 206
+        self.send_response(status)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if body:
+            with open(path, "rb") as f:
+                self.connection.sendfile(f, start, end - start + 1)
+
+
+class FileServer(_HTTPServer):
+    """Serve the files of `root`"""
+    handler = _FileHandler
+
+    def __init__(self, root: Path):
+        self.root = root
+        super().__init__()
+
+
+class _DataGouvFrHandler(_Handler):
+
+    def do_POST(self):
+        # (chunked) file upload, cf `sweeper.gateways.datagouvfr.DataGouvFrGateway`
+        self.server.bench.received += self._read_body()
+        self._send_json({"success": True, "id": "resource_id", "title": "title"})
+
+    def do_PUT(self):
+        # resource update
+        length = int(self.headers.get("Content-Length", 0))
+        self._send_json(json.loads(self.rfile.read(length) or b"{}"))
+
+
+class DataGouvFrServer(_HTTPServer):
+    """Fake data.gouv.fr API, counting the bytes received"""
+    handler = _DataGouvFrHandler
+
+    def __init__(self):
+        self.received = 0
+        super().__init__()
+
+
+class _SSHServerInterface(paramiko.ServerInterface):
+    """Accept any password, and sessions for the SFTP subsystem (no exec)"""
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+class _SFTPHandle(paramiko.SFTPHandle):
+
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr):
+        return paramiko.SFTP_OK
+
+
+class _SFTPServerInterface(paramiko.SFTPServerInterface):
+    """SFTP over the local directory `root`, absolute paths being relative to it"""
+
+    def __init__(self, server, root: str):
+        super().__init__(server)
+        self.root = root
+
+    def _path(self, path: str) -> str:
+        return os.path.join(self.root, self.canonicalize(path).lstrip("/"))
+
+    def _errno(self, e: OSError):
+        return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        path = self._path(path)
+        try:
+            fd = os.open(path, flags, getattr(attr, "st_mode", None) or 0o666)
+        except OSError as e:
+            return self._errno(e)
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        handle = _SFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as e:
+            return self._errno(e)
+
+    lstat = stat
+
+    def list_folder(self, path):
+        path = self._path(path)
+        try:
+            return [
+                paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, name)), name)
+                for name in os.listdir(path)
+            ]
+        except OSError as e:
+            return self._errno(e)
+
+    def remove(self, path):
+        try:
+            os.remove(self._path(path))
+        except OSError as e:
+            return self._errno(e)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(self._path(oldpath), self._path(newpath))
+        except OSError as e:
+            return self._errno(e)
+        return paramiko.SFTP_OK
+
+    posix_rename = rename
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self._path(path))
+        except OSError as e:
+            return self._errno(e)
+        return paramiko.SFTP_OK
+
+
+class SFTPServer():
+    """
+    SSH server on a random local port, with an SFTP subsystem over `root`.
+
+    Any username and password is accepted. Exec requests are refused, so that
+    `sweeper.gateways.ssh.SSHGateway.copy` falls back to uploading again.
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.key = paramiko.RSAKey.generate(2048)
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        self.transports = []
+        self.thread = threading.Thread(target=self._accept, daemon=True)
+        self.thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self.key)
+            transport.set_subsystem_handler(
+                "sftp", paramiko.SFTPServer, _SFTPServerInterface, str(self.root)
+            )
+            transport.start_server(server=_SSHServerInterface())
+            self.transports.append(transport)
+
+    def close(self):
+        self.sock.close()
+        for transport in self.transports:
+            transport.close()
+
+
+class S3Server():
+    """moto S3 server on a random local port, with an empty `bucket`"""
+
+    def __init__(self, bucket: str):
+        from moto.server import ThreadedMotoServer
+        import boto3
+
+        self.bucket = bucket
+        port = free_port()
+        self.url = f"http://127.0.0.1:{port}"
+        self.server = ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False)
+        self.server.start()
+        boto3.client("s3", endpoint_url=self.url).create_bucket(Bucket=bucket)
+
+    def close(self):
+        self.server.stop()
@@ -5,7 +5,6 @@
 """
 
 import os
-import dataset
 
 context = {}
 
@@ -13,6 +12,9 @@ context = {}
 def get_db():
     """Singleton for db connection"""
     if "db" not in context:
+        # imported here since it takes a while (SQLAlchemy), cf `sweeper --help`
+        import dataset
+
         context["db"] = dataset.connect(os.getenv("DATABASE_URL", "sqlite:///jobs.db"))
     return context["db"]
 
@@ -23,6 +25,23 @@ def close_db():
         context["db"].close()
 
 
+def ensure_columns(table, rows: list):
+    """
+    Create the columns of `rows` missing from `table`, with types guessed as `insert` does.
+
+    To be called before inserting `rows` in a transaction: changing the schema
+    inside a transaction is not safe with connections used by several threads.
+    """
+    examples = {}
+    for row in rows:
+        for key, value in row.items():
+            if examples.get(key) is None:
+                examples[key] = value
+    for key, value in examples.items():
+        if not table.has_column(key):
+            table.create_column_by_example(key, value)
+
+
 def clean_db():
     """Delete all tables from DB (used for tests)"""
     db = get_db()
@@ -0,0 +1,350 @@
+"""
+Async gateways, to be used from `sweeper.pipelines.base.AsyncBasePipeline`.
+
+Requires the `async` extra (`aiohttp`).
+"""
+import asyncio
+import base64
+import json
+import logging
+import math
+import threading
+
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Iterable, Optional, Tuple, Union
+from uuid import uuid4
+
+import aiohttp
+
+from sweeper.gateways.datagouvfr import DataGouvFrGateway
+from sweeper.gateways.http import BaseHTTPDownloadGateway
+from sweeper.models import Resource
+from sweeper.utils.cache import DownloadCache
+from sweeper.utils.hashing import DEFAULT_DIGESTS
+from sweeper.utils.multipart import FilePart, MultipartEncoder
+from sweeper.utils.stats import timer
+
+if TYPE_CHECKING:
+    from sweeper.gateways.s3 import S3Gateway
+    from sweeper.gateways.ssh import SSHGateway
+
+log = logging.getLogger(__name__)
+
+
+class AsyncHTTPDownloadGateway(BaseHTTPDownloadGateway):
+    """
+    Download a file from an HTTP server, with an `aiohttp.ClientSession`
+    (cf `sweeper.utils.http.make_async_session`).
+
+    Works as `sweeper.gateways.http.HTTPDownloadGateway.download`: conditional requests,
+    resumed partial downloads and cache. Segmented downloads, streaming and checks are
+    not available, concurrency comes from downloading many files at once.
+    """
+
+    def __init__(
+        self, has_changed: Callable[..., bool], tmp_dir: Path, session: aiohttp.ClientSession,
+        auth: Optional[Tuple[str, str]] = None, chunk_size=65536,
+        last_state: Optional[Callable[[str], Optional[dict]]] = None,
+        partial_dir: Optional[Path] = None, cache: Optional[DownloadCache] = None,
+        digests: Iterable[str] = DEFAULT_DIGESTS,
+    ):
+        super().__init__(
+            has_changed, tmp_dir, chunk_size, last_state=last_state,
+            partial_dir=partial_dir, cache=cache, digests=digests,
+        )
+        self.session = session
+        self.auth_headers = {}
+        if auth:
+            credentials = base64.b64encode(":".join(auth).encode()).decode()
+            self.auth_headers["Authorization"] = f"Basic {credentials}"
+
+    async def _stream(self, r: aiohttp.ClientResponse, file_id: str, path: Path, offset: int):
+        """
+        Write the response body to `path` from `offset`, returns the digests of the whole file.
+
+        Chunks are hashed and written in a thread, since both can block (hashing lagging
+        behind, slow disk), while the next chunk is received: a slow transfer does not
+        stall the other ones running in the event loop.
+        """
+        if offset:
+            log.info(f"Resuming download of {file_id} from byte {offset}...")
+            hasher = await asyncio.to_thread(self._hasher, path)
+        else:
+            log.info(f"Downloading {file_id}...")
+            hasher = self._hasher()
+
+        def write(chunk: bytes):
+            hasher.update(chunk)
+            ofile.write(chunk)
+
+        try:
+            with timer("http_download", file_id) as t:
+                with open(path, "ab" if offset else "wb") as ofile:
+                    writing = None
+                    try:
+                        async for chunk in r.content.iter_chunked(self.chunk_size):
+                            if writing is not None:
+                                await writing
+                            writing = asyncio.ensure_future(asyncio.to_thread(write, chunk))
+                            t.add(len(chunk))
+                        if writing is not None:
+                            await writing
+                    finally:
+                        # the file must not be closed while a chunk is being written
+                        if writing is not None:
+                            await asyncio.wait([writing])
+                            if not writing.cancelled():
+                                writing.exception()
+        except BaseException:
+            await asyncio.to_thread(hasher.close)
+            raise
+        return await asyncio.to_thread(hasher.hexdigests)
+
+    async def _from_cache(self, url: str, file_id: str, entry: dict) -> Tuple[bool, Resource]:
+        ofile_path = self.tmp_dir / file_id
+        with timer("cache_fetch", file_id) as t:
+            if not await asyncio.to_thread(self.cache.fetch, entry, ofile_path):
+                return await self.download(url, file_id)
+            t.add(entry["size"])
+        log.info(f"{file_id} fetched from cache.")
+        has_changed = self.has_changed(file_id, sha1sum=entry["sha1sum"])
+        return has_changed, Resource(
+            file=ofile_path,
+            name=file_id,
+            sha1sum=entry["sha1sum"],
+            size=entry["size"],
+            etag=entry["etag"],
+            last_modified=entry["last_modified"],
+            digests=entry.get("digests"),
+        )
+
+    async def download(self, url: str, file_id: str) -> Tuple[bool, Resource]:
+        state = self._get_last_state(file_id)
+        cached = self.cache.get(url) if self.cache else None
+        partial = self._partial_path(file_id)
+        offset, resume_headers = self._resume_headers(url, partial)
+        headers = {
+            **self.auth_headers, **self._conditional_headers(cached or state), **resume_headers,
+        }
+        async with self.session.get(url, headers=headers) as r:
+            if r.status == 304:
+                self._discard_partial(partial)
+                if cached:
+                    return await self._from_cache(url, file_id, cached)
+                return self._not_modified(file_id, state)
+            if r.status == 416 and offset:
+                log.warning(f"Could not resume {file_id}, starting over.")
+                self._discard_partial(partial)
+                return await self.download(url, file_id)
+            resumed = offset > 0 and r.status == 206
+            if not resumed:
+                offset = 0
+            validators = self._validators(r)
+            size = self._total_size(r.status, r.headers, offset)
+            if resumed and not size:
+                raise Exception(f"Bad Content-Range while resuming {file_id}")
+            if size and not self.has_changed(file_id, size=size):
+                self._discard_partial(partial)
+                return False, Resource(name=file_id, size=size, **validators)
+            r.raise_for_status()
+            ofile_path = self.tmp_dir / file_id
+            if not resumed and partial:
+                self._partial_infos_path(partial).write_text(json.dumps({
+                    "url": url, **validators,
+                }))
+            digests = await self._stream(r, file_id, partial or ofile_path, offset)
+        if partial:
+            partial.replace(ofile_path)
+            self._partial_infos_path(partial).unlink(missing_ok=True)
+        if self.cache:
+            await asyncio.to_thread(
+                self.cache.put, url, ofile_path, digests["sha1"], digests=digests, **validators
+            )
+        has_changed = self.has_changed(file_id, sha1sum=digests["sha1"])
+        return has_changed, Resource(**{
+            "file": ofile_path,
+            "name": file_id,
+            "sha1sum": digests["sha1"],
+            "size": ofile_path.stat().st_size,
+            "digests": digests,
+            **validators,
+        })
+
+
+class AsyncDataGouvFrGateway(DataGouvFrGateway):
+    """
+    Upload to [data.gouv.fr](https://www.data.gouv.fr) with an `aiohttp.ClientSession`.
+
+    Same API and options as `sweeper.gateways.datagouvfr.DataGouvFrGateway`,
+    with coroutines. Files are read from disk in a thread while being sent.
+    """
+    READ_SIZE = 65536
+    """Size of the blocks read from the multipart body"""
+
+    def __init__(self, token: Optional[str], session: aiohttp.ClientSession, **kwargs):
+        super().__init__(token, session=session, **kwargs)
+
+    async def update_resource(self, dataset_id, resource_id, **kwargs) -> dict:
+        """Helper function to update a resource (PUT)"""
+        with timer("datagouvfr_update", resource_id):
+            async with self.session.put(
+                f"{self.base_url}/datasets/{dataset_id}/resources/{resource_id}/",
+                json=kwargs,
+                headers={"X-Api-Key": self.token}
+            ) as r:
+                r.raise_for_status()
+                return await r.json()
+
+    async def _read_body(self, body: MultipartEncoder):
+        while chunk := await asyncio.to_thread(body.read, self.READ_SIZE):
+            yield chunk
+
+    async def _post_with_retry(self, url: str, fields: dict, check_success=False) -> dict:
+        """Post streamed multipart form data (cf `MultipartEncoder`), retrying on failure"""
+        for attempt in range(self.retries + 1):
+            body = MultipartEncoder(fields)
+            try:
+                async with self.session.post(url, data=self._read_body(body), headers={
+                    "X-Api-Key": self.token,
+                    "Content-Type": body.content_type,
+                    "Content-Length": str(len(body)),
+                }) as r:
+                    r.raise_for_status()
+                    data = await r.json()
+                if check_success and not data.get("success"):
+                    raise aiohttp.ClientError(f"Upload failed: {data}")
+                return data
+            except aiohttp.ClientError as e:
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                log.warning(f"Upload to {url} failed ({e}), retrying in {delay}s...")
+                await asyncio.sleep(delay)
+            finally:
+                body.close()
+
+    async def post_file_chunked(self, url: str, filepath: Path):
+        """
+        Helper function to post a local file to given url, with chunked upload.
+
+        The final request is sent once every chunk has been acknowledged.
+        """
+        size = filepath.stat().st_size
+        total_parts = math.ceil(size / self.chunk_size)
+        semaphore = asyncio.Semaphore(self.max_parallel_chunks)
+        # tuples for multipart form data compliance
+        data = {
+            "totalparts": ("", total_parts),
+            "size": ("", size),
+            "filename": ("", filepath.name),
+            "uuid": ("", str(uuid4())),
+        }
+
+        async def post_chunk(index: int):
+            offset = index * self.chunk_size
+            chunk = FilePart(filepath, offset, min(self.chunk_size, size - offset))
+            async with semaphore:
+                await self._post_with_retry(url, dict(data, **{
+                    "partindex": ("", index),
+                    "chunksize": ("", chunk.length),
+                    "partbyteoffset": ("", offset),
+                    "file": ("blob", chunk)
+                }), check_success=True)
+
+        tasks = [asyncio.ensure_future(post_chunk(index)) for index in range(total_parts)]
+        try:
+            await asyncio.gather(*tasks)
+        except Exception:
+            for task in tasks:
+                task.cancel()
+            raise
+        return await self._post_with_retry(url, data)
+
+    async def post_file(self, url, filepath):
+        """Helper function to post a local file to given url"""
+        return await self._post_with_retry(url, {"file": (filepath.name, FilePart(filepath))})
+
+    async def _upload(self, url: str, filepath: Path) -> dict:
+        with timer("datagouvfr_upload", filepath.name) as t:
+            if self._is_chunked(filepath):
+                data = await self.post_file_chunked(url, filepath)
+            else:
+                data = await self.post_file(url, filepath)
+            t.add(filepath.stat().st_size)
+        return data
+
+    async def upload_replace_resource(
+        self, dataset_id: str, resource_id: str, filepath: Path, **kwargs
+    ) -> dict:
+        """Replace a resource by uploading a local file."""
+        url = f"{self.base_url}/datasets/{dataset_id}/resources/{resource_id}/upload/"
+        log.info(f"Replacing file resource {url}...")
+        data = await self._upload(url, filepath)
+        update = self._update_from_kwargs(data, kwargs)
+        if update:
+            data = await self.update_resource(dataset_id, resource_id, **update)
+        return data
+
+    async def upload_add_resource(self, dataset_id, filepath, type='main', **kwargs):
+        """Add a new resource to a dataset by uploading a local file."""
+        url = f"{self.base_url}/datasets/{dataset_id}/upload/"
+        log.info(f"Adding file to {dataset_id} w/ resource {filepath}...")
+        data = await self._upload(url, filepath)
+        update = self._update_from_kwargs(data, kwargs)
+        if update:
+            data = await self.update_resource(dataset_id, update["id"], **update)
+        return data
+
+    async def remote_replace_resource(self, dataset_id, resource_id, url, title, **kwargs):
+        """Replace a remote resource by updating (at least) url and title"""
+        resource_url = f"{self.domain}/datasets/{dataset_id}/#resource-{resource_id}"
+        log.info(f"Replacing remote resource {resource_url}: {title} | {url}...")
+        return await self.update_resource(dataset_id, resource_id, **{
+            "title": title,
+            "url": url,
+            **kwargs,
+        })
+
+
+class AsyncSSHGateway():
+    """
+    Run the calls of a `sweeper.gateways.ssh.SSHGateway` in threads.
+
+    Calls on a same gateway are serialized, its SFTP channel being shared:
+    use one gateway per connection to transfer in parallel.
+    """
+
+    def __init__(self, gateway: "SSHGateway"):
+        self.gateway = gateway
+        self._lock = threading.Lock()
+
+    def _locked(self, func, *args, **kwargs):
+        with self._lock:
+            return func(*args, **kwargs)
+
+    async def _run(self, func, *args, **kwargs):
+        return await asyncio.to_thread(self._locked, func, *args, **kwargs)
+
+    async def upload(self, local, remote):
+        return await self._run(self.gateway.upload, local, remote)
+
+    async def copy(self, src: str, dst: str, local=None) -> str:
+        return await self._run(self.gateway.copy, src, dst, local=local)
+
+    async def link(self, src: str, dst: str) -> str:
+        return await self._run(self.gateway.link, src, dst)
+
+
+class AsyncS3Gateway():
+    """Run the calls of a `sweeper.gateways.s3.S3Gateway` in threads"""
+
+    def __init__(self, gateway: "S3Gateway"):
+        self.gateway = gateway
+
+    async def is_identical(self, local: Path, remote: str, sha1sum: str) -> bool:
+        return await asyncio.to_thread(self.gateway.is_identical, local, remote, sha1sum)
+
+    async def upload(
+        self, local: Union[str, Path], remote: str, sha1sum: Optional[str] = None
+    ) -> bool:
+        return await asyncio.to_thread(self.gateway.upload, local, remote, sha1sum=sha1sum)
@@ -1,13 +1,18 @@
 import logging
 import math
+import time
 import typing
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from uuid import uuid4
 from pathlib import Path
 
 import requests
 
-from sweeper.utils.progress import ProgressBar
+from sweeper.utils.http import make_session
+from sweeper.utils.multipart import FilePart, MultipartEncoder
+from sweeper.utils.progress import Progress
+from sweeper.utils.stats import timer
 
 log = logging.getLogger(__name__)
 
@@ -26,36 +31,76 @@ class DataGouvFrGateway():
         title="Mon fichier"
     )
     ```
+
+    Requests are made with `session` if given (cf `sweeper.utils.http.make_session`).
+
+    Files are streamed from disk. Files bigger than `chunk_threshold` are uploaded
+    by chunks, sending up to `max_parallel_chunks` chunks of `chunk_size` bytes
+    at once. A failed upload request is retried `retries` times, waiting `backoff` seconds
+    then twice as long on each attempt.
     """
     CHUNK_SIZE = 2000000
-    """Acts as lower limit for chunk upload and chunk size"""
+    """Acts as default lower limit for chunk upload (`chunk_threshold`) and chunk size"""
 
-    def __init__(self, token: typing.Optional[str], demo=False):
+    def __init__(
+        self, token: typing.Optional[str], demo=False,
+        session: typing.Optional[requests.Session] = None, chunk_size=CHUNK_SIZE,
+        max_parallel_chunks=1, retries=3, backoff=1.0, chunk_threshold=CHUNK_SIZE,
+    ):
         self.token = token
+        self.session = session or make_session()
+        self.chunk_size = chunk_size
+        self.chunk_threshold = chunk_threshold
+        self.max_parallel_chunks = max_parallel_chunks
+        self.retries = retries
+        self.backoff = backoff
         self.domain = f"https://{'demo' if demo else 'www'}.data.gouv.fr"
         self.base_url = f"{self.domain}/api/1"
 
     def update_resource(self, dataset_id, resource_id, **kwargs) -> dict:
         """Helper function to update a resource (PUT)"""
-        r = requests.put(
-            f"{self.base_url}/datasets/{dataset_id}/resources/{resource_id}/",
-            json=kwargs,
-            headers={"X-Api-Key": self.token}
-        )
+        with timer("datagouvfr_update", resource_id):
+            r = self.session.put(
+                f"{self.base_url}/datasets/{dataset_id}/resources/{resource_id}/",
+                json=kwargs,
+                headers={"X-Api-Key": self.token}
+            )
         r.raise_for_status()
         return r.json()
 
+    def _post_with_retry(self, url: str, fields: dict, check_success=False) -> dict:
+        """Post streamed multipart form data (cf `MultipartEncoder`), retrying on failure"""
+        for attempt in range(self.retries + 1):
+            body = MultipartEncoder(fields)
+            try:
+                r = self.session.post(url, data=body, headers={
+                    "X-Api-Key": self.token,
+                    "Content-Type": body.content_type,
+                })
+                r.raise_for_status()
+                data = r.json()
+                if check_success and not data.get("success"):
+                    raise requests.RequestException(f"Upload failed: {data}")
+                return data
+            except requests.RequestException as e:
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                log.warning(f"Upload to {url} failed ({e}), retrying in {delay}s...")
+                time.sleep(delay)
+            finally:
+                body.close()
+
     def post_file_chunked(self, url: str, filepath: Path):
-        """Helper function to post a local file to given url, with chunked upload"""
-        index = 0
+        """
+        Helper function to post a local file to given url, with chunked upload.
+
+        The final request is sent once every chunk has been acknowledged.
+        """
         size = filepath.stat().st_size
-        total_parts = math.ceil(size / self.CHUNK_SIZE)
+        total_parts = math.ceil(size / self.chunk_size)
         uuid = str(uuid4())
-        transfered = 0
-        bar = ProgressBar(
-            template="|{animation}| {done:B}/{total:B} ({speed:B}/s)",
-            total=size,
-        )
+        progress = Progress(total=size)
         # tuples for multipart form data compliance
         data = {
             "totalparts": ("", total_parts),
@@ -63,38 +108,43 @@ class DataGouvFrGateway():
             "filename": ("", filepath.name),
             "uuid": ("", uuid),
         }
-        with filepath.open("rb") as f:
-            while True:
-                chunk = f.read(self.CHUNK_SIZE)
-                if not len(chunk):
-                    r = requests.post(url, files=data, headers={"X-Api-Key": self.token})
-                    r.raise_for_status()
-                    return r.json()
-                chunk_data = dict(data, **{
-                    "partindex": ("", index),
-                    "chunksize": ("", len(chunk)),
-                    "partbyteoffset": ("", transfered),
-                    "file": ("blob", chunk)
-                })
-                r = requests.post(url, files=chunk_data, headers={"X-Api-Key": self.token})
-                r.raise_for_status()
-                assert r.json()["success"]
-                index += 1
-                transfered += len(chunk)
-                bar.update(done=transfered)
+
+        def post_chunk(index: int):
+            offset = index * self.chunk_size
+            chunk = FilePart(filepath, offset, min(self.chunk_size, size - offset))
+            self._post_with_retry(url, dict(data, **{
+                "partindex": ("", index),
+                "chunksize": ("", chunk.length),
+                "partbyteoffset": ("", offset),
+                "file": ("blob", chunk)
+            }), check_success=True)
+            progress.add(chunk.length)
+
+        with progress, ThreadPoolExecutor(max_workers=self.max_parallel_chunks) as executor:
+            futures = [executor.submit(post_chunk, index) for index in range(total_parts)]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except Exception:
+                executor.shutdown(cancel_futures=True)
+                raise
+        return self._post_with_retry(url, data)
 
     def _is_chunked(self, filepath: Path) -> bool:
-        return filepath.stat().st_size <= self.CHUNK_SIZE
+        return filepath.stat().st_size > self.chunk_threshold
 
     def post_file(self, url, filepath):
         """Helper function to post a local file to given url"""
-        r = requests.post(
-            url,
-            files={"file": (filepath.name, filepath.read_bytes())},
-            headers={"X-Api-Key": self.token},
-        )
-        r.raise_for_status()
-        return r.json()
+        return self._post_with_retry(url, {"file": (filepath.name, FilePart(filepath))})
+
+    def _upload(self, url: str, filepath: Path) -> dict:
+        with timer("datagouvfr_upload", filepath.name) as t:
+            if self._is_chunked(filepath):
+                data = self.post_file_chunked(url, filepath)
+            else:
+                data = self.post_file(url, filepath)
+            t.add(filepath.stat().st_size)
+        return data
 
     def _update_from_kwargs(self, data: dict, kwargs: dict):
         """Update data dict with kwargs if any key matches"""
@@ -110,14 +160,11 @@ class DataGouvFrGateway():
         """
         Replace a resource by uploading a local file.
 
-        Supports chunked upload for files > 2MB.
+        Supports chunked upload for files bigger than `chunk_threshold`.
         """
         url = f"{self.base_url}/datasets/{dataset_id}/resources/{resource_id}/upload/"
         log.info(f"Replacing file resource {url}...")
-        if self._is_chunked(filepath):
-            data = self.post_file(url, filepath)
-        else:
-            data = self.post_file_chunked(url, filepath)
+        data = self._upload(url, filepath)
         # make a second request with updated kwargs <-> resource attributes if any
         update = self._update_from_kwargs(data, kwargs)
         if update:
@@ -128,14 +175,11 @@ class DataGouvFrGateway():
         """
         Add a new resource to a dataset by uploading a local file.
 
-        Supports chunked upload for files > 2MB.
+        Supports chunked upload for files bigger than `chunk_threshold`.
         """
         url = f"{self.base_url}/datasets/{dataset_id}/upload/"
         log.info(f"Adding file to {dataset_id} w/ resource {filepath}...")
-        if self._is_chunked(filepath):
-            data = self.post_file(url, filepath)
-        else:
-            data = self.post_file_chunked(url, filepath)
+        data = self._upload(url, filepath)
         # make a second request with updated kwargs <-> resource attributes if any
         update = self._update_from_kwargs(data, kwargs)
         if update:
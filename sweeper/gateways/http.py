@@ -1,52 +1,408 @@
-import hashlib
+import json
 import logging
+import re
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Tuple, Callable
+from typing import Iterable, Tuple, Callable, Optional
 
 import requests
-from sweeper.utils.progress import ProgressBar
-from sweeper.models import Resource
+from sweeper.utils.cache import DownloadCache
+from sweeper.utils.chunks import AdaptiveChunkSize, iter_chunks
+from sweeper.utils.hashing import DEFAULT_DIGESTS, MultiHasher
+from sweeper.utils.http import make_session
+from sweeper.utils.progress import Progress
+from sweeper.utils.stats import timer
+from sweeper.models import PlannedFile, Resource
 
 log = logging.getLogger(__name__)
 
 
-class HTTPDownloadGateway():
+class BaseHTTPDownloadGateway():
+    """
+    State, resume, cache and hashing helpers shared by `HTTPDownloadGateway`
+    and `sweeper.gateways.aio.AsyncHTTPDownloadGateway`, which document their use.
+    """
+    RESUME_SUFFIX = ".json"
+    """Suffix of the file storing the infos of a partial download, next to it"""
 
-    def __init__(self, has_changed: Callable[..., bool], tmp_dir: Path, auth=None, chunk_size=8192):
+    def __init__(
+        self, has_changed: Callable[..., bool], tmp_dir: Path, chunk_size: int,
+        last_state: Optional[Callable[[str], Optional[dict]]] = None,
+        partial_dir: Optional[Path] = None, cache: Optional[DownloadCache] = None,
+        digests: Iterable[str] = DEFAULT_DIGESTS,
+    ):
         self.chunk_size = chunk_size
-        self.auth = auth
         self.tmp_dir = tmp_dir
         self.has_changed = has_changed
+        self.last_state = last_state
+        self.partial_dir = partial_dir
+        self.cache = cache
+        self.digests = list(digests)
 
-    def download(self, url: str, file_id: str) -> Tuple[bool, Resource]:
-        sha1sum = hashlib.sha1()
-        size = 0
-        with requests.get(url, stream=True, auth=self.auth) as r:
-            if 'content-length' in r.headers:
-                size = int(r.headers['content-length'])
-                if not self.has_changed(file_id, size=size):
-                    return False, Resource(name=file_id, size=size)
+    def _get_last_state(self, file_id: str) -> dict:
+        if not self.last_state:
+            return {}
+        return self.last_state(file_id) or {}
+
+    def _conditional_headers(self, state: dict) -> dict:
+        headers = {}
+        if state.get("etag"):
+            headers["If-None-Match"] = state["etag"]
+        if state.get("last_modified"):
+            headers["If-Modified-Since"] = state["last_modified"]
+        return headers
+
+    def _partial_path(self, file_id: str) -> Optional[Path]:
+        return self.partial_dir / file_id if self.partial_dir else None
+
+    def _partial_infos_path(self, partial: Path) -> Path:
+        return partial.with_name(partial.name + self.RESUME_SUFFIX)
+
+    def _discard_partial(self, partial: Optional[Path]):
+        if partial:
+            partial.unlink(missing_ok=True)
+            self._partial_infos_path(partial).unlink(missing_ok=True)
+
+    def _resume_headers(self, url: str, partial: Optional[Path]) -> Tuple[int, dict]:
+        """Offset and headers needed to resume a partial download, if any"""
+        if not partial or not partial.exists():
+            return 0, {}
+        try:
+            infos = json.loads(self._partial_infos_path(partial).read_text())
+        except (OSError, ValueError):
+            infos = {}
+        # weak ETags can not be used with If-Range
+        etag = infos.get("etag")
+        validator = etag if etag and not etag.startswith("W/") else infos.get("last_modified")
+        offset = partial.stat().st_size
+        if infos.get("url") != url or not validator or not offset:
+            self._discard_partial(partial)
+            return 0, {}
+        return offset, {"Range": f"bytes={offset}-", "If-Range": validator}
+
+    def _total_size(self, status: int, headers, offset: int) -> int:
+        """Total size of the remote file from response `status` and `headers`, 0 if unknown"""
+        if status == 206:
+            match = re.match(r"bytes (\d+)-\d+/(\d+)", headers.get("content-range", ""))
+            if match and int(match.group(1)) == offset:
+                return int(match.group(2))
+        elif 'content-length' in headers:
+            return int(headers['content-length'])
+        return 0
+
+    def _hasher(self, path: Optional[Path] = None) -> MultiHasher:
+        """A hasher for the configured digests, fed with the content of `path` if given"""
+        hasher = MultiHasher(self.digests)
+        if path:
+            try:
+                hasher.update_from_file(path)
+            except Exception:
+                hasher.close()
+                raise
+        return hasher
+
+    def _state_digests(self, state: dict) -> dict:
+        return {name: state[name] for name in self.digests if state.get(name)}
+
+    def _not_modified(self, file_id: str, state: dict) -> Tuple[bool, Resource]:
+        log.debug(f"{file_id} not modified according to server.")
+        return False, Resource(
+            name=file_id,
+            sha1sum=state.get("sha1sum"),
+            size=state.get("size"),
+            etag=state.get("etag"),
+            last_modified=state.get("last_modified"),
+            digests=self._state_digests(state),
+        )
+
+    def _validators(self, r) -> dict:
+        """`ETag` and `Last-Modified` of a `requests` or `aiohttp` response"""
+        return {
+            "etag": r.headers.get("etag"),
+            "last_modified": r.headers.get("last-modified"),
+        }
+
+
+class HTTPDownloadGateway(BaseHTTPDownloadGateway):
+    """
+    Download a file from an HTTP server.
+
+    `has_changed` is used to check the downloaded file against the stored infos
+    (cf `sweeper.pipelines.base.BasePipeline.file_has_changed`).
+
+    If `last_state` is given (cf `sweeper.pipelines.base.BasePipeline.file_last_state`),
+    the stored `ETag` and `Last-Modified` validators are sent as `If-None-Match`
+    and `If-Modified-Since` headers and a `304 Not Modified` response
+    is considered as an unchanged file, without downloading it.
+
+    If `partial_dir` is given, files are downloaded there and moved to `tmp_dir`
+    once complete. An interrupted download is resumed on the next call with a
+    `Range` request, guarded by an `If-Range` on the validator of the partial file
+    so that a file changed in between is downloaded from scratch.
+
+    If `segments` > 1 and the server supports byte ranges, files bigger than
+    two `min_segment_size` are downloaded as (at most) `segments` concurrent ranges
+    written in place in a preallocated file, then hashed in a single pass.
+    Segmented downloads are not resumed.
+
+    Requests are made with `session` if given (cf `sweeper.utils.http.make_session`).
+
+    If `cache` is given, downloaded files are stored in it and a file matching
+    a cached copy (according to its validators) is taken from cache instead
+    of being downloaded again (cf `sweeper.utils.cache.DownloadCache`).
+
+    Responses are read by chunks of `chunk_size` bytes, growing up to `max_chunk_size`
+    on fast links (cf `sweeper.utils.chunks.AdaptiveChunkSize`).
+
+    Files are hashed in a separate thread while being downloaded, computing
+    the `digests` algorithms in a single pass (cf `sweeper.utils.hashing.MultiHasher`).
+    """
+    MIN_SEGMENT_SIZE = 32 * 1024 * 1024
+    """Default minimum size of a segment for segmented downloads"""
+
+    def __init__(
+        self, has_changed: Callable[..., bool], tmp_dir: Path, auth=None,
+        chunk_size=AdaptiveChunkSize.MIN_SIZE, max_chunk_size=AdaptiveChunkSize.MAX_SIZE,
+        last_state: Optional[Callable[[str], Optional[dict]]] = None,
+        partial_dir: Optional[Path] = None, segments=1, min_segment_size=MIN_SEGMENT_SIZE,
+        session: Optional[requests.Session] = None, cache: Optional[DownloadCache] = None,
+        digests: Iterable[str] = DEFAULT_DIGESTS,
+    ):
+        super().__init__(
+            has_changed, tmp_dir, chunk_size, last_state=last_state, partial_dir=partial_dir,
+            cache=cache, digests=digests,
+        )
+        self.max_chunk_size = max_chunk_size
+        self.auth = auth
+        self.segments = segments
+        self.min_segment_size = min_segment_size
+        self.session = session or make_session()
+
+    def _can_segment(self, r: requests.Response, size: int) -> bool:
+        return (
+            self.segments > 1
+            and size >= 2 * self.min_segment_size
+            and r.headers.get("accept-ranges") == "bytes"
+        )
+
+    def _download_segments(self, url: str, file_id: str, path: Path, size: int, validators: dict):
+        """Download `url` in `path` as concurrent byte ranges"""
+        count = min(self.segments, size // self.min_segment_size)
+        bounds = [(i * size // count, (i + 1) * size // count - 1) for i in range(count)]
+        etag = validators["etag"]
+        validator = etag if etag and not etag.startswith("W/") else validators["last_modified"]
+        log.info(f"Downloading {file_id} in {count} segments...")
+        with open(path, "wb") as ofile:
+            ofile.truncate(size)
+        progress = Progress(total=size)
+
+        def fetch(start: int, end: int):
+            headers = {"Range": f"bytes={start}-{end}"}
+            if validator:
+                headers["If-Range"] = validator
+            with self.session.get(url, stream=True, auth=self.auth, headers=headers) as r:
+                r.raise_for_status()
+                if r.status_code != 206:
+                    raise Exception(f"Range {start}-{end} of {file_id} not served")
+                written = 0
+                with open(path, "r+b") as ofile:
+                    ofile.seek(start)
+                    for chunk in self._iter_chunks(r):
+                        ofile.write(chunk)
+                        written += len(chunk)
+                        progress.add(len(chunk))
+            if written != end - start + 1:
+                raise Exception(f"Incomplete range {start}-{end} of {file_id}")
+
+        with timer("http_download", file_id) as t, progress:
+            with ThreadPoolExecutor(max_workers=count) as executor:
+                # consume results to raise errors if any
+                list(executor.map(lambda b: fetch(*b), bounds))
+            t.add(progress.done)
+
+    def _iter_chunks(self, r: requests.Response):
+        """Iterate over the (decoded) response body, by adaptive chunks"""
+        return iter_chunks(
+            lambda size: r.raw.read(size, decode_content=True),
+            AdaptiveChunkSize(self.chunk_size, self.max_chunk_size),
+        )
+
+    def _write_body(
+        self, r: requests.Response, hasher: MultiHasher, outputs: list, offset: int, size: int
+    ) -> int:
+        """Hash the response body and write it to every output, returns the bytes written"""
+        with Progress(
+            total=size, done=offset,
+            animation="{stream}" if not size else "{progress}",
+            steps=["~", "=", "•"],
+        ) as progress:
+            for chunk in self._iter_chunks(r):
+                hasher.update(chunk)
+                for output in outputs:
+                    output.write(chunk)
+                progress.add(len(chunk))
+        return progress.done - offset
+
+    def _stream(self, r: requests.Response, file_id: str, path: Path, offset: int, size: int):
+        """Write the response body to `path` from `offset`, returns the digests of the whole file"""
+        if offset:
+            log.info(f"Resuming download of {file_id} from byte {offset}...")
+        else:
             log.info(f"Downloading {file_id}...")
+        with self._hasher(path if offset else None) as hasher:
+            with timer("http_download", file_id) as t:
+                with open(path, "ab" if offset else "wb") as ofile:
+                    t.add(self._write_body(r, hasher, [ofile], offset, size))
+        return hasher.hexdigests()
+
+    def stream(
+        self, url: str, file_id: str, open_writers: Callable[[], list]
+    ) -> Tuple[bool, Resource]:
+        """
+        Download a file without storing it locally.
+
+        The body is hashed and written on the fly to the writers returned by
+        `open_writers`, eg `sweeper.gateways.ssh.SSHGateway.writer`, which is only
+        called when the file has to be downloaded. Writers are committed if the file
+        has changed, aborted otherwise or on error.
+        """
+        state = self._get_last_state(file_id)
+        headers = self._conditional_headers(state)
+        with self.session.get(url, stream=True, auth=self.auth, headers=headers) as r:
+            if r.status_code == 304:
+                return self._not_modified(file_id, state)
+            validators = self._validators(r)
+            size = self._total_size(r.status_code, r.headers, 0)
+            if size and not self.has_changed(file_id, size=size):
+                return False, Resource(name=file_id, size=size, **validators)
             r.raise_for_status()
-            bar = ProgressBar(
-                animation="{stream}" if not size else "{progress}",
-                steps=["~", "=", "•"],
-                total=size,
-                template="|{animation}| {done:B}/{total:B} ({speed:B}/s)",
+            log.info(f"Streaming {file_id}...")
+            writers = open_writers()
+            try:
+                with self._hasher() as hasher, timer("http_download", file_id) as t:
+                    t.add(self._write_body(r, hasher, writers, 0, size))
+                digests = hasher.hexdigests()
+                has_changed = self.has_changed(file_id, sha1sum=digests["sha1"])
+            except Exception:
+                for writer in writers:
+                    writer.abort()
+                raise
+        for writer in writers:
+            if has_changed:
+                writer.commit()
+            else:
+                writer.abort()
+        return has_changed, Resource(
+            name=file_id, sha1sum=digests["sha1"], size=t.bytes, digests=digests,
+            **validators,
+        )
+
+    def _from_cache(self, url: str, file_id: str, entry: dict) -> Tuple[bool, Resource]:
+        ofile_path = self.tmp_dir / file_id
+        with timer("cache_fetch", file_id) as t:
+            if not self.cache.fetch(entry, ofile_path):
+                return self.download(url, file_id)
+            t.add(entry["size"])
+        log.info(f"{file_id} fetched from cache.")
+        has_changed = self.has_changed(file_id, sha1sum=entry["sha1sum"])
+        return has_changed, Resource(
+            file=ofile_path,
+            name=file_id,
+            sha1sum=entry["sha1sum"],
+            size=entry["size"],
+            etag=entry["etag"],
+            last_modified=entry["last_modified"],
+            digests=entry.get("digests"),
+        )
+
+    def check(self, url: str, file_id: str) -> PlannedFile:
+        """
+        Tell whether `HTTPDownloadGateway.download` would download a file, without downloading it.
+
+        A conditional `HEAD` request is sent with the stored validators, and the size
+        of the remote file is checked against the stored one, as `download` does.
+        """
+        state = self._get_last_state(file_id)
+        try:
+            r = self.session.head(
+                url, auth=self.auth, headers=self._conditional_headers(state),
+                allow_redirects=True,
             )
+        except requests.RequestException as e:
+            return PlannedFile(file_id, PlannedFile.UNKNOWN, reason=str(e))
+        if r.status_code == 304:
+            return PlannedFile(file_id, PlannedFile.UNCHANGED, reason="not modified")
+        if not r.ok:
+            return PlannedFile(file_id, PlannedFile.UNKNOWN, reason=f"HTTP {r.status_code}")
+        size = self._total_size(r.status_code, r.headers, 0) or None
+        validators = self._validators(r)
+        if not state:
+            return PlannedFile(file_id, PlannedFile.CHANGED, size, reason="new file")
+        if size and size == state.get("size"):
+            return PlannedFile(file_id, PlannedFile.UNCHANGED, reason="same size")
+        if size:
+            return PlannedFile(file_id, PlannedFile.CHANGED, size, reason="size changed")
+        if any(validators.values()) and validators != {
+            "etag": state.get("etag"), "last_modified": state.get("last_modified"),
+        }:
+            return PlannedFile(file_id, PlannedFile.CHANGED, reason="validators changed")
+        return PlannedFile(file_id, PlannedFile.UNKNOWN, reason="no size nor validators")
+
+    def download(self, url: str, file_id: str) -> Tuple[bool, Resource]:
+        state = self._get_last_state(file_id)
+        # validators of a cached copy take precedence over the stored ones:
+        # if the server's file matches, it is taken from cache
+        cached = self.cache.get(url) if self.cache else None
+        partial = self._partial_path(file_id)
+        offset, resume_headers = self._resume_headers(url, partial)
+        headers = {**self._conditional_headers(cached or state), **resume_headers}
+        with self.session.get(url, stream=True, auth=self.auth, headers=headers) as r:
+            if r.status_code == 304:
+                self._discard_partial(partial)
+                if cached:
+                    return self._from_cache(url, file_id, cached)
+                return self._not_modified(file_id, state)
+            if r.status_code == 416 and offset:
+                log.warning(f"Could not resume {file_id}, starting over.")
+                self._discard_partial(partial)
+                return self.download(url, file_id)
+            resumed = offset > 0 and r.status_code == 206
+            if not resumed:
+                offset = 0
+            validators = self._validators(r)
+            size = self._total_size(r.status_code, r.headers, offset)
+            if resumed and not size:
+                raise Exception(f"Bad Content-Range while resuming {file_id}")
+            if size and not self.has_changed(file_id, size=size):
+                self._discard_partial(partial)
+                return False, Resource(name=file_id, size=size, **validators)
+            r.raise_for_status()
             ofile_path = self.tmp_dir / file_id
-            with open(ofile_path, "wb") as ofile:
-                count = 0
-                for chunk in r.iter_content(chunk_size=self.chunk_size):
-                    sha1sum.update(chunk)
-                    ofile.write(chunk)
-                    count += 1
-                    bar.update(done=count * self.chunk_size)
-        has_changed = self.has_changed(file_id, sha1sum=sha1sum.hexdigest())
+            if not resumed and self._can_segment(r, size):
+                r.close()
+                # no resume infos, a partial segmented file will be discarded
+                self._discard_partial(partial)
+                self._download_segments(url, file_id, partial or ofile_path, size, validators)
+                with self._hasher(partial or ofile_path) as hasher:
+                    digests = hasher.hexdigests()
+            else:
+                if not resumed and partial:
+                    self._partial_infos_path(partial).write_text(json.dumps({
+                        "url": url, **validators,
+                    }))
+                digests = self._stream(r, file_id, partial or ofile_path, offset, size)
+        if partial:
+            partial.replace(ofile_path)
+            self._partial_infos_path(partial).unlink(missing_ok=True)
+        if self.cache:
+            self.cache.put(url, ofile_path, digests["sha1"], digests=digests, **validators)
+        has_changed = self.has_changed(file_id, sha1sum=digests["sha1"])
         return has_changed, Resource(**{
             "file": ofile_path,
             "name": file_id,
-            "sha1sum": sha1sum.hexdigest(),
+            "sha1sum": digests["sha1"],
             "size": ofile_path.stat().st_size,
+            "digests": digests,
+            **validators,
         })
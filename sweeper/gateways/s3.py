@@ -1,9 +1,66 @@
+import logging
+
 from pathlib import Path
-from typing import Union
+from typing import Optional, Union
 
 import boto3
 
+from boto3.s3.transfer import TransferConfig
 from botocore.client import Config
+from botocore.exceptions import ClientError
+
+from sweeper.utils.stats import timer
+
+log = logging.getLogger(__name__)
+
+
+class S3MultipartWriter():
+    """
+    Write an S3 object through a multipart upload.
+
+    Data is buffered and sent by parts of `part_size` bytes. The object only
+    becomes visible on `S3MultipartWriter.commit`, `S3MultipartWriter.abort`
+    discards the uploaded parts.
+    """
+    PART_SIZE = 8 * 1024 * 1024
+    """S3 requires at least 5MB per part, except the last one"""
+
+    def __init__(self, client, bucket: str, key: str, part_size: int = PART_SIZE):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.parts = []
+        upload = client.create_multipart_upload(Bucket=bucket, Key=key)
+        self.upload_id = upload["UploadId"]
+
+    def _upload_part(self):
+        part_number = len(self.parts) + 1
+        r = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=bytes(self.buffer),
+        )
+        self.parts.append({"PartNumber": part_number, "ETag": r["ETag"]})
+        self.buffer.clear()
+
+    def write(self, data: bytes):
+        self.buffer += data
+        if len(self.buffer) >= self.part_size:
+            self._upload_part()
+
+    def commit(self):
+        if self.buffer or not self.parts:
+            self._upload_part()
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts},
+        )
+
+    def abort(self):
+        self.client.abort_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+        )
 
 
 class S3Gateway():
@@ -24,18 +81,71 @@ class S3Gateway():
     gw.upload("/tmp/monfichier.csv", "mydir/monfichier.csv")
     ```
 
+    Files bigger than `multipart_threshold` bytes are uploaded by parts of
+    `multipart_chunksize` bytes, `max_concurrency` at a time.
     """
+    MULTIPART_THRESHOLD = 8 * 1024 * 1024
+    MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+    MAX_CONCURRENCY = 10
 
-    def __init__(self, bucket: str, s3_endpoint_url: str = None):
+    def __init__(
+        self, bucket: str, s3_endpoint_url: str = None,
+        multipart_threshold: int = MULTIPART_THRESHOLD,
+        multipart_chunksize: int = MULTIPART_CHUNKSIZE,
+        max_concurrency: int = MAX_CONCURRENCY,
+    ):
         s3_endpoint_url = s3_endpoint_url or "https://s3.amazonaws.com"
         self.bucket = bucket
         self.s3 = boto3.resource(
             "s3",
             endpoint_url=s3_endpoint_url,
-            config=Config(signature_version='s3v4'),
+            config=Config(signature_version='s3v4', max_pool_connections=max_concurrency),
+        )
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+            max_concurrency=max_concurrency,
         )
 
-    def upload(self, local: Union[str, Path], remote: str):
-        if not isinstance(local, str):
-            local = str(local)
-        self.s3.Bucket(self.bucket).upload_file(local, remote)
+    def is_identical(self, local: Path, remote: str, sha1sum: str) -> bool:
+        """Is the remote object already there with the same size and sha1sum metadata?"""
+        try:
+            head = self.s3.meta.client.head_object(Bucket=self.bucket, Key=remote)
+        except ClientError as e:
+            code = e.response["Error"]["Code"]
+            if code in ("404", "NoSuchKey"):
+                return False
+            # without s3:ListBucket, a missing key is a 403
+            if code in ("403", "AccessDenied"):
+                log.warning(f"Could not check {remote} on {self.bucket} ({code}), uploading.")
+                return False
+            raise
+        return (
+            head["Metadata"].get("sha1sum") == sha1sum
+            and head["ContentLength"] == local.stat().st_size
+        )
+
+    def upload(self, local: Union[str, Path], remote: str, sha1sum: Optional[str] = None) -> bool:
+        """
+        Upload a local file.
+
+        If `sha1sum` is given, it is stored as the object's metadata and the upload
+        is skipped when the remote object is identical (cf `S3Gateway.is_identical`).
+
+        Returns `False` if the upload has been skipped.
+        """
+        local = Path(local)
+        if sha1sum and self.is_identical(local, remote, sha1sum):
+            log.info(f"{remote} is identical on {self.bucket}, skipping upload.")
+            return False
+        extra_args = {"Metadata": {"sha1sum": sha1sum}} if sha1sum else None
+        with timer("s3_upload", remote) as t:
+            self.s3.Bucket(self.bucket).upload_file(
+                str(local), remote, ExtraArgs=extra_args, Config=self.transfer_config,
+            )
+            t.add(local.stat().st_size)
+        return True
+
+    def writer(self, remote: str) -> S3MultipartWriter:
+        """Open a remote object for streamed writing, cf `S3MultipartWriter`"""
+        return S3MultipartWriter(self.s3.meta.client, self.bucket, remote)
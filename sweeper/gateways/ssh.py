@@ -1,18 +1,71 @@
 import logging
+import posixpath
+import shlex
+import shutil
+import threading
+import typing
 
-from paramiko import SSHClient, SFTPClient
+from paramiko import SSHClient, SFTPClient, SSHException
+from paramiko.sftp import CMD_EXTENDED, int64
 
-from sweeper.utils.progress import ProgressBar
+from sweeper.utils.progress import Progress
+from sweeper.utils.stats import timer
 
 log = logging.getLogger(__name__)
 
 
+class SFTPWriter():
+    """
+    Write a remote file through SFTP, made visible atomically.
+
+    Data is written to a temporary file next to `remote`, which is renamed to
+    `remote` on `SFTPWriter.commit` or deleted on `SFTPWriter.abort`.
+    """
+
+    def __init__(self, sftp: SFTPClient, remote: str):
+        self.sftp = sftp
+        self.remote = remote
+        dirname, basename = posixpath.split(remote)
+        self.tmp_remote = posixpath.join(dirname, f".{basename}.sweeper-tmp")
+        self.file = sftp.open(self.tmp_remote, "wb")
+        # do not wait for the server's ack after each write
+        self.file.set_pipelined(True)
+
+    def write(self, data: bytes):
+        self.file.write(data)
+
+    def commit(self):
+        self.file.close()
+        try:
+            self.sftp.posix_rename(self.tmp_remote, self.remote)
+        except IOError:
+            # posix-rename@openssh.com extension not supported, rename is not atomic
+            try:
+                self.sftp.remove(self.remote)
+            except IOError:
+                pass
+            self.sftp.rename(self.tmp_remote, self.remote)
+
+    def abort(self):
+        self.file.close()
+        try:
+            self.sftp.remove(self.tmp_remote)
+        except IOError:
+            log.warning(f"Could not remove {self.tmp_remote}")
+
+
 class SSHGateway():
+    """
+    Upload to a SSH server (uses SFTP).
 
-    def __init__(self, host, username="root"):
-        self.ssh = SSHClient()
-        self.ssh.load_system_host_keys()
-        self.ssh.connect(host, username=username)
+    A new SSH connection is opened unless an existing `client` is given,
+    in which case only a new SFTP channel is opened on its transport
+    (cf `SSHPool`).
+    """
+
+    def __init__(self, host, username="root", client: typing.Optional[SSHClient] = None):
+        self.owns_client = client is None
+        self.ssh = client or self.connect(host, username)
         self.host = host
         transport = self.ssh.get_transport()
         if transport is not None:
@@ -20,17 +73,154 @@ class SSHGateway():
         else:
             raise Exception("Failed to get ssh transport")
 
+    @staticmethod
+    def connect(host, username="root") -> SSHClient:
+        client = SSHClient()
+        client.load_system_host_keys()
+        client.connect(host, username=username)
+        return client
+
     def upload(self, local, remote):
-        bar = ProgressBar(
-            template="|{animation}| {done:B}/{total:B} ({speed:B}/s)",
-        )
+        log.info(f"Uploading {local} to {self.host}:{remote}...")
+        with timer("ssh_upload", str(remote)) as t, Progress() as progress:
+            t.add(self.sftp.put(local, remote, callback=progress.update).st_size)
 
-        def cb(done, total):
-            bar.update(done=done, total=total)
+    def writer(self, remote) -> SFTPWriter:
+        """Open a remote file for streamed writing, cf `SFTPWriter`"""
+        log.info(f"Streaming to {self.host}:{remote}...")
+        return SFTPWriter(self.sftp, remote)
 
-        log.info(f"Uploading {local} to {self.host}:{remote}...")
-        self.sftp.put(local, remote, callback=cb)
+    def _exec(self, command: str) -> bool:
+        """Run a command on the server, returns `True` if it succeeded"""
+        try:
+            _, stdout, stderr = self.ssh.exec_command(command)
+            status = stdout.channel.recv_exit_status()
+        except SSHException as e:
+            log.debug(f"Could not run `{command}` on {self.host}: {e}")
+            return False
+        if status != 0:
+            log.debug(f"`{command}` failed on {self.host}: {stderr.read()!r}")
+        return status == 0
+
+    def _copy_data(self, src: str, dst: str) -> bool:
+        """Copy a file with the SFTP `copy-data` extension, returns `True` if supported"""
+        try:
+            with self.sftp.open(src, "rb") as fsrc, self.sftp.open(dst, "wb") as fdst:
+                # offset 0 and length 0 (until EOF) on source, offset 0 on destination
+                self.sftp._request(
+                    CMD_EXTENDED, "copy-data",
+                    fsrc.handle, int64(0), int64(0), fdst.handle, int64(0),
+                )
+        except IOError as e:
+            log.debug(f"copy-data extension not supported by {self.host}: {e}")
+            return False
+        return True
+
+    def copy(self, src: str, dst: str, local=None) -> str:
+        """
+        Copy a remote file `src` to `dst`, server-side if possible.
+
+        Tries `cp --reflink=auto` through SSH exec, then the SFTP `copy-data` extension.
+        If neither is available, `local` (the local copy of `src`) is uploaded again
+        if given, else `src` is streamed back and forth through this client.
+
+        Returns the method used: `exec`, `copy-data`, `upload` or `stream`.
+        """
+        log.info(f"Copying {self.host}:{src} to {dst}...")
+        with timer("ssh_copy", dst):
+            return self._copy(src, dst, local)
+
+    def _copy(self, src: str, dst: str, local=None) -> str:
+        if self._exec(f"cp --reflink=auto -- {shlex.quote(src)} {shlex.quote(dst)}"):
+            return "exec"
+        if self._copy_data(src, dst):
+            return "copy-data"
+        log.warning(f"No server-side copy available on {self.host}, uploading again.")
+        if local is not None:
+            self.upload(local, dst)
+            return "upload"
+        writer = self.writer(dst)
+        try:
+            with self.sftp.open(src, "rb") as fsrc:
+                fsrc.prefetch()
+                shutil.copyfileobj(fsrc, writer)
+        except Exception:
+            writer.abort()
+            raise
+        writer.commit()
+        return "stream"
+
+    def link(self, src: str, dst: str) -> str:
+        """
+        Hardlink a remote file `src` to `dst`.
+
+        Uses the SFTP `hardlink@openssh.com` extension or `ln` through SSH exec.
+        Beware that `dst` will reflect any change made in place to `src`
+        (eg with `SSHGateway.upload`, but not with `SSHGateway.writer`).
+
+        Returns the method used: `hardlink` or `exec`.
+        """
+        log.info(f"Linking {self.host}:{src} to {dst}...")
+        try:
+            self.sftp._request(CMD_EXTENDED, "hardlink@openssh.com", src, dst)
+            return "hardlink"
+        except IOError as e:
+            log.debug(f"hardlink extension not supported by {self.host}: {e}")
+        if self._exec(f"ln -f -- {shlex.quote(src)} {shlex.quote(dst)}"):
+            return "exec"
+        raise Exception(f"Could not link {src} to {dst} on {self.host}")
 
     def teardown(self):
         self.sftp.close()
-        self.ssh.close()
+        if self.owns_client:
+            self.ssh.close()
+
+
+class SSHPool():
+    """
+    Pool of SSH connections, keyed by `(host, username)`.
+
+    A connection is opened once and shared by every `SSHGateway` returned by
+    `SSHPool.get`, each using its own SFTP channel. Pooled connections are
+    health-checked before being reused and reopened if needed.
+
+    Example usage:
+    ```python
+    pool = SSHPool()
+    gw = pool.get("example.com")
+    gw.upload("/tmp/monfichier.csv", "/data/monfichier.csv")
+    gw.teardown()  # closes the SFTP channel only
+    pool.close()
+    ```
+    """
+
+    def __init__(self):
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def _is_alive(self, client: SSHClient) -> bool:
+        transport = client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except (EOFError, OSError, SSHException):
+            return False
+        return True
+
+    def get(self, host, username="root") -> SSHGateway:
+        with self.lock:
+            client = self.clients.get((host, username))
+            if client is None or not self._is_alive(client):
+                if client is not None:
+                    log.info(f"Reconnecting to {host}...")
+                    client.close()
+                client = SSHGateway.connect(host, username)
+                self.clients[(host, username)] = client
+        return SSHGateway(host, username, client=client)
+
+    def close(self):
+        with self.lock:
+            for client in self.clients.values():
+                client.close()
+            self.clients = {}
@@ -11,7 +11,26 @@ class Resource():
     name: str
     sha1sum: typing.Optional[str] = None
     size: typing.Optional[int] = None
+    etag: typing.Optional[str] = None
+    last_modified: typing.Optional[str] = None
     error: typing.Optional[str] = None
     created_at: datetime = datetime.utcnow()
     file: typing.Optional[Path] = None
     metadata_id: typing.Optional[int] = None
+    digests: typing.Optional[dict] = None
+    """Digests of the file by algorithm, cf `sweeper.utils.hashing.MultiHasher`"""
+
+
+@dataclass
+class PlannedFile():
+    """What a run would do with a file, cf `sweeper.pipelines.base.BasePipeline.plan`"""
+    CHANGED = "changed"
+    UNCHANGED = "unchanged"
+    UNKNOWN = "unknown"
+
+    name: str
+    status: str
+    """`PlannedFile.CHANGED`, `PlannedFile.UNCHANGED` or `PlannedFile.UNKNOWN` (cf `reason`)"""
+    size: typing.Optional[int] = None
+    """Bytes that would be transferred, if known"""
+    reason: typing.Optional[str] = None
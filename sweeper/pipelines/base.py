@@ -1,12 +1,18 @@
+import asyncio
 import os
 import shutil
 import logging
+import threading
+import time
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
+from typing import Any, Awaitable, Callable, Iterable, List, Optional
 
-from sweeper import get_db
-from sweeper.models import Resource
+from sweeper import ensure_columns, get_db
+from sweeper.models import PlannedFile, Resource
+from sweeper.utils.cache import DownloadCache
 
 log = logging.getLogger(__name__)
 
@@ -29,6 +35,8 @@ class BasePipeline():
     - `BasePipeline.run` _must_ be defined
     - `BasePipeline.pre_run` _can_ be defined
     - `BasePipeline.post_run` _can_ be defined
+    - `BasePipeline.plan` _can_ be defined, for `sweeper plan`
+    - `BasePipeline.run_infos` _can_ be extended
 
     ### Use
 
@@ -36,22 +44,89 @@ class BasePipeline():
 
     - `BasePipeline.register_file`
     - `BasePipeline.register_error`
+    - `BasePipeline.flush`
     - `BasePipeline.file_has_changed`
+    - `BasePipeline.file_last_state`
+    - `BasePipeline.process_concurrently`
+    - `BasePipeline.get_option`
+    - `BasePipeline.session`
+    - `BasePipeline.get_s3_gateway`
+    - `BasePipeline.ssh_pool`
 
     """
     name = None
 
-    def __init__(self, metadata_id: int, config: dict):
+    def __init__(self, metadata_id: int, config: dict, planning: bool = False):
         if not self.name:
             raise Exception("No name defined for backend")
         self.metadata_id = metadata_id
+        self.planning = planning
+        """Set by `sweeper plan`: nothing is written, neither to DB nor to disk"""
         self.config = config[self.name].get("config", {})
+        self.main_config = config["main"]
         self.errors = []
         secrets = config[self.name].get("secrets", {})
         self.secrets = {k: os.getenv(v) for k, v in secrets.items()}
-        self.table = get_db()[self.name]
+        self.db = get_db()
+        self.table = self.db[self.name]
+        self._state = None
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._flusher = None
+        self._flusher_stop = threading.Event()
         self.tmp_dir = Path(config["main"]["tmp_dir"]) / self.name
-        self.tmp_dir.mkdir(exist_ok=True, parents=True)
+        self.partial_dir = self.tmp_dir / ".partial"
+        """Partial downloads are stored here, it is kept between runs for resuming"""
+        if not planning:
+            self.partial_dir.mkdir(exist_ok=True, parents=True)
+        self._session = None
+        self._ssh_pool = None
+        self._connections = None
+        self._connections_lock = threading.Lock()
+        self.cache = None
+        """Download cache if `cache_dir` option is set, cf `sweeper.utils.cache.DownloadCache`"""
+        if self.get_option("cache_dir") and not planning:
+            self.cache = DownloadCache(
+                self.get_option("cache_dir"), self.get_option("cache_max_size", 10 * 1024 ** 3),
+            )
+
+    def _setup(self):
+        """
+        Executed before `BasePipeline.pre_run` by `sweeper run`.
+
+        Do not override w/o calling super()
+        """
+        if self.planning:
+            # read only: no table means no state yet
+            if self.name in self.db.tables:
+                self._load_state()
+            else:
+                self._state = {}
+            return
+        self._ensure_index()
+        self._load_state()
+
+    def _ensure_index(self):
+        """Index the pipeline table for `BasePipeline.file_last_state` lookups"""
+        self.table.create_column("name", self.db.types.text)
+        self.table.create_column("error", self.db.types.text)
+        self.table.create_column("created_at", self.db.types.datetime)
+        self.table.create_index(["name", "error", "created_at"])
+
+    def _load_state(self):
+        """Load the latest info of every file in memory, in a single query"""
+        table = self.db.engine.dialect.identifier_preparer.quote(self.table.name)
+        rows = self.db.query(f"""
+            SELECT t.* FROM {table} t
+            JOIN (
+                SELECT name, MAX(created_at) AS max_created_at FROM {table}
+                WHERE error IS NULL GROUP BY name
+            ) latest ON t.name = latest.name AND t.created_at = latest.max_created_at
+            WHERE t.error IS NULL
+        """)
+        self._state = {row["name"]: dict(row) for row in rows}
 
     def pre_run(self):
         """
@@ -77,9 +152,177 @@ class BasePipeline():
         """
         pass
 
+    def plan(self) -> List[PlannedFile]:
+        """
+        What `BasePipeline.run` would do with each file, without transferring any,
+        used by `sweeper plan`.
+
+        Should rely on cheap checks (eg `sweeper.gateways.http.HTTPDownloadGateway.check`)
+        and the stored state (cf `BasePipeline.file_last_state`). Nothing should be
+        written, neither to DB nor to disk (cf `BasePipeline.planning`).
+        Called after `BasePipeline._setup`, without `BasePipeline.pre_run`.
+        """
+        raise NotImplementedError(f"{self.__class__.__name__} does not support planning")
+
+    @property
+    def session(self):
+        """
+        HTTP session shared by the gateways of a job run, to reuse connections.
+
+        Configured by `http_pool_size` and `http_keep_alive` options (cf `BasePipeline.get_option`).
+        The pool size defaults to the concurrent requests made by a run,
+        `max_workers` × `http_segments`, and at least 10.
+        """
+        # created on first use, possibly by several worker threads at once
+        with self._connections_lock:
+            if self._session is None:
+                # imported here since requests takes a while, cf `sweeper --help`
+                from sweeper.utils.http import make_session
+                self._session = make_session(
+                    pool_size=self._http_pool_size(),
+                    keep_alive=self.get_option("http_keep_alive", True),
+                )
+        return self._session
+
+    def _http_pool_size(self) -> int:
+        concurrency = self.get_option("max_workers", 1) * self.get_option("http_segments", 1)
+        return self.get_option("http_pool_size", max(10, concurrency))
+
+    @property
+    def ssh_pool(self):
+        """SSH connections shared by the gateways of a job run, cf `sweeper.gateways.ssh.SSHPool`"""
+        with self._connections_lock:
+            if self._ssh_pool is None:
+                from sweeper.gateways.ssh import SSHPool
+                self._ssh_pool = SSHPool()
+        return self._ssh_pool
+
+    def get_s3_gateway(self, bucket: str, s3_endpoint_url: Optional[str] = None):
+        """
+        Build a `sweeper.gateways.s3.S3Gateway` with transfer settings from the
+        `s3_multipart_threshold`, `s3_multipart_chunksize` and `s3_max_concurrency`
+        options (cf `BasePipeline.get_option`).
+        """
+        from sweeper.gateways.s3 import S3Gateway
+        return S3Gateway(
+            bucket, s3_endpoint_url=s3_endpoint_url,
+            multipart_threshold=self.get_option(
+                "s3_multipart_threshold", S3Gateway.MULTIPART_THRESHOLD
+            ),
+            multipart_chunksize=self.get_option(
+                "s3_multipart_chunksize", S3Gateway.MULTIPART_CHUNKSIZE
+            ),
+            max_concurrency=self.get_option("s3_max_concurrency", S3Gateway.MAX_CONCURRENCY),
+        )
+
+    def run_infos(self) -> dict:
+        """
+        Extra infos about the run, stored in its `metadata` row at the end of the run.
+
+        Can be extended, using super().
+        """
+        infos = {}
+        if self.cache:
+            infos["cache_hits"] = self.cache.hits
+            infos["cache_misses"] = self.cache.misses
+        return infos
+
+    def _keep_connections(self, connections: dict):
+        """
+        Reuse the HTTP session and SSH connections stored in `connections`
+        by a previous run, and store them there instead of closing them at teardown.
+
+        Used by `sweeper daemon` to keep connections warm between runs.
+        """
+        self._connections = connections
+        self._session = connections.get("session")
+        self._ssh_pool = connections.get("ssh_pool")
+
+    def _close_connections(self):
+        """Close the HTTP session and SSH connections, unless they are kept"""
+        if self._connections is not None:
+            self._connections.update(session=self._session, ssh_pool=self._ssh_pool)
+        else:
+            if self._session is not None:
+                self._session.close()
+            if self._ssh_pool is not None:
+                self._ssh_pool.close()
+
     def _teardown(self):
         """Do not override w/o calling super()"""
-        shutil.rmtree(self.tmp_dir)
+        self._stop_flusher()
+        self.flush()
+        self._close_connections()
+        for path in self.tmp_dir.iterdir():
+            if path == self.partial_dir:
+                continue
+            if path.is_dir():
+                shutil.rmtree(path)
+            else:
+                path.unlink()
+
+    def get_option(self, key: str, default=None):
+        """
+        Get an option from the pipeline config (`[<name>.config]`),
+        falling back to the `[main]` section, then to `default`.
+        """
+        return self.config.get(key, self.main_config.get(key, default))
+
+    def process_concurrently(
+        self, func: Callable[[Any], Optional[Resource]], items: Iterable,
+        name: Callable[[Any], str] = str,
+    ):
+        """
+        Call `func` on every item of `items` with a pool of `max_workers` threads.
+
+        `max_workers` is read through `BasePipeline.get_option` and defaults to 1.
+        With a single worker, items are processed sequentially in the calling thread.
+
+        DB writes happen in the calling thread: if `func` returns a
+        `sweeper.models.Resource` it is stored with `BasePipeline.register_file`,
+        if it raises the error is stored with `BasePipeline.register_error`,
+        using `name(item)` as the resource name.
+
+        `items` can be a lazy iterable (eg parsed while downloaded): if iterating it
+        raises, the items already submitted are processed and stored, then the error
+        is raised.
+        """
+        max_workers = self.get_option("max_workers", 1)
+        if max_workers <= 1:
+            for item in items:
+                self._register_result(name(item), lambda: func(item))
+            return
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            try:
+                for item in items:
+                    futures[executor.submit(func, item)] = item
+            finally:
+                for future in as_completed(futures):
+                    self._register_result(name(futures[future]), future.result)
+
+    def _register_result(self, name: str, get_result: Callable[[], Optional[Resource]]):
+        try:
+            resource = get_result()
+        except Exception as e:
+            self.register_error(Resource(name=name, error=str(e)))
+        else:
+            if resource is not None:
+                self.register_file(resource)
+
+    def file_last_state(self, filename) -> Optional[dict]:
+        """
+        Latest info stored in DB for a file, from a successful `BasePipeline.register_file`.
+
+        Returns `None` if the file has never been registered.
+
+        Infos are read from memory once loaded at setup time (cf `sweeper.sync.run`),
+        from DB otherwise.
+        """
+        if self._state is not None:
+            return self._state.get(filename)
+        self.flush()
+        return self.table.find_one(name=filename, error=None, order_by='-created_at', _limit=1)
 
     def file_has_changed(self, filename, sha1sum=None, size=None) -> bool:
         """
@@ -90,7 +333,7 @@ class BasePipeline():
 
         It can be checked againt `sha1sum` or `size` (in bytes) values.
         """
-        res = self.table.find_one(name=filename, error=None, order_by='-created_at', _limit=1)
+        res = self.file_last_state(filename)
         if not res:
             return True
         elif sha1sum and sha1sum != res["sha1sum"]:
@@ -108,12 +351,84 @@ class BasePipeline():
 
         Those info will be used by `BasePipeline.file_has_changed` to check if
         a file has or not since last run.
+
+        `sweeper.models.Resource.digests` are stored in a column per algorithm (eg `sha256`).
+
+        Rows are written by batches of `db_batch_size` (default 1, ie right away),
+        or when `db_flush_interval` seconds have passed since the last write,
+        cf `BasePipeline.flush`. With batches, a background thread also writes pending
+        rows every `db_flush_interval` seconds, so that they are not kept in memory
+        while no file is registered (eg during a long transfer).
         """
         resource.metadata_id = self.metadata_id
         resource.created_at = datetime.utcnow()
         data = resource.__dict__
         data.pop("file")
-        self.table.insert(data)
+        digests = data.pop("digests") or {}
+        data.update({name: value for name, value in digests.items() if name != "sha1"})
+        batch_size = self.get_option("db_batch_size", 1)
+        interval = self.get_option("db_flush_interval", 10)
+        with self._pending_lock:
+            self._pending.append(data)
+            if self._state is not None and resource.error is None:
+                self._state[resource.name] = dict(data)
+            should_flush = (
+                len(self._pending) >= batch_size
+                or time.monotonic() - self._last_flush >= interval
+            )
+            if not should_flush and self._flusher is None and interval > 0:
+                self._flusher = threading.Thread(
+                    target=self._flush_periodically, args=(interval,),
+                    name="sweeper-flusher", daemon=True,
+                )
+                self._flusher.start()
+        if should_flush:
+            self.flush()
+
+    def _flush_periodically(self, interval: float):
+        """Flush pending rows every `interval` seconds, until `BasePipeline._stop_flusher`"""
+        try:
+            while not self._flusher_stop.wait(interval):
+                try:
+                    self.flush()
+                except Exception as e:
+                    log.warning(f"Could not write pending rows, will retry: {e}")
+        finally:
+            # dataset opens a connection per thread, close this one from its own thread
+            with self.db.lock:
+                connection = self.db.connections.pop(threading.get_ident(), None)
+            if connection is not None:
+                connection.close()
+
+    def _stop_flusher(self):
+        if self._flusher is not None:
+            self._flusher_stop.set()
+            self._flusher.join()
+            self._flusher = None
+            self._flusher_stop.clear()
+
+    def flush(self):
+        """
+        Write pending `BasePipeline.register_file` rows to DB, in a single transaction.
+
+        Called at the end of a run by `sweeper run`, even when it fails,
+        before updating the run `metadata`. Rows are kept pending if the write fails.
+        """
+        # a flush in progress in another thread is over when this one returns
+        with self._flush_lock:
+            with self._pending_lock:
+                rows, self._pending = self._pending, []
+                self._last_flush = time.monotonic()
+            if not rows:
+                return
+            try:
+                ensure_columns(self.table, rows)
+                with self.db as tx:
+                    tx[self.name].insert_many(rows)
+            except Exception:
+                with self._pending_lock:
+                    self._pending = rows + self._pending
+                raise
 
     def register_error(self, resource: Resource):
         """
@@ -125,3 +440,80 @@ class BasePipeline():
         log.error(f"[error] {resource}")
         self.errors.append(resource)
         self.register_file(resource)
+
+
+class AsyncBasePipeline(BasePipeline):
+    """
+    ## Base class for async pipelines.
+
+    Works as `BasePipeline`, except that `AsyncBasePipeline.run` is a coroutine,
+    run in an event loop by `sweeper run`. Many transfers can be kept in flight
+    with `AsyncBasePipeline.process_concurrently`, using the async gateways
+    from `sweeper.gateways.aio` (requires the `async` extra).
+
+    `AsyncBasePipeline.async_session` is an `aiohttp.ClientSession` shared by the
+    async HTTP gateways. Blocking gateways (SSH, S3) can be wrapped to be run in threads,
+    eg `sweeper.gateways.aio.AsyncSSHGateway`.
+    """
+
+    def __init__(self, metadata_id: int, config: dict, planning: bool = False):
+        super().__init__(metadata_id, config, planning=planning)
+        self._async_session = None
+
+    async def run(self):
+        """
+        Main logic goes here.
+
+        This *must* be redefined.
+        """
+        raise NotImplementedError()
+
+    @property
+    def async_session(self):
+        """
+        HTTP session shared by the async gateways of a job run,
+        configured as `BasePipeline.session`.
+        """
+        if self._async_session is None:
+            from sweeper.utils.http import make_async_session
+            self._async_session = make_async_session(
+                pool_size=self.get_option("http_pool_size", 10),
+                keep_alive=self.get_option("http_keep_alive", True),
+            )
+        return self._async_session
+
+    async def _run_async(self):
+        """Run `AsyncBasePipeline.run` and close the resources bound to the event loop"""
+        try:
+            await self.run()
+        finally:
+            if self._async_session is not None:
+                await self._async_session.close()
+                self._async_session = None
+
+    async def process_concurrently(
+        self, func: Callable[[Any], Awaitable[Optional[Resource]]], items: Iterable,
+        name: Callable[[Any], str] = str,
+    ):
+        """
+        Await `func` on every item of `items`, with at most `max_in_flight`
+        (default 10, cf `BasePipeline.get_option`) calls running at once.
+
+        Results are stored as with `BasePipeline.process_concurrently`.
+        """
+        semaphore = asyncio.Semaphore(self.get_option("max_in_flight", 10))
+
+        async def process(item):
+            async with semaphore:
+                try:
+                    resource = await func(item)
+                except Exception as e:
+                    return item, e
+                return item, resource
+
+        for task in asyncio.as_completed([process(item) for item in items]):
+            item, result = await task
+            if isinstance(result, Exception):
+                self.register_error(Resource(name=name(item), error=str(result)))
+            elif result is not None:
+                self.register_file(result)
@@ -2,12 +2,22 @@
 
 Steps :
 
-- get the list of files (see below)
-- download them and see if they have changed since last run
+- get the list of files (see below), streamed: files are dispatched while it is received.
+  With `conditional_listing = true`, the listing is stored in the `sirene_listing` table
+  and requested with its `ETag` and `Last-Modified`: if neither the listing nor the mapping
+  have changed, the stored files are processed again (each one still being checked below)
+- download them (only if `ETag` or `Last-Modified` changed) and see if they
+  have changed since last run,
+  `max_workers` files at a time (see `sweeper.pipelines.base.BasePipeline.process_concurrently`)
 - if they did change
     - upload to files.data.gouv.fr both with and without timestamp
+      (the timestamped one being copied server-side if possible)
+      (with `streaming = true`, files are streamed from source to files.data.gouv.fr
+      without being stored locally, and replaced only if they did change)
     - update data.gouv.fr's resources according to `sirene.config.mapping` in `jobs.toml`
 
+`sweeper plan sirene` tells which files would be downloaded, with `HEAD` requests only.
+
 This is what we're expecting as a source file:
 
 ```xml
@@ -36,84 +46,249 @@ This is what we're expecting as a source file:
 </ns2:ServiceDepotRetrait>
 ```
 """
+import hashlib
+import json
 import logging
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, date
+from xml.etree import ElementTree
 
-import xmltodict
 import requests
 from requests.auth import HTTPBasicAuth
 
 from sweeper.pipelines.base import BasePipeline
-from sweeper.gateways.ssh import SSHGateway
 from sweeper.gateways.http import HTTPDownloadGateway
 from sweeper.gateways.datagouvfr import DataGouvFrGateway
-from sweeper.models import Resource
+from sweeper.models import PlannedFile, Resource
 
 log = logging.getLogger(__name__)
 
 
 class SirenePipeline(BasePipeline):
     name = "sirene"
+    LISTING_CHUNK_SIZE = 4096
+    """Size of the blocks read from the listing, small enough to dispatch files early"""
 
     def pre_run(self):
         pass
 
-    def run(self):
-        source_url = self.config["source_url"]
-        auth = None
+    def _auth(self) -> typing.Optional[HTTPBasicAuth]:
         if self.secrets["basicauth_user"]:
-            auth = HTTPBasicAuth(
+            return HTTPBasicAuth(
                 self.secrets["basicauth_user"],
                 self.secrets["basicauth_password"],
             )
-        r = requests.get(source_url, auth=auth)
-        assert r.status_code == 200, "bad response from list"
-        xmldict = xmltodict.parse(r.text)
-        files = xmldict['ns2:ServiceDepotRetrait']['Fichiers']
-        if not isinstance(files, list):
-            files = [files]
+        return None
+
+    def _parse_listing(self, r: requests.Response) -> typing.Iterator[dict]:
+        """Files of the listing, yielded as soon as their entry has been received"""
+        parser = ElementTree.XMLPullParser(events=("end",))
+
+        def entries():
+            for _, elem in parser.read_events():
+                if elem.tag.rsplit("}", 1)[-1] == "Fichiers":
+                    file = {child.tag: child.text for child in elem}
+                    elem.clear()
+                    yield file
+
+        for chunk in r.iter_content(chunk_size=self.LISTING_CHUNK_SIZE):
+            parser.feed(chunk)
+            yield from entries()
+        parser.close()
+        yield from entries()
+
+    def _fingerprint(self, files: typing.List[dict]) -> str:
+        """Fingerprint of the listed files and of the mapping they are processed with"""
+        data = json.dumps({"files": files, "mapping": self.config["mapping"]}, sort_keys=True)
+        return hashlib.sha1(data.encode()).hexdigest()
+
+    @property
+    def listing_table(self):
+        """Listings stored with `conditional_listing`, a row per change"""
+        return self.db[f"{self.name}_listing"]
 
-        downloader = HTTPDownloadGateway(self.file_has_changed, self.tmp_dir, auth=auth)
+    def _last_listing(self) -> typing.Optional[dict]:
+        return self.listing_table.find_one(
+            source_url=self.config["source_url"], order_by="-created_at",
+        )
 
+    def _listing_state(self) -> typing.Optional[dict]:
+        """Listing stored by the last run, if `conditional_listing` is set"""
+        if not self.get_option("conditional_listing", False):
+            return None
+        state = self._last_listing()
+        if not state:
+            return None
+        if state["fingerprint"] != self._fingerprint(json.loads(state["files"])):
+            log.info("Mapping has changed since last run, getting the whole listing.")
+            return None
+        return state
+
+    def _mapped(self, files: typing.Iterable[dict]) -> typing.Iterator[dict]:
+        """Mapped files of `files`, all of them being kept in `listed_files`"""
         for file in files:
-            try:
-                if file["id"] not in self.config["mapping"]:
-                    log.warning(f"{file['id']} not found in mapping")
-                    continue
-                has_changed, infos = downloader.download(file["URI"], file["id"])
-                if has_changed:
-                    self.upload(infos)
-                else:
-                    log.info(f"{file['id']} has not changed.")
-            except Exception as e:
-                self.register_error(Resource(name=file["id"], error=str(e)))
-                continue
+            self.listed_files.append(file)
+            if self._is_mapped(file):
+                yield file
+
+    @contextmanager
+    def _listing(self) -> typing.Iterator[typing.Iterator[dict]]:
+        """
+        Stream the source listing: gives an iterator over its mapped files.
+
+        If it has not changed since the last run (cf `_listing_state`),
+        the files stored by that run are given instead.
+        """
+        source_url = self.config["source_url"]
+        self.listed_files = []
+        state = self._listing_state()
+        headers = {}
+        if state and state.get("etag"):
+            headers["If-None-Match"] = state["etag"]
+        if state and state.get("last_modified"):
+            headers["If-Modified-Since"] = state["last_modified"]
+        with self.session.get(source_url, auth=self._auth(), headers=headers, stream=True) as r:
+            if r.status_code == 304 and state:
+                log.info("Listing has not changed since last run, using the stored one.")
+                self.listing_validators = {
+                    "etag": state["etag"], "last_modified": state["last_modified"],
+                }
+                yield self._mapped(json.loads(state["files"]))
+                return
+            assert r.status_code == 200, "bad response from list"
+            self.listing_validators = {
+                "etag": r.headers.get("etag"),
+                "last_modified": r.headers.get("last-modified"),
+            }
+            yield self._mapped(self._parse_listing(r))
+
+    def _store_listing(self):
+        """Store the listing, its validators and fingerprint, if they changed"""
+        if not any(self.listing_validators.values()):
+            return
+        listing = {
+            "source_url": self.config["source_url"],
+            "fingerprint": self._fingerprint(self.listed_files),
+            **self.listing_validators,
+        }
+        state = self._last_listing() or {}
+        if any(listing[key] != state.get(key) for key in listing):
+            self.listing_table.insert({
+                **listing,
+                "files": json.dumps(self.listed_files),
+                "metadata_id": self.metadata_id,
+                "created_at": datetime.utcnow(),
+            })
+
+    def _make_downloader(self) -> HTTPDownloadGateway:
+        return HTTPDownloadGateway(
+            self.file_has_changed, self.tmp_dir, auth=self._auth(),
+            last_state=self.file_last_state, partial_dir=self.partial_dir,
+            session=self.session, cache=self.cache,
+            digests=self.get_option("digests", ["sha1"]),
+            segments=self.get_option("http_segments", 1),
+            min_segment_size=self.get_option(
+                "http_min_segment_size", HTTPDownloadGateway.MIN_SEGMENT_SIZE
+            ),
+        )
+
+    def run(self):
+        with self._listing() as files:
+            self.downloader = self._make_downloader()
+            self.process_concurrently(self.process_file, files, name=lambda f: f["id"])
+        # reached only once the whole listing has been read
+        if self.get_option("conditional_listing", False):
+            self._store_listing()
+
+    def plan(self) -> typing.List[PlannedFile]:
+        """Check the listed files with `HEAD` requests, `max_workers` at a time"""
+        with self._listing() as files:
+            downloader = self._make_downloader()
+            with ThreadPoolExecutor(max_workers=self.get_option("max_workers", 1)) as executor:
+                return list(executor.map(lambda f: downloader.check(f["URI"], f["id"]), files))
+
+    def _is_mapped(self, file: dict) -> bool:
+        if file["id"] not in self.config["mapping"]:
+            log.warning(f"{file['id']} not found in mapping")
+            return False
+        return True
+
+    def process_file(self, file: dict) -> typing.Optional[Resource]:
+        """Download a file and upload it if it has changed, runs in a worker thread"""
+        if self.get_option("streaming", False):
+            has_changed, infos = self.stream(file)
+        else:
+            has_changed, infos = self.downloader.download(file["URI"], file["id"])
+        if not has_changed:
+            log.info(f"{file['id']} has not changed.")
+            # file has been downloaded: keep track of its new validators
+            # in DB so that it won't be downloaded next time
+            if infos.sha1sum and self._has_new_validators(infos):
+                return infos
+            return None
+        if not self.get_option("streaming", False):
+            self.upload(infos)
+        self.update_datagouvfr(infos)
+        return infos
+
+    def _has_new_validators(self, resource: Resource) -> bool:
+        state = self.file_last_state(resource.name) or {}
+        if not resource.etag and not resource.last_modified:
+            return False
+        return (resource.etag, resource.last_modified) != (
+            state.get("etag"), state.get("last_modified")
+        )
+
+    def _remotes(self, name: str) -> typing.Tuple[str, str]:
+        """Remote paths on files.data.gouv.fr, without and with timestamp"""
+        remote = f"{self.config['destination_dir']}/{name}"
+        today = date.today().isoformat()
+        remote_date = f"{self.config['destination_dir']}/{today}-{name}"
+        return remote, remote_date
+
+    def stream(self, file: dict) -> typing.Tuple[bool, Resource]:
+        """
+        Stream a file from source to files.data.gouv.fr, without storing it locally.
+
+        Remote files are only replaced if the file has changed.
+        """
+        remote, remote_date = self._remotes(file["id"])
+        uploader = self.ssh_pool.get(self.config["destination_host"])
+        try:
+            has_changed, infos = self.downloader.stream(
+                file["URI"], file["id"], lambda: [uploader.writer(remote)],
+            )
+            if has_changed:
+                uploader.copy(remote, remote_date)
+            return has_changed, infos
+        finally:
+            uploader.teardown()
 
     def upload(self, resource: Resource):
-        uploader = SSHGateway(self.config["destination_host"])
-        datagouvfr = DataGouvFrGateway(self.secrets["datagouvfr_token"], demo=self.config["demo"])
+        """Upload a local file to files.data.gouv.fr"""
+        remote, remote_date = self._remotes(resource.name)
+        uploader = self.ssh_pool.get(self.config["destination_host"])
         try:
-            # uploading to files.data.gouv.fr
-            remote = f"{self.config['destination_dir']}/{resource.name}"
             uploader.upload(resource.file, remote)
-            today = date.today().isoformat()
-            remote_date = f"{self.config['destination_dir']}/{today}-{resource.name}"
-            uploader.upload(resource.file, remote_date)
-            # update datagouvfr
-            title = resource.name.replace("_utf8.zip", "")
-            res = datagouvfr.remote_replace_resource(
-                self.config["dataset_id"],
-                self.config["mapping"][resource.name],
-                f"https://files.data.gouv.fr/insee-sirene/{resource.name}",
-                f"Fichier {title} du {datetime.now().strftime('%d %B %Y')}",
-                filesize=resource.size,
-                checksum={"value": resource.sha1sum, "type": "sha1"},
-            )
-            # keep track in DB
-            self.register_file(resource)
-            return res
+            uploader.copy(remote, remote_date, local=resource.file)
         finally:
             uploader.teardown()
 
+    def update_datagouvfr(self, resource: Resource) -> dict:
+        datagouvfr = DataGouvFrGateway(
+            self.secrets["datagouvfr_token"], demo=self.config["demo"], session=self.session,
+        )
+        title = resource.name.replace("_utf8.zip", "")
+        return datagouvfr.remote_replace_resource(
+            self.config["dataset_id"],
+            self.config["mapping"][resource.name],
+            f"https://files.data.gouv.fr/insee-sirene/{resource.name}",
+            f"Fichier {title} du {datetime.now().strftime('%d %B %Y')}",
+            filesize=resource.size,
+            checksum={"value": resource.sha1sum, "type": "sha1"},
+        )
+
     def post_run(self):
         pass
@@ -1,45 +1,92 @@
+import asyncio
 import importlib
+import inspect
 import locale
 import logging
+import os
+import signal
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
 
-import coloredlogs
 from minicli import cli, run as clirun, wrap
 
-from sweeper import close_db
+from sweeper import close_db, context, get_db
 from sweeper.utils.config import load as load_config
 from sweeper.utils.metadata import Metadata
+from sweeper.utils.schedule import Scheduler
+from sweeper.utils.stats import Stats
+
+if TYPE_CHECKING:
+    from sweeper.utils.profiling import Profiler
 
-# TODO: this should be configurable
-locale.setlocale(locale.LC_TIME, "fr_FR")
 log = logging.getLogger(__name__)
 
 
 @cli
-def run(job, config="jobs.toml", quiet=False):
+def run(job, config="jobs.toml", quiet=False, profile=False):
     """Run a job sync
 
     :job: name of the job section in jobs.toml
+    :profile: profile the run, cf profile_mode and profile_dir in [main]
     """
+    _setup_logging(quiet)
+    return _run(job, config, profile=profile)
+
+
+def _setup_logging(quiet):
+    import coloredlogs
+
     level = "DEBUG" if not quiet else "INFO"
     mute_loggers = ["boto", "botocore", "s3transfer", "boto3"]
     [logging.getLogger(lg).setLevel(logging.INFO) for lg in mute_loggers]
     coloredlogs.install(level=level, fmt="%(asctime)s %(name)s %(levelname)s %(message)s")
 
+
+def _set_locale(name: str):
+    """Set the locale used to format dates, eg in resources titles"""
+    try:
+        locale.setlocale(locale.LC_TIME, name)
+    except locale.Error:
+        log.warning(f"Locale {name} is not available, using the default one")
+
+
+def _run(job, config, connections: Optional[dict] = None, profile=False):
+    """
+    Run a job, returns the number of errors registered by the pipeline.
+
+    `config` is the path of the config file or its loaded content. If `connections`
+    is given, the job's connections are kept there (cf `BasePipeline._keep_connections`).
+    The run is profiled if `profile` or the `profile` option is set (cf `_start_profiler`).
+    """
     log.info(f"🧹 Sweeping files from job {job}")
 
-    config = load_config(config, job)
+    config = config if isinstance(config, dict) else load_config(config, job)
+    _set_locale(config["main"].get("locale", "fr_FR"))
     _mod, _class = config[job]["backend"].split(':')
     _mod = importlib.import_module(_mod)
 
     metadata = Metadata()
     metadata.start(job)
+    stats = context["stats"] = Stats()
 
-    job = getattr(_mod, _class)(metadata.id, config)
+    job_name, job = job, getattr(_mod, _class)(metadata.id, config)
+    if connections is not None:
+        job._keep_connections(connections)
 
     main_error = None
+    profiler = _start_profiler(config["main"], profile)
     try:
+        job._setup()
         job.pre_run()
-        job.run()
+        if inspect.iscoroutinefunction(job.run):
+            asyncio.run(job._run_async())
+        else:
+            job.run()
     except KeyboardInterrupt:
         main_error = 'Cancelled by user'
     except Exception as e:
@@ -49,9 +96,203 @@ def run(job, config="jobs.toml", quiet=False):
         try:
             job.post_run()
         finally:
-            metadata.end(main_error, job.errors)
-            job._teardown()
-            log.info("🧹 Done sweeping!")
+            try:
+                job.flush()
+            finally:
+                try:
+                    metadata.end(main_error, job.errors, job.run_infos())
+                    _save_stats(
+                        stats, metadata.id, job_name, config["main"], main_error, job.errors
+                    )
+                finally:
+                    context.pop("stats", None)
+                    if profiler:
+                        _stop_profiler(profiler, job_name, metadata.id, config["main"])
+                    job._teardown()
+                    log.info("🧹 Done sweeping!")
+    return len(job.errors)
+
+
+def _save_stats(stats: Stats, metadata_id: int, job: str, main_config: dict, main_error, errors):
+    """
+    Store the stats of a run (cf `sweeper.utils.stats`), and write them as a
+    Prometheus textfile if `prometheus_dir` is set in `[main]`.
+    """
+    stats.log_summary()
+    stats.save(get_db(), metadata_id)
+    if main_config.get("prometheus_dir"):
+        try:
+            stats.write_prometheus(main_config["prometheus_dir"], job, {
+                "duration_seconds": time.monotonic() - stats.started,
+                "errors": len(errors),
+                "failed": int(main_error is not None),
+                "timestamp_seconds": time.time(),
+            })
+        except OSError as e:
+            log.error(f"Could not write Prometheus metrics: {e}")
+
+
+def _start_profiler(main_config: dict, profile=False) -> Optional["Profiler"]:
+    """
+    Start profiling a run if `profile` or the `profile` option is set, with the
+    `profile_mode` option: `cprofile` (default) or `sample` (every `profile_interval` seconds),
+    cf `sweeper.utils.profiling`.
+    """
+    if not (profile or main_config.get("profile")):
+        return None
+    from sweeper.utils.profiling import SamplingProfiler, make_profiler
+
+    profiler = make_profiler(
+        main_config.get("profile_mode", "cprofile"),
+        main_config.get("profile_interval", SamplingProfiler.INTERVAL),
+    )
+    profiler.start()
+    return profiler
+
+
+def _stop_profiler(profiler: "Profiler", job: str, metadata_id: int, main_config: dict):
+    """
+    Dump the profile to `<profile_dir>/<job>-<metadata id>.<prof|folded>`,
+    and log the `profile_top` (default 20) hot functions.
+    """
+    profiler.stop()
+    log.info(f"Profile summary:\n{profiler.summary(main_config.get('profile_top', 20))}")
+    profile_dir = Path(main_config.get("profile_dir", "profiles"))
+    path = profile_dir / f"{job}-{metadata_id}{profiler.extension}"
+    try:
+        profile_dir.mkdir(parents=True, exist_ok=True)
+        profiler.dump(path)
+    except OSError as e:
+        log.error(f"Could not write profile: {e}")
+    else:
+        log.info(f"Profile written to {path}")
+
+
+@cli
+def plan(job, config="jobs.toml", quiet=False):
+    """List the files a job sync would transfer, without transferring any
+
+    :job: name of the job section in jobs.toml
+    """
+    from sweeper.models import PlannedFile
+
+    _setup_logging(quiet)
+    config = load_config(config, job)
+    _mod, _class = config[job]["backend"].split(':')
+    pipeline = getattr(importlib.import_module(_mod), _class)(None, config, planning=True)
+    try:
+        pipeline._setup()
+        planned = pipeline.plan()
+    finally:
+        pipeline._close_connections()
+    for status in (PlannedFile.CHANGED, PlannedFile.UNKNOWN, PlannedFile.UNCHANGED):
+        files = [f for f in planned if f.status == status]
+        size = sum(f.size or 0 for f in files)
+        print(f"{len(files)} {status} file(s), {size / 1024 ** 2:.1f} MB")
+        for f in files:
+            size = f"{f.size / 1024 ** 2:.1f} MB" if f.size is not None else "? MB"
+            print(f"  {f.name:<50} {size:>12}  {f.reason or ''}")
+    return planned
+
+
+def _run_in_process(job, config):
+    """Run a job in a worker process of `run_all`, returns its errors count, error and duration"""
+    # do not reuse the DB connection of the parent process
+    context.pop("db", None)
+    start = time.monotonic()
+    try:
+        run_errors, error = _run(job, config), None
+    except Exception as e:
+        run_errors, error = 0, str(e) or repr(e)
+    finally:
+        close_db()
+    return run_errors, error, time.monotonic() - start
+
+
+@cli
+def run_all(*jobs, config="jobs.toml", parallel=0, quiet=False):
+    """Run several job syncs at the same time, one process per job
+
+    :jobs: names of the job sections in jobs.toml, all jobs if none given
+    :parallel: max jobs running at once, defaults to max_parallel_jobs in [main] or CPU count
+    """
+    _setup_logging(quiet)
+    conf = load_config(config, "main")
+    jobs = jobs or [k for k, v in conf.items() if isinstance(v, dict) and "backend" in v]
+    for job in jobs:
+        load_config(config, job)
+    parallel = parallel or conf["main"].get("max_parallel_jobs", os.cpu_count())
+
+    log.info(f"🧹 Sweeping files from jobs {', '.join(jobs)}")
+    # jobs would race to create it on a new DB
+    Metadata().create_table()
+    with ProcessPoolExecutor(max_workers=min(parallel, len(jobs))) as executor:
+        results = dict(zip(jobs, executor.map(_run_in_process, jobs, [config] * len(jobs))))
+
+    failed = 0
+    for job, (run_errors, error, duration) in results.items():
+        if error:
+            failed += 1
+            log.error(f"❌ {job} failed in {duration:.1f}s: {error}")
+        elif run_errors:
+            log.warning(f"⚠️  {job} done in {duration:.1f}s with {run_errors} file error(s)")
+        else:
+            log.info(f"✅ {job} done in {duration:.1f}s")
+    log.info(f"🧹 {len(jobs) - failed}/{len(jobs)} jobs done")
+    if failed:
+        raise SystemExit(1)
+
+
+def _close_connections(connections: dict):
+    if connections.get("session") is not None:
+        connections["session"].close()
+    if connections.get("ssh_pool") is not None:
+        connections["ssh_pool"].close()
+
+
+def _daemon(scheduler: Scheduler, stop: threading.Event):
+    """Run the jobs of `scheduler` when due, one at a time, until `stop` is set"""
+    connections = {}
+    try:
+        while not stop.is_set():
+            if scheduler.reload(datetime.now()):
+                # options may have changed
+                for job_connections in connections.values():
+                    _close_connections(job_connections)
+                connections = {}
+            job = scheduler.due(datetime.now())
+            if job is None:
+                stop.wait(scheduler.wait_time(datetime.now()))
+                continue
+            try:
+                _run(job, scheduler.config, connections.setdefault(job, {}))
+            except Exception as e:
+                log.exception(f"Job {job} failed: {e}")
+            scheduler.done(job, datetime.now())
+            log.info(f"Next run of {job} at {scheduler.next_runs[job]}")
+    finally:
+        for job_connections in connections.values():
+            _close_connections(job_connections)
+
+
+@cli
+def daemon(config="jobs.toml", quiet=False):
+    """Run jobs according to their schedule, reloading the config file when it changes
+
+    A job is scheduled by a `schedule` key in its section, either a cron expression
+    (eg "*/10 * * * *") or an interval in seconds. Jobs run one at a time in this process.
+    """
+    _setup_logging(quiet)
+    stop = threading.Event()
+
+    def shutdown(signum, frame):
+        log.info("🧹 Stopping once the current job is done...")
+        stop.set()
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+    log.info(f"🧹 Sweeper daemon started with {config}")
+    _daemon(Scheduler(config), stop)
 
 
 @wrap
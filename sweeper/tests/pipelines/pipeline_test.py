@@ -1,5 +1,6 @@
-from sweeper.pipelines.base import BasePipeline
-from sweeper.models import Resource
+from sweeper.pipelines.base import AsyncBasePipeline, BasePipeline
+from sweeper.models import PlannedFile, Resource
+from sweeper.utils.stats import timer
 
 
 class TestPipeline(BasePipeline):
@@ -7,6 +8,8 @@ class TestPipeline(BasePipeline):
     name = "test"
 
     def run(self):
+        with timer("test", "dumdum") as t:
+            t.add(1)
         resource = Resource(
             name="dumdum",
             sha1sum="sha1sum",
@@ -14,6 +17,12 @@ class TestPipeline(BasePipeline):
         )
         self.register_file(resource)
 
+    def plan(self):
+        return [
+            PlannedFile("dumdum", PlannedFile.CHANGED, 2 * 1024 ** 2, "new file"),
+            PlannedFile("other", PlannedFile.UNCHANGED, reason="not modified"),
+        ]
+
 
 class TestPipelineError(TestPipeline):
     name = "test_error"
@@ -27,3 +36,16 @@ class TestPipelineErrorRunError(TestPipeline):
 
     def run(self):
         self.register_error(Resource(name="dumdum", error="ERROR"))
+
+
+class TestAsyncPipeline(AsyncBasePipeline):
+    __test__ = False
+    name = "test_async"
+
+    async def process(self, name):
+        if name == "error":
+            raise Exception("ERROR")
+        return Resource(name=name, sha1sum="sha1sum", size=1)
+
+    async def run(self):
+        await self.process_concurrently(self.process, ["dumdum", "error"])
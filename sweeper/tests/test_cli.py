@@ -1,6 +1,13 @@
+import subprocess
+import sys
+import threading
+
+import dataset
 import pytest
 
-from sweeper.sync import run
+from sweeper import context, sync
+from sweeper.sync import plan, run, run_all
+from sweeper.utils.schedule import Scheduler
 
 
 def test_cli(config_file, db):
@@ -13,6 +20,56 @@ def test_cli(config_file, db):
     assert _run["metadata_id"] == job["id"]
 
 
+def test_cli_stats(config_file, tmp_path, db):
+    config = tmp_path / "jobs.toml"
+    config.write_text(config_file.read_text().replace(
+        "[main]", f'[main]\nprometheus_dir = "{tmp_path}"', 1
+    ))
+    run("test", config=config)
+    job = db["metadata"].find_one(job="test")
+    stats = db["stats"].find_one(metadata_id=job["id"])
+    assert (stats["stage"], stats["name"], stats["bytes"]) == ("test", "dumdum", 1)
+    assert "stats" not in context
+    metrics = (tmp_path / "sweeper_test.prom").read_text()
+    assert 'sweeper_run_errors{job="test"} 0\n' in metrics
+    assert 'sweeper_stage_bytes{job="test",stage="test"} 1\n' in metrics
+
+
+@pytest.mark.parametrize("options,profile,extension", [
+    ("", True, ".prof"),
+    ('profile = true\nprofile_mode = "sample"\nprofile_interval = 0.001', False, ".folded"),
+])
+def test_cli_profile(config_file, tmp_path, db, options, profile, extension):
+    config = tmp_path / "jobs.toml"
+    config.write_text(config_file.read_text().replace(
+        "[main]", f'[main]\nprofile_dir = "{tmp_path / "profiles"}"\n{options}', 1
+    ))
+    run("test", config=config, profile=profile)
+    job = db["metadata"].find_one(job="test")
+    assert (tmp_path / "profiles" / f"test-{job['id']}{extension}").exists()
+
+
+def test_cli_plan(config_file, db, capsys, tmp_path):
+    tmp_config = tmp_path / "jobs.toml"
+    tmp_config.write_text(
+        config_file.read_text().replace("/tmp/data-gw-test", str(tmp_path / "tmp"))
+    )
+    planned = plan("test", config=tmp_config)
+    assert [f.name for f in planned] == ["dumdum", "other"]
+    out = capsys.readouterr().out
+    assert "1 changed file(s), 2.0 MB" in out
+    assert "0 unknown file(s)" in out
+    assert "1 unchanged file(s)" in out
+    # nothing written
+    assert db.tables == []
+    assert not (tmp_path / "tmp").exists()
+
+
+def test_cli_plan_not_supported(config_file, db):
+    with pytest.raises(NotImplementedError):
+        plan("test_async", config=config_file)
+
+
 def test_cli_error(config_file, db):
     with pytest.raises(Exception):
         run("test_error", config=config_file)
@@ -30,3 +87,92 @@ def test_cli_run_error(config_file, db):
     assert _run["error"] == "ERROR"
     assert _run["name"] == "dumdum"
     assert _run["metadata_id"] == job["id"]
+
+
+def test_cli_async(config_file, db):
+    run("test_async", config=config_file)
+    job = db["metadata"].find_one(job="test_async")
+    assert job["error"] is None
+    assert job["has_run_errors"]
+    assert db["test_async"].count(error=None, name="dumdum") == 1
+    assert db["test_async"].count(error="ERROR", name="error") == 1
+
+
+@pytest.fixture
+def file_db(tmp_path, monkeypatch):
+    """DB shared with the worker processes of `run_all`"""
+    url = f"sqlite:///{tmp_path / 'jobs.db'}"
+    monkeypatch.setenv("DATABASE_URL", url)
+    monkeypatch.delitem(context, "db")
+    return dataset.connect(url)
+
+
+def test_cli_run_all(config_file, file_db):
+    run_all("test", "test_run_error", "test_async", config=config_file, parallel=2)
+    jobs = {row["job"]: row for row in file_db["metadata"].all()}
+    assert set(jobs) == {"test", "test_run_error", "test_async"}
+    assert all(job["error"] is None for job in jobs.values())
+    assert jobs["test_run_error"]["has_run_errors"]
+    assert file_db["test"].find_one()["metadata_id"] == jobs["test"]["id"]
+
+
+def test_cli_run_all_error(config_file, file_db):
+    with pytest.raises(SystemExit) as exc:
+        run_all("test", "test_error", config=config_file)
+    assert exc.value.code == 1
+    assert file_db["metadata"].find_one(job="test")["error"] is None
+    assert file_db["metadata"].find_one(job="test_error")["error"] == "ERROR"
+
+
+def test_daemon(config_file, tmp_path, db, mocker):
+    config = tmp_path / "jobs.toml"
+    config.write_text(config_file.read_text().replace(
+        '[test.config]', 'schedule = 0.01\n\n[test.config]', 1
+    ))
+    stop = threading.Event()
+    runs = []
+
+    def _run(job, config, connections):
+        runs.append(connections)
+        if len(runs) == 2:
+            stop.set()
+        return run_job(job, config, connections)
+
+    run_job = sync._run
+    mocker.patch("sweeper.sync._run", side_effect=_run)
+    scheduler = Scheduler(str(config))
+    sync._daemon(scheduler, stop)
+    assert db["metadata"].count(job="test") == 2
+    assert runs[0] is runs[1]
+    assert "ssh_pool" in runs[0]
+
+
+IMPORT_TIME_BUDGET = 0.25
+"""Max seconds spent importing modules for `sweeper --help`"""
+
+
+def test_import_time():
+    """`sweeper --help` should not import DB, logging or gateways dependencies"""
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "sweeper.sync", "--help"],
+        capture_output=True, text=True, check=True,
+    )
+    modules = {}
+    for line in res.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = int(self_us)
+    assert "sweeper.utils.metadata" in modules
+    lazy = {"dataset", "sqlalchemy", "coloredlogs", "requests", "paramiko", "boto3", "pstats"}
+    assert not lazy & set(modules)
+    assert sum(modules.values()) / 1e6 < IMPORT_TIME_BUDGET
+
+
+def test_import_pipeline_base():
+    """Gateways dependencies are imported when a pipeline first uses them"""
+    res = subprocess.run(
+        [sys.executable, "-c", "import sys, sweeper.pipelines.base; print(*sys.modules)"],
+        capture_output=True, text=True, check=True,
+    )
+    assert not {"requests", "aiohttp", "paramiko", "boto3"} & set(res.stdout.split())
@@ -1,14 +1,43 @@
+import asyncio
 import hashlib
 import io
+import json
+import re
+import time
+
+from unittest import mock
 
 import boto3
 import pytest
+import requests
 
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from botocore.exceptions import ClientError
 from moto import mock_s3
+from paramiko import SSHException
 
+from sweeper import context
+from sweeper.gateways.aio import (
+    AsyncDataGouvFrGateway, AsyncHTTPDownloadGateway, AsyncSSHGateway,
+)
 from sweeper.gateways.datagouvfr import DataGouvFrGateway
 from sweeper.gateways.http import HTTPDownloadGateway
 from sweeper.gateways.s3 import S3Gateway
+from sweeper.gateways.ssh import SFTPWriter, SSHGateway, SSHPool
+from sweeper.tests.pipelines.pipeline_test import TestPipeline
+from sweeper.utils.cache import DownloadCache
+from sweeper.utils.http import make_async_session, make_session
+from sweeper.utils.progress import Progress
+from sweeper.utils.stats import Stats
+
+
+@pytest.fixture
+def stats(monkeypatch):
+    """Stats of a fake job run, cf `sweeper.utils.stats.get_stats`"""
+    stats = Stats()
+    monkeypatch.setitem(context, "stats", stats)
+    return stats
 
 
 class TestHTTP():
@@ -83,9 +112,388 @@ class TestHTTP():
         assert resource.sha1sum is None
         spy_changed.assert_called_once_with("dumdum", size=1)
 
+    def test_download_not_modified(self, tmp_path, requests_mock, mocker):
+        state = {"sha1sum": self.sha1sum, "size": 1, "etag": '"abc"',
+                 "last_modified": "Wed, 21 Oct 2015 07:28:00 GMT"}
+        gw = HTTPDownloadGateway(self.has_changed, tmp_path, last_state=lambda _: state)
+        fmock = requests_mock.get("https://example.com/monfichier.zip", status_code=304)
+        spy_changed = mocker.spy(gw, "has_changed")
+        changed, resource = gw.download("https://example.com/monfichier.zip", "dumdum")
+        assert fmock.last_request.headers["If-None-Match"] == '"abc"'
+        assert fmock.last_request.headers["If-Modified-Since"] == state["last_modified"]
+        assert not changed
+        assert resource.file is None
+        assert resource.sha1sum == self.sha1sum
+        assert resource.etag == '"abc"'
+        assert not spy_changed.called
+
+    def test_download_modified_stores_validators(self, tmp_path, requests_mock, body):
+        gw = HTTPDownloadGateway(self.has_changed, tmp_path, last_state=lambda _: None)
+        fmock = requests_mock.get("https://example.com/monfichier.zip", body=body, headers={
+            "ETag": '"def"', "Last-Modified": "Wed, 21 Oct 2015 07:28:00 GMT",
+        })
+        changed, resource = gw.download("https://example.com/monfichier.zip", "dumdum")
+        assert "If-None-Match" not in fmock.last_request.headers
+        assert changed
+        assert resource.file.read_bytes() == self.test_bytes
+        assert resource.etag == '"def"'
+        assert resource.last_modified == "Wed, 21 Oct 2015 07:28:00 GMT"
+
+    @pytest.mark.parametrize("state,response,expected", [
+        (None, {"headers": {"Content-Length": "10"}}, ("changed", 10, "new file")),
+        ({"size": 10}, {"headers": {"Content-Length": "10"}}, ("unchanged", None, "same size")),
+        ({"size": 5}, {"headers": {"Content-Length": "10"}}, ("changed", 10, "size changed")),
+        ({"etag": "abc"}, {"status_code": 304}, ("unchanged", None, "not modified")),
+        ({"etag": "abc"}, {"headers": {"ETag": "def"}}, ("changed", None, "validators changed")),
+        ({"etag": "abc"}, {}, ("unknown", None, "no size nor validators")),
+        ({"size": 10}, {"status_code": 404}, ("unknown", None, "HTTP 404")),
+        ({"size": 10}, {"exc": requests.ConnectionError("down")}, ("unknown", None, "down")),
+    ])
+    def test_check(self, tmp_path, requests_mock, state, response, expected):
+        gw = HTTPDownloadGateway(self.has_changed, tmp_path, last_state=lambda name: state)
+        hmock = requests_mock.head("https://example.com/monfichier.zip", **response)
+        get = requests_mock.get("https://example.com/monfichier.zip")
+        planned = gw.check("https://example.com/monfichier.zip", "dumdum")
+        assert planned.name == "dumdum"
+        assert (planned.status, planned.size, planned.reason) == expected
+        assert not get.called
+        if state and "etag" in state:
+            assert hmock.last_request.headers["If-None-Match"] == "abc"
+
+    def test_download_stats(self, tmp_path, requests_mock, stats):
+        gw = HTTPDownloadGateway(self.has_changed, tmp_path)
+        requests_mock.get("https://example.com/monfichier.zip", body=io.BytesIO(self.test_bytes))
+        gw.download("https://example.com/monfichier.zip", "dumdum")
+        [record] = stats.records
+        assert (record["stage"], record["name"]) == ("http_download", "dumdum")
+        assert record["bytes"] == len(self.test_bytes)
+        assert record["error"] is None
+
+    def test_download_progress(self, tmp_path, requests_mock, mocker):
+        gw = HTTPDownloadGateway(self.has_changed, tmp_path, chunk_size=4, max_chunk_size=8)
+        requests_mock.get(
+            "https://example.com/monfichier.zip", body=io.BytesIO(self.test_bytes),
+            headers={"Content-Length": str(len(self.test_bytes))},
+        )
+        close = mocker.spy(Progress, "close")
+        _, resource = gw.download("https://example.com/monfichier.zip", "dumdum")
+        assert resource.file.read_bytes() == self.test_bytes
+        progress = close.call_args[0][0]
+        assert progress.done == progress.total == len(self.test_bytes)
+
+    def test_download_digests(self, tmp_path, requests_mock, body):
+        gw = HTTPDownloadGateway(self.has_changed, tmp_path, digests=["md5", "sha256"])
+        requests_mock.get("https://example.com/monfichier.zip", body=body)
+        _, resource = gw.download("https://example.com/monfichier.zip", "dumdum")
+        assert resource.sha1sum == self.sha1sum
+        assert resource.digests == {
+            "sha1": self.sha1sum,
+            "md5": hashlib.md5(self.test_bytes).hexdigest(),
+            "sha256": hashlib.sha256(self.test_bytes).hexdigest(),
+        }
+
+    def test_download_cache(self, tmp_path, requests_mock, mocker):
+        cache = DownloadCache(tmp_path / "cache", max_size=1000)
+        (tmp_path / "run1").mkdir()
+        (tmp_path / "run2").mkdir()
+
+        def content(request, context):
+            if request.headers.get("If-None-Match") == '"abc"':
+                context.status_code = 304
+                return b""
+            context.headers = {"ETag": '"abc"'}
+            return self.test_bytes
+
+        fmock = requests_mock.get("https://example.com/monfichier.zip", content=content)
+        gw = HTTPDownloadGateway(self.has_changed, tmp_path / "run1", cache=cache)
+        changed, resource = gw.download("https://example.com/monfichier.zip", "dumdum")
+        assert changed
+        # same file, another job without any state
+        gw = HTTPDownloadGateway(self.has_not_changed, tmp_path / "run2", cache=cache)
+        spy_changed = mocker.spy(gw, "has_changed")
+        changed, resource = gw.download("https://example.com/monfichier.zip", "dumdum")
+        assert fmock.last_request.headers["If-None-Match"] == '"abc"'
+        assert not changed
+        spy_changed.assert_called_once_with("dumdum", sha1sum=self.sha1sum)
+        assert resource.file == tmp_path / "run2" / "dumdum"
+        assert resource.file.read_bytes() == self.test_bytes
+        assert resource.sha1sum == self.sha1sum
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    @pytest.fixture
+    def partial_dir(self, tmp_path):
+        partial_dir = tmp_path / ".partial"
+        partial_dir.mkdir()
+        (partial_dir / "dumdum").write_bytes(self.test_bytes[:10])
+        (partial_dir / "dumdum.json").write_text(json.dumps({
+            "url": "https://example.com/monfichier.zip", "etag": '"abc"',
+        }))
+        return partial_dir
+
+    def test_download_resume(self, tmp_path, requests_mock, partial_dir):
+        gw = HTTPDownloadGateway(self.has_changed, tmp_path, partial_dir=partial_dir)
+        fmock = requests_mock.get(
+            "https://example.com/monfichier.zip", status_code=206,
+            body=io.BytesIO(self.test_bytes[10:]),
+            headers={"ETag": '"abc"', "Content-Range": f"bytes 10-{len(self.test_bytes) - 1}"
+                                                       f"/{len(self.test_bytes)}"},
+        )
+        changed, resource = gw.download("https://example.com/monfichier.zip", "dumdum")
+        assert fmock.last_request.headers["Range"] == "bytes=10-"
+        assert fmock.last_request.headers["If-Range"] == '"abc"'
+        assert changed
+        assert resource.file == tmp_path / "dumdum"
+        assert resource.file.read_bytes() == self.test_bytes
+        assert resource.sha1sum == self.sha1sum
+        assert list(partial_dir.iterdir()) == []
+
+    def test_download_resume_file_changed(self, tmp_path, requests_mock, partial_dir, body):
+        gw = HTTPDownloadGateway(self.has_changed, tmp_path, partial_dir=partial_dir)
+        requests_mock.get("https://example.com/monfichier.zip", body=body,
+                          headers={"ETag": '"def"'})
+        changed, resource = gw.download("https://example.com/monfichier.zip", "dumdum")
+        assert resource.file.read_bytes() == self.test_bytes
+        assert resource.sha1sum == self.sha1sum
+        assert resource.etag == '"def"'
+
+    def test_download_segmented(self, tmp_path, requests_mock):
+        gw = HTTPDownloadGateway(self.has_changed, tmp_path, segments=3, min_segment_size=8)
+
+        def content(request, context):
+            if "Range" not in request.headers:
+                context.headers = {"Accept-Ranges": "bytes", "ETag": '"abc"',
+                                   "Content-Length": str(len(self.test_bytes))}
+                return self.test_bytes
+            assert request.headers["If-Range"] == '"abc"'
+            start, end = map(int, request.headers["Range"][len("bytes="):].split("-"))
+            context.status_code = 206
+            return self.test_bytes[start:end + 1]
+
+        fmock = requests_mock.get("https://example.com/monfichier.zip", content=content)
+        changed, resource = gw.download("https://example.com/monfichier.zip", "dumdum")
+        assert changed
+        ranges = sorted(r.headers["Range"] for r in fmock.request_history if "Range" in r.headers)
+        assert ranges == ["bytes=0-8", "bytes=18-27", "bytes=9-17"]
+        assert resource.file.read_bytes() == self.test_bytes
+        assert resource.sha1sum == self.sha1sum
+
+    def test_download_interrupted_keeps_partial(self, tmp_path, requests_mock):
+        partial_dir = tmp_path / ".partial"
+        partial_dir.mkdir()
+        gw = HTTPDownloadGateway(self.has_changed, tmp_path, partial_dir=partial_dir,
+                                 chunk_size=10)
+
+        class BrokenBody(io.BytesIO):
+            def read(self, *args, **kwargs):
+                if self.tell():
+                    raise ConnectionError("connection lost")
+                return super().read(*args, **kwargs)
+
+        requests_mock.get("https://example.com/monfichier.zip",
+                          body=BrokenBody(self.test_bytes), headers={"ETag": '"abc"'})
+        with pytest.raises(Exception):
+            gw.download("https://example.com/monfichier.zip", "dumdum")
+        assert (partial_dir / "dumdum").read_bytes() == self.test_bytes[:10]
+        assert json.loads((partial_dir / "dumdum.json").read_text())["etag"] == '"abc"'
+
+
+class FakeWriter():
+    def __init__(self):
+        self.data = b""
+        self.status = "open"
+
+    def write(self, data):
+        self.data += data
+
+    def commit(self):
+        self.status = "committed"
+
+    def abort(self):
+        self.status = "aborted"
+
+
+class TestHTTPStream():
+    test_bytes = TestHTTP.test_bytes
+    sha1sum = TestHTTP.sha1sum
+
+    @pytest.mark.parametrize("changed", [True, False])
+    def test_stream(self, tmp_path, requests_mock, changed):
+        writers = [FakeWriter(), FakeWriter()]
+        gw = HTTPDownloadGateway(lambda *args, **kwargs: changed, tmp_path)
+        requests_mock.get("https://example.com/monfichier.zip", body=io.BytesIO(self.test_bytes),
+                          headers={"ETag": '"abc"'})
+        has_changed, resource = gw.stream("https://example.com/monfichier.zip", "dumdum",
+                                          lambda: writers)
+        assert has_changed == changed
+        assert resource.file is None
+        assert resource.sha1sum == self.sha1sum
+        assert resource.size == len(self.test_bytes)
+        assert resource.etag == '"abc"'
+        assert list(tmp_path.iterdir()) == []
+        for writer in writers:
+            assert writer.data == self.test_bytes
+            assert writer.status == "committed" if changed else "aborted"
+
+    def test_stream_not_modified(self, tmp_path, requests_mock):
+        open_writers = mock.Mock()
+        gw = HTTPDownloadGateway(lambda *args, **kwargs: True, tmp_path,
+                                 last_state=lambda _: {"etag": '"abc"'})
+        requests_mock.get("https://example.com/monfichier.zip", status_code=304)
+        has_changed, _ = gw.stream("https://example.com/monfichier.zip", "dumdum", open_writers)
+        assert not has_changed
+        assert not open_writers.called
+
+    def test_stream_error(self, tmp_path, requests_mock):
+        writer = FakeWriter()
+        writer.write = mock.Mock(side_effect=IOError("disk full"))
+        gw = HTTPDownloadGateway(lambda *args, **kwargs: True, tmp_path)
+        requests_mock.get("https://example.com/monfichier.zip", body=io.BytesIO(self.test_bytes))
+        with pytest.raises(IOError):
+            gw.stream("https://example.com/monfichier.zip", "dumdum", lambda: [writer])
+        assert writer.status == "aborted"
+
+
+class TestSFTPWriter():
+
+    def test_commit(self):
+        sftp = mock.Mock()
+        writer = SFTPWriter(sftp, "/data/file.zip")
+        sftp.open.assert_called_once_with("/data/.file.zip.sweeper-tmp", "wb")
+        writer.write(b"data")
+        sftp.open.return_value.write.assert_called_once_with(b"data")
+        writer.commit()
+        sftp.posix_rename.assert_called_once_with("/data/.file.zip.sweeper-tmp", "/data/file.zip")
+
+    def test_commit_no_posix_rename(self):
+        sftp = mock.Mock()
+        sftp.posix_rename.side_effect = IOError("unsupported")
+        writer = SFTPWriter(sftp, "/data/file.zip")
+        writer.commit()
+        sftp.remove.assert_called_once_with("/data/file.zip")
+        sftp.rename.assert_called_once_with("/data/.file.zip.sweeper-tmp", "/data/file.zip")
+
+    def test_abort(self):
+        sftp = mock.Mock()
+        writer = SFTPWriter(sftp, "/data/file.zip")
+        writer.abort()
+        assert sftp.open.return_value.close.called
+        sftp.remove.assert_called_once_with("/data/.file.zip.sweeper-tmp")
+
+
+class TestSSHCopy():
+
+    @pytest.fixture
+    def gw(self, mocker):
+        mocker.patch("sweeper.gateways.ssh.SFTPClient.from_transport")
+        return SSHGateway("example.com", client=mock.Mock())
+
+    def exec_status(self, gw, status):
+        stdout = mock.Mock()
+        stdout.channel.recv_exit_status.return_value = status
+        gw.ssh.exec_command.return_value = (mock.Mock(), stdout, mock.Mock())
+
+    def test_copy_exec(self, gw):
+        self.exec_status(gw, 0)
+        assert gw.copy("/data/a b.zip", "/data/c.zip") == "exec"
+        gw.ssh.exec_command.assert_called_once_with(
+            "cp --reflink=auto -- '/data/a b.zip' /data/c.zip"
+        )
+        assert not gw.sftp._request.called
+
+    def test_copy_copy_data(self, gw):
+        self.exec_status(gw, 1)
+        assert gw.copy("/data/a.zip", "/data/c.zip") == "copy-data"
+        assert gw.sftp._request.call_args.args[1] == "copy-data"
+
+    def test_copy_fallback_upload(self, gw, mocker):
+        upload = mocker.patch.object(gw, "upload")
+        gw.ssh.exec_command.side_effect = SSHException("no exec")
+        gw.sftp._request.side_effect = IOError("unsupported")
+        assert gw.copy("/data/a.zip", "/data/c.zip", local="/tmp/a.zip") == "upload"
+        upload.assert_called_once_with("/tmp/a.zip", "/data/c.zip")
+
+    def test_copy_fallback_stream(self, gw, mocker):
+        writer = mocker.patch.object(gw, "writer", return_value=FakeWriter())
+        self.exec_status(gw, 1)
+        mocker.patch.object(gw, "_copy_data", return_value=False)
+        fsrc = io.BytesIO(b"data")
+        fsrc.prefetch = mock.Mock()
+        gw.sftp.open.return_value = mock.MagicMock()
+        gw.sftp.open.return_value.__enter__.return_value = fsrc
+        assert gw.copy("/data/a.zip", "/data/c.zip") == "stream"
+        writer.assert_called_once_with("/data/c.zip")
+        assert writer.return_value.data == b"data"
+        assert writer.return_value.status == "committed"
+
+    def test_link(self, gw):
+        assert gw.link("/data/a.zip", "/data/c.zip") == "hardlink"
+        gw.sftp._request.side_effect = IOError("unsupported")
+        self.exec_status(gw, 0)
+        assert gw.link("/data/a.zip", "/data/c.zip") == "exec"
+        self.exec_status(gw, 1)
+        with pytest.raises(Exception):
+            gw.link("/data/a.zip", "/data/c.zip")
+
+
+class TestSSHPool():
+
+    @pytest.fixture
+    def connect(self, mocker):
+        mocker.patch("sweeper.gateways.ssh.SFTPClient.from_transport")
+        return mocker.patch("sweeper.gateways.ssh.SSHGateway.connect",
+                            side_effect=lambda *args: mock.Mock())
+
+    def test_reuse_connection(self, connect):
+        pool = SSHPool()
+        gw1 = pool.get("example.com")
+        gw2 = pool.get("example.com")
+        gw3 = pool.get("example.com", username="other")
+        assert connect.call_count == 2
+        assert gw1.ssh is gw2.ssh
+        assert gw1.ssh is not gw3.ssh
+        gw1.teardown()
+        assert gw1.sftp.close.called
+        assert not gw1.ssh.close.called
+        pool.close()
+        assert gw1.ssh.close.called
+        assert gw3.ssh.close.called
+
+    def test_reconnect_dead_connection(self, connect):
+        pool = SSHPool()
+        gw1 = pool.get("example.com")
+        gw1.ssh.get_transport.return_value.is_active.return_value = False
+        gw2 = pool.get("example.com")
+        assert connect.call_count == 2
+        assert gw1.ssh.close.called
+        assert gw1.ssh is not gw2.ssh
+
+    def test_reconnect_failed_health_check(self, connect):
+        pool = SSHPool()
+        gw1 = pool.get("example.com")
+        gw1.ssh.get_transport.return_value.send_ignore.side_effect = EOFError()
+        pool.get("example.com")
+        assert connect.call_count == 2
+
 
 class TestDataGouvFr():
 
+    def test_shared_session(self, requests_mock, mocker):
+        session = make_session()
+        spy_put = mocker.spy(session, "put")
+        gw = DataGouvFrGateway("TOKEN", session=session)
+        requests_mock.put(
+            "https://www.data.gouv.fr/api/1/datasets/dataset_id/resources/resource_id/",
+            json={},
+        )
+        gw.update_resource("dataset_id", "resource_id", title="title")
+        assert spy_put.called
+
+    def test_default_session(self, tmp_path, mocker):
+        for module in ("datagouvfr", "http"):
+            mocker.patch(f"sweeper.gateways.{module}.make_session", return_value=module)
+        assert DataGouvFrGateway("TOKEN").session == "datagouvfr"
+        assert HTTPDownloadGateway(lambda: True, tmp_path).session == "http"
+
     def test_upload_replace_resource_no_update(self, requests_mock, tmp_path):
         gw = DataGouvFrGateway("TOKEN")
         pmock = requests_mock.post(
@@ -98,11 +506,11 @@ class TestDataGouvFr():
         assert pmock.called
         r = pmock.last_request
         assert r.headers["x-api-key"] == "TOKEN"
-        # no way to access .files in requests-mock
-        assert "file content" in r.text
+        # no way to access .files in requests-mock, body is streamed
+        assert b"file content" in r.body.read()
         assert res == {"title": "old"}
 
-    def test_upload_replace_resource_w_update(self, requests_mock, tmp_path):
+    def test_upload_replace_resource_w_update(self, requests_mock, tmp_path, stats):
         gw = DataGouvFrGateway("TOKEN")
         requests_mock.post(
             "https://www.data.gouv.fr/api/1/datasets/dataset_id/resources/resource_id/upload/",
@@ -121,6 +529,10 @@ class TestDataGouvFr():
         assert r.headers["x-api-key"] == "TOKEN"
         assert r.json() == {"title": "new"}
         assert res == {"title": "new"}
+        assert [(r["stage"], r["name"], r["bytes"]) for r in stats.records] == [
+            ("datagouvfr_upload", "test.csv", len("file content")),
+            ("datagouvfr_update", "resource_id", 0),
+        ]
 
     def test_upload_replace_resource_w_update_chunk(self, requests_mock, tmp_path):
         gw = DataGouvFrGateway("TOKEN")
@@ -144,6 +556,58 @@ class TestDataGouvFr():
         # 2 calls for chunks + 1 for final transmission
         assert pmock.call_count == 3
 
+    def test_upload_chunked_parallel(self, requests_mock, tmp_path):
+        gw = DataGouvFrGateway("TOKEN", chunk_size=10, max_parallel_chunks=3, chunk_threshold=10)
+        pmock = requests_mock.post(
+            "https://www.data.gouv.fr/api/1/datasets/dataset_id/resources/resource_id/upload/",
+            json={"title": "old", "success": True},
+        )
+        tmp_file = tmp_path / "test.csv"
+        tmp_file.write_bytes(b"x" * 25)
+        res = gw.upload_replace_resource("dataset_id", "resource_id", tmp_file)
+        assert res == {"title": "old", "success": True}
+        # 3 calls for chunks + 1 for final transmission, sent last
+        assert pmock.call_count == 4
+        bodies = [r.body.read() for r in pmock.request_history]
+        assert b'name="partindex"' not in bodies[-1]
+        offsets = sorted(
+            re.search(rb'name="partbyteoffset".*?\r\n\r\n(\d+)', body, re.S).group(1)
+            for body in bodies[:3]
+        )
+        assert offsets == [b"0", b"10", b"20"]
+
+    def test_upload_chunked_retry(self, requests_mock, tmp_path, mocker):
+        sleep = mocker.patch("sweeper.gateways.datagouvfr.time.sleep")
+        gw = DataGouvFrGateway("TOKEN", chunk_size=10, retries=2, backoff=1)
+        pmock = requests_mock.post(
+            "https://www.data.gouv.fr/api/1/datasets/dataset_id/resources/resource_id/upload/",
+            [
+                {"status_code": 500},
+                {"json": {"success": False}},
+                {"json": {"success": True}},
+                {"json": {"title": "old"}},
+            ],
+        )
+        tmp_file = tmp_path / "test.csv"
+        tmp_file.write_bytes(b"x" * 10)
+        gw.post_file_chunked(pmock._url, tmp_file)
+        assert pmock.call_count == 4
+        assert [c.args for c in sleep.call_args_list] == [(1,), (2,)]
+
+    def test_upload_chunked_retry_fails(self, requests_mock, tmp_path, mocker):
+        mocker.patch("sweeper.gateways.datagouvfr.time.sleep")
+        gw = DataGouvFrGateway("TOKEN", chunk_size=10, retries=1)
+        pmock = requests_mock.post(
+            "https://www.data.gouv.fr/api/1/datasets/dataset_id/resources/resource_id/upload/",
+            status_code=500,
+        )
+        tmp_file = tmp_path / "test.csv"
+        tmp_file.write_bytes(b"x" * 10)
+        with pytest.raises(Exception):
+            gw.post_file_chunked(pmock._url, tmp_file)
+        # no final transmission
+        assert pmock.call_count == 2
+
     def test_remote_replace_resource(self, requests_mock):
         gw = DataGouvFrGateway("TOKEN")
         pmock = requests_mock.put(
@@ -206,3 +670,237 @@ class TestS3():
         gw.s3.Bucket("test-bucket").download_fileobj("mydir/test.csv", content)
         content.seek(0)
         assert content.read() == tmp_file.read_bytes()
+
+    def test_upload_skip_identical(self, tmp_path, s3, locale, mocker):
+        s3.create_bucket(Bucket="test-bucket")
+        gw = S3Gateway("test-bucket")
+        upload_file = mocker.spy(gw.s3.meta.client, "upload_file")
+        tmp_file = tmp_path / "test.csv"
+        tmp_file.write_text("file content")
+        sha1sum = hashlib.sha1(tmp_file.read_bytes()).hexdigest()
+
+        assert gw.upload(tmp_file, "mydir/test.csv", sha1sum=sha1sum)
+        head = s3.head_object(Bucket="test-bucket", Key="mydir/test.csv")
+        assert head["Metadata"] == {"sha1sum": sha1sum}
+        assert not gw.upload(tmp_file, "mydir/test.csv", sha1sum=sha1sum)
+        assert upload_file.call_count == 1
+
+        tmp_file.write_text("new file content")
+        assert gw.upload(tmp_file, "mydir/test.csv", sha1sum="othersha1")
+        assert upload_file.call_count == 2
+
+    @pytest.mark.parametrize("code", ["403", "404"])
+    def test_is_identical_missing(self, tmp_path, s3, locale, mocker, code):
+        s3.create_bucket(Bucket="test-bucket")
+        gw = S3Gateway("test-bucket")
+        mocker.patch.object(
+            gw.s3.meta.client, "head_object",
+            side_effect=ClientError({"Error": {"Code": code}}, "HeadObject"),
+        )
+        local = tmp_path / "test.csv"
+        local.write_text("a,b,c\n")
+        assert gw.upload(local, "mydir/test.csv", sha1sum="sha1") is True
+        assert s3.head_object(Bucket="test-bucket", Key="mydir/test.csv")["ContentLength"] == 6
+
+    def test_transfer_config(self, config, s3, locale):
+        config["test"]["config"].update(s3_multipart_threshold=1, s3_max_concurrency=2)
+        gw = TestPipeline(0, config).get_s3_gateway("test-bucket")
+        assert gw.transfer_config.multipart_threshold == 1
+        assert gw.transfer_config.multipart_chunksize == S3Gateway.MULTIPART_CHUNKSIZE
+        assert gw.transfer_config.max_request_concurrency == 2
+
+    def test_writer(self, s3, locale):
+        s3.create_bucket(Bucket="test-bucket")
+        gw = S3Gateway("test-bucket")
+        writer = gw.writer("mydir/test.csv")
+        writer.part_size = 5 * 1024 * 1024
+        writer.write(b"x" * writer.part_size)
+        writer.write(b"file content")
+        with pytest.raises(s3.exceptions.NoSuchKey):
+            s3.get_object(Bucket="test-bucket", Key="mydir/test.csv")
+        writer.commit()
+        assert len(writer.parts) == 2
+        content = s3.get_object(Bucket="test-bucket", Key="mydir/test.csv")["Body"].read()
+        assert content == b"x" * writer.part_size + b"file content"
+
+    def test_writer_abort(self, s3, locale):
+        s3.create_bucket(Bucket="test-bucket")
+        gw = S3Gateway("test-bucket")
+        writer = gw.writer("mydir/test.csv")
+        writer.write(b"file content")
+        writer.abort()
+        assert "Contents" not in s3.list_objects_v2(Bucket="test-bucket")
+        assert "Uploads" not in s3.list_multipart_uploads(Bucket="test-bucket")
+
+
+def serve(routes: list, test):
+    """Run `test(server, session)` against a local aiohttp server serving `routes`"""
+    async def main():
+        app = web.Application()
+        app.add_routes(routes)
+        async with TestServer(app) as server, make_async_session() as session:
+            return await test(server, session)
+    return asyncio.run(main())
+
+
+class TestAsyncHTTP():
+    test_bytes = TestHTTP.test_bytes
+    sha1sum = TestHTTP.sha1sum
+
+    def test_download_not_modified(self, tmp_path):
+        requests = []
+
+        async def handler(request):
+            requests.append(request.headers)
+            if request.headers.get("If-None-Match") == '"abc"':
+                return web.Response(status=304)
+            return web.Response(body=self.test_bytes, headers={"ETag": '"abc"'})
+
+        async def test(server, session):
+            states = {}
+            gw = AsyncHTTPDownloadGateway(
+                lambda *a, **kw: True, tmp_path, session, auth=("user", "pass"),
+                last_state=states.get,
+            )
+            changed, resource = await gw.download(str(server.make_url("/file")), "dumdum")
+            assert changed
+            assert resource.file.read_bytes() == self.test_bytes
+            assert resource.sha1sum == self.sha1sum
+            assert resource.etag == '"abc"'
+            states["dumdum"] = {"sha1sum": self.sha1sum, "size": 1, "etag": '"abc"'}
+            changed, resource = await gw.download(str(server.make_url("/file")), "dumdum")
+            assert not changed
+            assert resource.sha1sum == self.sha1sum
+
+        serve([web.get("/file", handler)], test)
+        assert requests[0]["Authorization"].startswith("Basic ")
+        assert requests[1]["If-None-Match"] == '"abc"'
+
+    def test_blocking_methods_not_inherited(self, tmp_path):
+        gw = AsyncHTTPDownloadGateway(lambda *a, **kw: True, tmp_path, session=None)
+        assert not isinstance(gw, HTTPDownloadGateway)
+        assert not hasattr(gw, "check")
+        assert not hasattr(gw, "stream")
+
+    def test_download_does_not_block_loop(self, tmp_path, mocker):
+        update = mocker.patch("sweeper.utils.hashing.MultiHasher.update", autospec=True)
+        update.side_effect = lambda *args: time.sleep(0.05)
+        ticks = []
+
+        async def handler(request):
+            return web.Response(body=self.test_bytes)
+
+        async def tick():
+            while True:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        async def test(server, session):
+            gw = AsyncHTTPDownloadGateway(lambda *a, **kw: True, tmp_path, session, chunk_size=4)
+            ticker = asyncio.ensure_future(tick())
+            try:
+                await gw.download(str(server.make_url("/file")), "dumdum")
+            finally:
+                ticker.cancel()
+
+        serve([web.get("/file", handler)], test)
+        assert update.call_count > 1
+        # the event loop kept running while chunks were hashed
+        assert max(b - a for a, b in zip(ticks, ticks[1:])) < 0.04
+        assert (tmp_path / "dumdum").read_bytes() == self.test_bytes
+
+    def test_download_resume(self, tmp_path):
+        partial_dir = tmp_path / ".partial"
+        partial_dir.mkdir()
+        (partial_dir / "dumdum").write_bytes(self.test_bytes[:10])
+
+        async def handler(request):
+            assert request.headers["Range"] == "bytes=10-"
+            assert request.headers["If-Range"] == '"abc"'
+            size = len(self.test_bytes)
+            return web.Response(status=206, body=self.test_bytes[10:], headers={
+                "ETag": '"abc"', "Content-Range": f"bytes 10-{size - 1}/{size}",
+            })
+
+        async def test(server, session):
+            url = str(server.make_url("/file"))
+            (partial_dir / "dumdum.json").write_text(json.dumps({"url": url, "etag": '"abc"'}))
+            gw = AsyncHTTPDownloadGateway(
+                lambda *a, **kw: True, tmp_path, session, partial_dir=partial_dir,
+            )
+            return await gw.download(url, "dumdum")
+
+        changed, resource = serve([web.get("/file", handler)], test)
+        assert changed
+        assert resource.file.read_bytes() == self.test_bytes
+        assert resource.sha1sum == self.sha1sum
+        assert list(partial_dir.iterdir()) == []
+
+
+class TestAsyncDataGouvFr():
+
+    def test_upload_chunked_parallel(self, tmp_path):
+        parts = []
+
+        async def upload(request):
+            assert request.headers["X-Api-Key"] == "TOKEN"
+            assert "Transfer-Encoding" not in request.headers
+            form = await request.post()
+            if "partindex" in form:
+                parts.append((int(form["partindex"]), form["file"].file.read()))
+            return web.json_response({"success": True, "title": "old"})
+
+        async def update(request):
+            return web.json_response(await request.json())
+
+        async def test(server, session):
+            gw = AsyncDataGouvFrGateway(
+                "TOKEN", session, chunk_size=4, chunk_threshold=4, max_parallel_chunks=3,
+            )
+            gw.base_url = str(server.make_url("/api/1"))
+            tmp_file = tmp_path / "test.csv"
+            tmp_file.write_bytes(b"0123456789")
+            return await gw.upload_replace_resource("ds", "rid", tmp_file, title="new")
+
+        res = serve([
+            web.post("/api/1/datasets/ds/resources/rid/upload/", upload),
+            web.put("/api/1/datasets/ds/resources/rid/", update),
+        ], test)
+        assert sorted(parts) == [(0, b"0123"), (1, b"4567"), (2, b"89")]
+        assert res["title"] == "new"
+
+    def test_upload_retry(self, tmp_path):
+        attempts = []
+
+        async def upload(request):
+            attempts.append(await request.read())
+            if len(attempts) == 1:
+                return web.Response(status=500)
+            return web.json_response({"title": "old"})
+
+        async def test(server, session):
+            gw = AsyncDataGouvFrGateway("TOKEN", session, backoff=0)
+            gw.base_url = str(server.make_url("/api/1"))
+            tmp_file = tmp_path / "test.csv"
+            tmp_file.write_text("file content")
+            return await gw.upload_replace_resource("ds", "rid", tmp_file)
+
+        res = serve([web.post("/api/1/datasets/ds/resources/rid/upload/", upload)], test)
+        assert res == {"title": "old"}
+        assert len(attempts) == 2
+        assert all(b"file content" in body for body in attempts)
+
+
+def test_async_ssh_gateway():
+    gw = mock.Mock()
+    gw.copy.return_value = "exec"
+    agw = AsyncSSHGateway(gw)
+
+    async def test():
+        return await asyncio.gather(
+            agw.upload("local", "remote"), agw.copy("remote", "remote_date", local="local"),
+        )
+
+    assert asyncio.run(test())[1] == "exec"
+    gw.upload.assert_called_once_with("local", "remote")
+    gw.copy.assert_called_once_with("remote", "remote_date", local="local")
@@ -1,10 +1,17 @@
+import asyncio
 import io
+import json
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
 
 import pytest
 
+from sweeper import context
 from sweeper.pipelines.sirene import SirenePipeline
 from sweeper.models import Resource
-from sweeper.tests.pipelines.pipeline_test import TestPipeline
+from sweeper.tests.pipelines.pipeline_test import TestAsyncPipeline, TestPipeline
 
 
 class TestGenericBackend():
@@ -18,6 +25,8 @@ class TestGenericBackend():
         assert not backend.file_has_changed("dumdum", sha1sum="sha1")
         assert backend.file_has_changed("dumdum", size=2)
         assert not backend.file_has_changed("dumdum", size=1)
+        assert backend.file_last_state("dumdum")["sha1sum"] == "sha1"
+        assert backend.file_last_state("nope") is None
         # result in DB
         assert db["test"].count(name="dumdum") == 1
         _run = db["test"].find_one(name="dumdum")
@@ -29,34 +38,258 @@ class TestGenericBackend():
         assert backend.config["foo"] == "bar"
         assert backend.secrets["test_secret"] == "sqlite:///:memory:"
 
+    def test_register_digests(self, config, db):
+        backend = TestPipeline(0, config)
+        backend._setup()
+        backend.register_file(Resource(
+            name="a", sha1sum="sha1", size=1, digests={"sha1": "sha1", "md5": "md5"},
+        ))
+        row = db["test"].find_one(name="a")
+        assert (row["sha1sum"], row["md5"]) == ("sha1", "md5")
+        assert "sha1" not in row
+        assert "digests" not in row
+        assert backend.file_last_state("a")["md5"] == "md5"
+
+    @pytest.mark.parametrize("max_workers", [1, 3])
+    def test_process_concurrently(self, config, db, max_workers, recwarn):
+        backend = TestPipeline(0, config)
+        backend.config["max_workers"] = max_workers
+
+        def process(name):
+            if name == "error":
+                raise Exception("ERROR")
+            if name == "skip":
+                return None
+            return Resource(name=name, sha1sum="sha1", size=1)
+
+        backend.process_concurrently(process, ["ok1", "skip", "error", "ok2"])
+        assert db["test"].count() == 3
+        assert db["test"].count(error=None) == 2
+        assert db["test"].find_one(error="ERROR")["name"] == "error"
+        assert [e.name for e in backend.errors] == ["error"]
+        # columns are created before the insert transaction
+        assert not [w for w in recwarn if "database schema" in str(w.message)]
+
+    def test_process_concurrently_items_error(self, config, db):
+        backend = TestPipeline(0, config)
+        backend.config["max_workers"] = 3
+
+        def items():
+            yield "ok1"
+            yield "ok2"
+            raise Exception("Connection lost")
+
+        with pytest.raises(Exception, match="Connection lost"):
+            backend.process_concurrently(
+                lambda name: Resource(name=name, sha1sum="sha1", size=1), items(),
+            )
+        assert db["test"].count(error=None) == 2
+
+    def test_async_process_concurrently(self, config, db):
+        config["test_async"] = {"config": {"max_in_flight": 2}}
+        backend = TestAsyncPipeline(0, config)
+        in_flight = max_in_flight = 0
+
+        async def process(name):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(in_flight, max_in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            if name == "error":
+                raise Exception("ERROR")
+            if name == "skip":
+                return None
+            return Resource(name=name, sha1sum="sha1", size=1)
+
+        asyncio.run(
+            backend.process_concurrently(process, ["ok1", "skip", "error", "ok2", "ok3"])
+        )
+        assert max_in_flight == 2
+        assert db["test_async"].count(error=None) == 3
+        assert [e.name for e in backend.errors] == ["error"]
+
+    def test_setup_index(self, config, db):
+        backend = TestPipeline(0, config)
+        backend._setup()
+        assert db["test"].has_index(["name", "error", "created_at"])
+        # idempotent
+        TestPipeline(0, config)._setup()
+
+    def test_setup_loads_state(self, config, db, mocker):
+        backend = TestPipeline(0, config)
+        backend.register_file(Resource(name="a", sha1sum="sha1-old", size=1))
+        backend.register_file(Resource(name="a", sha1sum="sha1-new", size=1))
+        backend.register_error(Resource(name="a", error="ERROR"))
+        backend.register_file(Resource(name="b", sha1sum="sha1-b", size=1))
+        backend = TestPipeline(1, config)
+        backend._setup()
+        spy_find = mocker.spy(backend.table, "find_one")
+        assert backend.file_last_state("a")["sha1sum"] == "sha1-new"
+        assert backend.file_last_state("b")["sha1sum"] == "sha1-b"
+        assert backend.file_last_state("c") is None
+        assert not backend.file_has_changed("a", sha1sum="sha1-new")
+        backend.register_file(Resource(name="c", sha1sum="sha1-c", size=1))
+        backend.register_error(Resource(name="c", error="ERROR"))
+        assert backend.file_last_state("c")["sha1sum"] == "sha1-c"
+        assert not spy_find.called
+
+    def test_batched_writes(self, config, db):
+        backend = TestPipeline(0, config)
+        backend._setup()
+        backend.config["db_batch_size"] = 3
+        backend.register_file(Resource(name="a", sha1sum="sha1-a", size=1))
+        backend.register_error(Resource(name="b", error="ERROR"))
+        assert db["test"].count() == 0
+        assert not backend.file_has_changed("a", sha1sum="sha1-a")
+        backend.register_file(Resource(name="c", sha1sum="sha1-c", size=1))
+        assert db["test"].count() == 3
+        backend.register_file(Resource(name="d", sha1sum="sha1-d", size=1))
+        assert db["test"].count() == 3
+        backend._teardown()
+        assert db["test"].count() == 4
+
+    def test_batched_writes_interval(self, config, db):
+        backend = TestPipeline(0, config)
+        backend.config["db_batch_size"] = 100
+        backend.config["db_flush_interval"] = 0
+        backend.register_file(Resource(name="a", sha1sum="sha1-a", size=1))
+        assert db["test"].count() == 1
+
+    def test_batched_writes_flusher(self, config, tmp_path, monkeypatch):
+        # the flusher thread has its own connection, that would not see an in-memory DB
+        monkeypatch.setenv("DATABASE_URL", f"sqlite:///{tmp_path / 'jobs.db'}")
+        monkeypatch.delitem(context, "db")
+        backend = TestPipeline(0, config)
+        backend.config["db_batch_size"] = 100
+        backend.config["db_flush_interval"] = 0.5
+        backend.register_file(Resource(name="a", sha1sum="sha1-a", size=1))
+        assert backend._pending
+        # written while no other file is registered
+        deadline = time.monotonic() + 5
+        while not backend.db["test"].count(name="a") and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert backend.db["test"].count(name="a") == 1
+        assert not backend._pending
+        backend._teardown()
+        assert backend._flusher is None
+
+    def test_flush_failure_keeps_rows(self, config, db, mocker):
+        backend = TestPipeline(0, config)
+        backend.config["db_batch_size"] = 100
+        backend.register_file(Resource(name="a", sha1sum="sha1-a", size=1))
+        mocker.patch("dataset.Table.insert_many", side_effect=Exception("DB down"))
+        with pytest.raises(Exception):
+            backend.flush()
+        mocker.stopall()
+        backend.flush()
+        assert db["test"].count(name="a") == 1
+
+    def test_teardown_keeps_partial_downloads(self, config):
+        backend = TestPipeline(0, config)
+        (backend.tmp_dir / "file.zip").write_text("content")
+        (backend.partial_dir / "partial.zip").write_text("content")
+        backend._teardown()
+        assert list(backend.tmp_dir.iterdir()) == [backend.partial_dir]
+        assert (backend.partial_dir / "partial.zip").exists()
+
+    def test_session(self, config, mocker):
+        config["main"]["http_pool_size"] = 3
+        backend = TestPipeline(0, config)
+        session = backend.session
+        assert session is backend.session
+        assert session.get_adapter("https://example.com")._pool_maxsize == 3
+        assert session.headers["Connection"] == "keep-alive"
+        spy_close = mocker.spy(session, "close")
+        backend._teardown()
+        assert spy_close.called
+
+    def test_session_pool_size(self, config):
+        config["test"]["config"].update(max_workers=3, http_segments=4)
+        backend = TestPipeline(0, config)
+        assert backend.session.get_adapter("https://example.com")._pool_maxsize == 12
+
+    def test_session_no_keep_alive(self, config):
+        config["main"]["http_keep_alive"] = False
+        backend = TestPipeline(0, config)
+        assert backend.session.headers["Connection"] == "close"
+
+    def test_teardown_closes_ssh_pool(self, config, mocker):
+        backend = TestPipeline(0, config)
+        spy_close = mocker.spy(backend.ssh_pool, "close")
+        backend._teardown()
+        assert spy_close.called
+
+    def test_ssh_pool_shared_by_threads(self, config, mocker):
+        from sweeper.gateways.ssh import SSHPool
+        init = SSHPool.__init__
+        mocker.patch.object(
+            SSHPool, "__init__", autospec=True,
+            side_effect=lambda pool: time.sleep(0.05) or init(pool),
+        )
+        backend = TestPipeline(0, config)
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            pools = list(executor.map(lambda _: backend.ssh_pool, range(3)))
+        assert len(set(map(id, pools))) == 1
+        assert SSHPool.__init__.call_count == 1
+
+    def test_keep_connections(self, config, mocker):
+        connections = {}
+        backend = TestPipeline(0, config)
+        backend._keep_connections(connections)
+        session, ssh_pool = backend.session, backend.ssh_pool
+        spy_close = mocker.spy(ssh_pool, "close")
+        backend._teardown()
+        assert not spy_close.called
+        assert connections == {"session": session, "ssh_pool": ssh_pool}
+        backend = TestPipeline(1, config)
+        backend._keep_connections(connections)
+        assert backend.session is session
+        assert backend.ssh_pool is ssh_pool
+
+    def test_run_infos_cache(self, config, tmp_path):
+        assert TestPipeline(0, config).run_infos() == {}
+        config["main"]["cache_dir"] = str(tmp_path)
+        backend = TestPipeline(0, config)
+        assert backend.run_infos() == {"cache_hits": 0, "cache_misses": 0}
+
+    def test_get_option(self, config):
+        config["main"]["max_workers"] = 4
+        backend = TestPipeline(0, config)
+        assert backend.get_option("max_workers") == 4
+        backend.config["max_workers"] = 2
+        assert backend.get_option("max_workers") == 2
+        assert backend.get_option("nope", "default") == "default"
+
+
+LISTING = """<?xml version="1.0" encoding="UTF-8"?>
+<ns2:ServiceDepotRetrait xmlns:ns2="http://xml.insee.fr/schema/outils">
+    <Fichiers>
+        <id>monfichier.zip</id>
+        <URI>https://example.com/monfichier.zip</URI>
+    </Fichiers>
+    <Fichiers>
+        <id>ignore-moi_pas-dans-le-mapping.zip</id>
+        <URI>https://example.com/ignoremoi.zip</URI>
+    </Fichiers>
+</ns2:ServiceDepotRetrait>"""
+
 
 @pytest.fixture
 def mock_ssh(mocker):
+    mocker.patch("sweeper.gateways.ssh.SSHGateway.connect")
     m1 = mocker.patch("sweeper.gateways.ssh.SSHGateway.__init__", return_value=None)
     m2 = mocker.patch("sweeper.gateways.ssh.SSHGateway.upload", return_value=None)
     m3 = mocker.patch("sweeper.gateways.ssh.SSHGateway.teardown", return_value=None)
-    return [m1, m2, m3]
+    m4 = mocker.patch("sweeper.gateways.ssh.SSHGateway.copy", return_value="exec")
+    return [m1, m2, m3, m4]
 
 
 class TestSireneBackend():
 
     def test_backend(self, config, requests_mock, mock_ssh, db):
         backend = SirenePipeline(0, config)
-        requests_mock.get(
-            "https://example.com/list.xml",
-            text="""<?xml version="1.0" encoding="UTF-8"?>
-                    <ns2:ServiceDepotRetrait xmlns:ns2="http://xml.insee.fr/schema/outils">
-                        <Fichiers>
-                            <id>monfichier.zip</id>
-                            <URI>https://example.com/monfichier.zip</URI>
-                        </Fichiers>
-                        <Fichiers>
-                            <id>ignore-moi_pas-dans-le-mapping.zip</id>
-                            <URI>https://example.com/ignoremoi.zip</URI>
-                        </Fichiers>
-                    </ns2:ServiceDepotRetrait>
-                """
-        )
+        requests_mock.get("https://example.com/list.xml", text=LISTING)
         body = io.BytesIO(b"some initial binary data: \x00\x01")
         fmock = requests_mock.get("https://example.com/monfichier.zip", body=body)
         pmock = requests_mock.put(
@@ -66,9 +299,143 @@ class TestSireneBackend():
         backend.run()
         for m in mock_ssh:
             assert m.called
+        mock_ssh[1].assert_called_once()
+        assert mock_ssh[3].call_args.kwargs["local"] == backend.tmp_dir / "monfichier.zip"
         assert fmock.called
         assert pmock.called
 
         assert db["sirene"].count() == 1
         run = db["sirene"].find_one()
         assert run["name"] == "monfichier.zip"
+
+    def test_backend_not_modified(self, config, requests_mock, mock_ssh, db):
+        backend = SirenePipeline(0, config)
+        backend.register_file(Resource(name="monfichier.zip", sha1sum="sha1", size=1, etag="abc"))
+        requests_mock.get("https://example.com/list.xml", text=LISTING)
+        fmock = requests_mock.get("https://example.com/monfichier.zip", status_code=304)
+        backend.run()
+        assert fmock.last_request.headers["If-None-Match"] == "abc"
+        for m in mock_ssh:
+            assert not m.called
+        assert db["sirene"].count() == 1
+
+    @pytest.fixture
+    def conditional(self, config):
+        config["sirene"]["config"]["conditional_listing"] = True
+        return config
+
+    def run_listing(self, config, requests_mock, listing_headers=None, file_status=200):
+        """Run with a listing served with `listing_headers`, returns the listing mock"""
+        backend = SirenePipeline(0, config)
+        lmock = requests_mock.get(
+            "https://example.com/list.xml", text=LISTING, headers=listing_headers or {},
+        )
+        requests_mock.get(
+            "https://example.com/monfichier.zip", content=b"data", status_code=file_status,
+        )
+        requests_mock.put(
+            "https://www.data.gouv.fr/api/1/datasets/dataset_id/resources/resource_id/",
+            json={},
+        )
+        backend.run()
+        return backend, lmock
+
+    def test_listing_not_modified(self, conditional, requests_mock, mock_ssh, db):
+        backend, lmock = self.run_listing(conditional, requests_mock, {"ETag": '"list"'})
+        assert "If-None-Match" not in lmock.last_request.headers
+        state = db["sirene_listing"].find_one(source_url="https://example.com/list.xml")
+        assert state["etag"] == '"list"'
+        assert len(json.loads(state["files"])) == 2
+        assert db["sirene"].count(name="https://example.com/list.xml") == 0
+        # listing not modified: stored files are still checked
+        lmock = requests_mock.get("https://example.com/list.xml", status_code=304)
+        fmock = requests_mock.get("https://example.com/monfichier.zip", content=b"new data")
+        backend = SirenePipeline(1, conditional)
+        backend._setup()
+        backend.run()
+        assert lmock.last_request.headers["If-None-Match"] == '"list"'
+        assert fmock.called
+        assert backend.file_last_state("monfichier.zip")["size"] == 8
+        assert db["sirene_listing"].count() == 1
+        requests_mock.head("https://example.com/monfichier.zip", status_code=304)
+        backend = SirenePipeline(None, conditional, planning=True)
+        backend._setup()
+        planned = backend.plan()
+        assert [f.name for f in planned] == ["monfichier.zip"]
+
+    def test_listing_mapping_changed(self, conditional, requests_mock, mock_ssh, db):
+        self.run_listing(conditional, requests_mock, {"ETag": '"list"'})
+        conditional["sirene"]["config"]["mapping"]["ignore-moi_pas-dans-le-mapping.zip"] = "rid"
+        backend, lmock = self.run_listing(conditional, requests_mock, {"ETag": '"list"'})
+        assert "If-None-Match" not in lmock.last_request.headers
+        assert db["sirene_listing"].count() == 2
+
+    def test_listing_not_stored_when_broken(self, conditional, requests_mock, mock_ssh, db):
+        backend = SirenePipeline(0, conditional)
+        requests_mock.get(
+            "https://example.com/list.xml", text=LISTING[:300], headers={"ETag": '"list"'},
+        )
+        requests_mock.get("https://example.com/monfichier.zip", status_code=500)
+        with pytest.raises(ElementTree.ParseError):
+            backend.run()
+        assert len(backend.errors) == 1
+        assert "sirene_listing" not in db.tables
+
+    def test_listing_not_conditional(self, config, requests_mock, mock_ssh, db):
+        self.run_listing(config, requests_mock, {"ETag": '"list"'})
+        _, lmock = self.run_listing(config, requests_mock, {"ETag": '"list"'})
+        assert "If-None-Match" not in lmock.last_request.headers
+        assert "sirene_listing" not in db.tables
+
+    def test_parse_listing_streams(self, config):
+        backend = SirenePipeline(0, config)
+        chunks = [LISTING[:300], LISTING[300:]]
+        consumed = []
+
+        class Response():
+            def iter_content(self, chunk_size):
+                for chunk in chunks:
+                    consumed.append(chunk)
+                    yield chunk.encode()
+
+        files = backend._parse_listing(Response())
+        first = next(files)
+        assert first == {"id": "monfichier.zip", "URI": "https://example.com/monfichier.zip"}
+        # yielded before the end of the listing has been received
+        assert len(consumed) == 1
+        assert [f["id"] for f in files] == ["ignore-moi_pas-dans-le-mapping.zip"]
+
+    def test_plan(self, config, requests_mock, mock_ssh, db):
+        backend = SirenePipeline(0, config)
+        backend.register_file(Resource(name="monfichier.zip", sha1sum="sha1", size=1, etag="abc"))
+        backend = SirenePipeline(1, config)
+        backend._setup()
+        requests_mock.get("https://example.com/list.xml", text=LISTING)
+        hmock = requests_mock.head("https://example.com/monfichier.zip", status_code=304)
+        fmock = requests_mock.get("https://example.com/monfichier.zip")
+        [planned] = backend.plan()
+        assert (planned.name, planned.status) == ("monfichier.zip", "unchanged")
+        assert hmock.last_request.headers["If-None-Match"] == "abc"
+        assert not fmock.called
+        for m in mock_ssh:
+            assert not m.called
+        assert db["sirene"].count() == 1
+
+    def test_backend_streaming(self, config, requests_mock, mock_ssh, mocker, db):
+        config["sirene"]["config"]["streaming"] = True
+        backend = SirenePipeline(0, config)
+        writer = mocker.patch("sweeper.gateways.ssh.SSHGateway.writer")
+        requests_mock.get("https://example.com/list.xml", text=LISTING)
+        requests_mock.get("https://example.com/monfichier.zip", content=b"data")
+        pmock = requests_mock.put(
+            "https://www.data.gouv.fr/api/1/datasets/dataset_id/resources/resource_id/",
+            json={},
+        )
+        backend.run()
+        # streamed to remote then copied, no local upload
+        writer.assert_called_once_with("/root/data-gw/monfichier.zip")
+        assert writer.return_value.commit.called
+        assert mock_ssh[3].call_args.args[0] == "/root/data-gw/monfichier.zip"
+        assert not mock_ssh[1].called
+        assert pmock.called
+        assert db["sirene"].find_one()["size"] == 4
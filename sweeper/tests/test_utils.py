@@ -0,0 +1,359 @@
+import hashlib
+import io
+import json
+import os
+import pstats
+import stat
+import time
+import zlib
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from requests.models import RequestEncodingMixin
+
+from sweeper import context
+from sweeper.utils.cache import DownloadCache
+from sweeper.utils.chunks import AdaptiveChunkSize, iter_chunks
+from sweeper.utils.hashing import MultiHasher
+from sweeper.utils.multipart import FilePart, MultipartEncoder
+from sweeper.utils.profiling import CProfiler, SamplingProfiler, make_profiler
+from sweeper.utils.progress import Progress
+from sweeper.utils.schedule import CronSchedule, IntervalSchedule, Scheduler, parse
+from sweeper.utils.stats import Stats, get_stats, timer
+
+
+class TestMultipart():
+
+    def test_encoder_matches_requests(self, tmp_path):
+        tmp_file = tmp_path / "test.csv"
+        tmp_file.write_bytes(b"0123456789" * 1000)
+        files = {"size": ("", 10000), "uuid": ("", "abc"), "file": ("blob", b"23456")}
+        expected, content_type = RequestEncodingMixin._encode_files(files, {})
+        boundary = content_type.split("boundary=")[1]
+        encoder = MultipartEncoder(
+            dict(files, file=("blob", FilePart(tmp_file, offset=2, length=5))),
+            boundary=boundary,
+        )
+        assert encoder.content_type == content_type
+        assert len(encoder) == len(expected)
+        body = b""
+        while chunk := encoder.read(7):
+            body += chunk
+        assert body == expected
+
+    def test_encoder_whole_file(self, tmp_path):
+        tmp_file = tmp_path / "test.csv"
+        tmp_file.write_bytes(b"file content")
+        encoder = MultipartEncoder({"file": ("test.csv", FilePart(tmp_file))})
+        body = encoder.read()
+        assert len(body) == len(encoder)
+        assert b'filename="test.csv"\r\n\r\nfile content\r\n' in body
+        assert encoder.read() == b""
+
+
+class TestDownloadCache():
+
+    def put(self, cache, tmp_path, url, content):
+        path = tmp_path / "download"
+        path.write_bytes(content)
+        sha1sum = hashlib.sha1(content).hexdigest()
+        cache.put(url, path, sha1sum, etag=f'"{sha1sum}"')
+        return sha1sum
+
+    def test_put_get_fetch(self, tmp_path):
+        cache = DownloadCache(tmp_path / "cache", max_size=100)
+        assert cache.get("https://example.com/a") is None
+        sha1sum = self.put(cache, tmp_path, "https://example.com/a", b"content")
+        entry = cache.get("https://example.com/a")
+        assert entry["sha1sum"] == sha1sum
+        assert entry["size"] == 7
+        assert entry["etag"] == f'"{sha1sum}"'
+        assert cache.fetch(entry, tmp_path / "copy")
+        assert (tmp_path / "copy").read_bytes() == b"content"
+        assert (cache.hits, cache.misses) == (1, 1)
+        # index is persisted
+        assert DownloadCache(tmp_path / "cache", max_size=100).get("https://example.com/a")
+
+    def test_stale_is_a_miss(self, tmp_path):
+        cache = DownloadCache(tmp_path / "cache", max_size=100)
+        self.put(cache, tmp_path, "https://example.com/a", b"content")
+        assert cache.get("https://example.com/a")
+        self.put(cache, tmp_path, "https://example.com/a", b"new content")
+        assert (cache.hits, cache.misses) == (0, 1)
+
+    def test_hit_persists_use_time(self, tmp_path):
+        cache = DownloadCache(tmp_path / "cache", max_size=100)
+        entry_url = "https://example.com/a"
+        self.put(cache, tmp_path, entry_url, b"content")
+        put_at = cache.index[entry_url]["used_at"]
+        time.sleep(0.01)
+        entry = cache.get(entry_url)
+        assert cache.fetch(entry, tmp_path / "copy")
+        used_at = json.loads((tmp_path / "cache" / "index.json").read_text())[entry_url]["used_at"]
+        assert used_at == cache.index[entry_url]["used_at"] > put_at
+
+    def test_no_validators(self, tmp_path):
+        cache = DownloadCache(tmp_path / "cache", max_size=100)
+        path = tmp_path / "download"
+        path.write_bytes(b"content")
+        cache.put("https://example.com/a", path, "sha1")
+        assert cache.get("https://example.com/a") is None
+
+    def test_lru_eviction(self, tmp_path):
+        cache = DownloadCache(tmp_path / "cache", max_size=10)
+        self.put(cache, tmp_path, "https://example.com/a", b"aaaa")
+        time.sleep(0.01)
+        self.put(cache, tmp_path, "https://example.com/b", b"bbbb")
+        time.sleep(0.01)
+        # a is now more recently used than b
+        assert cache.get("https://example.com/a")
+        self.put(cache, tmp_path, "https://example.com/c", b"cccc")
+        assert cache.get("https://example.com/a")
+        assert cache.get("https://example.com/b") is None
+        assert cache.get("https://example.com/c")
+        assert len(list((tmp_path / "cache" / "objects").glob("*/*"))) == 2
+
+
+class TestSchedule():
+
+    @pytest.mark.parametrize("expression,after,expected", [
+        ("*/10 * * * *", datetime(2021, 3, 1, 12, 5, 30), datetime(2021, 3, 1, 12, 10)),
+        ("*/10 * * * *", datetime(2021, 3, 1, 12, 10), datetime(2021, 3, 1, 12, 20)),
+        ("30 2 * * *", datetime(2021, 3, 1, 12, 5), datetime(2021, 3, 2, 2, 30)),
+        ("0 9-17/4 * * *", datetime(2021, 3, 1, 13, 0), datetime(2021, 3, 1, 17, 0)),
+        ("0 0 1,15 * *", datetime(2021, 12, 20), datetime(2022, 1, 1)),
+        # 2021-03-01 is a monday
+        ("0 8 * * 0", datetime(2021, 3, 1), datetime(2021, 3, 7, 8)),
+        ("0 8 * * 7", datetime(2021, 3, 1), datetime(2021, 3, 7, 8)),
+        # day of month or day of week
+        ("0 8 5 * 3", datetime(2021, 3, 1), datetime(2021, 3, 3, 8)),
+        ("0 0 29 2 *", datetime(2021, 3, 1), datetime(2024, 2, 29)),
+    ])
+    def test_cron(self, expression, after, expected):
+        assert CronSchedule(expression).next_run(after) == expected
+
+    @pytest.mark.parametrize("expression", ["* * * *", "60 * * * *", "0 0 30 2 *", "a * * * *"])
+    def test_cron_invalid(self, expression):
+        with pytest.raises(ValueError):
+            CronSchedule(expression).next_run(datetime(2021, 3, 1))
+
+    def test_parse(self):
+        assert isinstance(parse("* * * * *"), CronSchedule)
+        schedule = parse(60)
+        assert isinstance(schedule, IntervalSchedule)
+        now = datetime(2021, 3, 1)
+        assert schedule.first_run(now) == now
+        assert schedule.next_run(now) == now + timedelta(minutes=1)
+
+    def test_scheduler(self, tmp_path):
+        config = tmp_path / "jobs.toml"
+        config.write_text(
+            '[main]\n[a]\nbackend = "a:A"\nschedule = 60\n'
+            '[b]\nbackend = "b:B"\nschedule = "0 * * * *"\n[c]\nbackend = "c:C"\n'
+        )
+        now = datetime(2021, 3, 1, 12, 30)
+        scheduler = Scheduler(str(config))
+        assert scheduler.reload(now)
+        assert not scheduler.reload(now)
+        assert scheduler.next_runs == {"a": now, "b": datetime(2021, 3, 1, 13)}
+        assert scheduler.due(now) == "a"
+        scheduler.done("a", now)
+        assert scheduler.due(now) is None
+        assert scheduler.wait_time(now) == scheduler.POLL_INTERVAL
+        later = now + timedelta(minutes=1)
+        assert scheduler.due(later) == "a"
+
+        # b changed, a kept, invalid config ignored
+        config.write_text('[main]\n[a]\nbackend = "a:A"\nschedule = 60\n'
+                          '[b]\nbackend = "b:B"\nschedule = 120\n')
+        os.utime(config, (time.time() + 1, time.time() + 1))
+        assert scheduler.reload(later)
+        assert scheduler.next_runs == {"a": later, "b": later}
+        config.write_text('[main]\n[a]\nschedule = "nope"\n')
+        os.utime(config, (time.time() + 2, time.time() + 2))
+        assert not scheduler.reload(later)
+        assert set(scheduler.next_runs) == {"a", "b"}
+
+
+class TestMultiHasher():
+    data = [b"0123456789" * 1000, b"abc", b"", b"def" * 5000]
+
+    def test_digests(self):
+        with MultiHasher(["md5", "sha256", "crc32"], queue_size=2) as hasher:
+            for chunk in self.data:
+                hasher.update(chunk)
+        content = b"".join(self.data)
+        assert hasher.hexdigests() == {
+            "sha1": hashlib.sha1(content).hexdigest(),
+            "md5": hashlib.md5(content).hexdigest(),
+            "sha256": hashlib.sha256(content).hexdigest(),
+            "crc32": f"{zlib.crc32(content):08x}",
+        }
+
+    def test_crc32c(self):
+        pytest.importorskip("crc32c")
+        hasher = MultiHasher(["crc32c"])
+        hasher.update(b"12345")
+        hasher.update(b"6789")
+        assert hasher.hexdigests()["crc32c"] == "e3069283"
+
+    def test_unknown_digest(self):
+        with pytest.raises(ValueError):
+            MultiHasher(["nope"])
+
+    def test_update_from_file(self, tmp_path):
+        tmp_file = tmp_path / "test.csv"
+        tmp_file.write_bytes(b"".join(self.data))
+        hasher = MultiHasher()
+        hasher.update_from_file(tmp_file, chunk_size=100)
+        assert hasher.hexdigests() == {"sha1": hashlib.sha1(tmp_file.read_bytes()).hexdigest()}
+
+    def test_closed(self):
+        hasher = MultiHasher()
+        hasher.close()
+        with pytest.raises(ValueError):
+            hasher.update(b"data")
+
+
+class TestAdaptiveChunkSize():
+
+    def test_grow_and_shrink(self):
+        chunk_size = AdaptiveChunkSize(min_size=4, max_size=16, target=1)
+        chunk_size.update(4, 0.1)
+        assert chunk_size.size == 8
+        # partial read: end of stream or slow link
+        chunk_size.update(2, 0.1)
+        assert chunk_size.size == 8
+        chunk_size.update(8, 0.1)
+        chunk_size.update(16, 0.1)
+        assert chunk_size.size == 16
+        chunk_size.update(16, 3)
+        assert chunk_size.size == 8
+        chunk_size.update(8, 3)
+        chunk_size.update(4, 3)
+        assert chunk_size.size == 4
+
+    def test_iter_chunks(self):
+        body = io.BytesIO(b"0123456789" * 10)
+        chunks = list(iter_chunks(body.read, AdaptiveChunkSize(min_size=2, max_size=32)))
+        assert b"".join(chunks) == b"0123456789" * 10
+        assert [len(c) for c in chunks[:5]] == [2, 4, 8, 16, 32]
+
+
+class TestProgress():
+
+    def test_throttled(self, mocker):
+        progress = Progress(total=100, interval=60)
+        render = mocker.spy(progress.bar, "update")
+        with progress:
+            for _ in range(10):
+                progress.add(10)
+        assert progress.done == 100
+        assert render.call_args_list == [
+            mocker.call(step=0, done=10, total=100), mocker.call(step=0, done=100, total=100),
+        ]
+
+    def test_update(self, mocker):
+        progress = Progress(interval=0)
+        render = mocker.spy(progress.bar, "update")
+        progress.update(5, 10)
+        progress.close()
+        render.assert_called_once_with(step=0, done=5, total=10)
+
+
+class TestStats():
+
+    def test_timer_outside_run(self):
+        with timer("download", "a") as t:
+            t.add(10)
+        assert "stats" not in context
+        assert get_stats().records == []
+
+    def test_timer(self):
+        stats = Stats()
+        with stats.timer("download", "a") as t:
+            t.add(10)
+            t.add(5)
+        with pytest.raises(ValueError):
+            with stats.timer("download", "b"):
+                raise ValueError("ERROR")
+        with stats.timer("upload", "a"):
+            pass
+        a, b, _ = stats.records
+        assert (a["name"], a["bytes"], a["error"]) == ("a", 15, None)
+        assert a["throughput"] == 15 / a["duration"]
+        assert (b["bytes"], b["error"]) == (0, "ERROR")
+        summary = stats.summary()
+        assert summary["download"]["count"] == 2
+        assert summary["download"]["bytes"] == 15
+        assert summary["upload"]["count"] == 1
+
+    def test_save(self, db):
+        stats = Stats()
+        stats.save(db, 1)
+        assert "stats" not in db.tables
+        with stats.timer("download", "a") as t:
+            t.add(10)
+        stats.save(db, 1)
+        assert db["stats"].find_one(metadata_id=1)["bytes"] == 10
+
+    def test_write_prometheus(self, tmp_path):
+        stats = Stats()
+        with stats.timer("download", "a") as t:
+            t.add(10)
+        with stats.timer("download", "b") as t:
+            t.add(5)
+        stats.write_prometheus(tmp_path, "myjob", {"errors": 0})
+        assert [p.name for p in tmp_path.iterdir()] == ["sweeper_myjob.prom"]
+        lines = (tmp_path / "sweeper_myjob.prom").read_text().splitlines()
+        assert lines[:4] == [
+            "# TYPE sweeper_run_errors gauge",
+            'sweeper_run_errors{job="myjob"} 0',
+            "# TYPE sweeper_stage_transfers gauge",
+            'sweeper_stage_transfers{job="myjob",stage="download"} 2',
+        ]
+        assert 'sweeper_stage_bytes{job="myjob",stage="download"} 15' in lines
+        assert stat.S_IMODE((tmp_path / "sweeper_myjob.prom").stat().st_mode) == 0o644
+
+
+def _busy(seconds):
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        pass
+
+
+class TestProfiling():
+
+    def test_cprofile(self, tmp_path):
+        profiler = make_profiler("cprofile")
+        assert isinstance(profiler, CProfiler)
+        profiler.start()
+        _busy(0.01)
+        profiler.stop()
+        assert "_busy" in profiler.summary(5)
+        profiler.dump(tmp_path / "run.prof")
+        functions = pstats.Stats(str(tmp_path / "run.prof")).stats
+        assert any(name == "_busy" for _, _, name in functions)
+
+    def test_sampling(self, tmp_path):
+        profiler = make_profiler("sample", interval=0.001)
+        assert isinstance(profiler, SamplingProfiler)
+        profiler.start()
+        _busy(0.1)
+        profiler.stop()
+        assert not profiler._thread.is_alive()
+        busy = [s for s in profiler.stacks if s[-1][2] == "_busy"]
+        assert busy
+        assert busy[0][-2][2] == "test_sampling"
+        summary = profiler.summary(5)
+        assert "_busy (test_utils.py:" in summary
+        profiler.dump(tmp_path / "run.folded")
+        lines = (tmp_path / "run.folded").read_text().splitlines()
+        assert any(line.split(";")[-1].startswith("_busy (") for line in lines)
+        assert sum(int(line.rsplit(" ", 1)[1]) for line in lines) == sum(profiler.stacks.values())
+
+    def test_unknown_mode(self):
+        with pytest.raises(ValueError):
+            make_profiler("nope")
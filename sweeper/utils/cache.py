@@ -0,0 +1,131 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import typing
+
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+
+class DownloadCache():
+    """
+    Content-addressed cache of downloaded files, kept across runs and shared by jobs.
+
+    Files are stored as `<root>/objects/<sha1[:2]>/<sha1>` and indexed by URL in
+    `<root>/index.json`, along with their `ETag` and `Last-Modified` validators.
+    Least recently used files are evicted when the cache grows over `max_size` bytes.
+
+    Files are hardlinked from and to the cache when possible, copied otherwise.
+
+    A lookup (`DownloadCache.get`) ends either in a hit, when the cached file is used
+    (`DownloadCache.fetch`), or in a miss, when it is not cached or is stale
+    (`DownloadCache.put` of another version).
+    """
+    INDEX = "index.json"
+
+    def __init__(self, root: Path, max_size: int):
+        self.root = Path(root)
+        self.max_size = max_size
+        self.objects_dir = self.root / "objects"
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.index = self._load_index()
+        self.hits = 0
+        self.misses = 0
+
+    def _load_index(self) -> dict:
+        try:
+            return json.loads((self.root / self.INDEX).read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def _object_path(self, sha1sum: str) -> Path:
+        return self.objects_dir / sha1sum[:2] / sha1sum
+
+    def _link(self, src: Path, dst: Path):
+        dst.unlink(missing_ok=True)
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copyfile(src, dst)
+
+    def get(self, url: str) -> typing.Optional[dict]:
+        """Cache entry for `url` (sha1sum, size, etag, last_modified, digests) if cached"""
+        with self.lock:
+            entry = self.index.get(url)
+            if not entry or not self._object_path(entry["sha1sum"]).exists():
+                self.misses += 1
+                return None
+            entry["used_at"] = time.time()
+            return dict(entry)
+
+    def fetch(self, entry: dict, path: Path) -> bool:
+        """Copy a cached file to `path`, returns `False` if it is no longer cached"""
+        try:
+            self._link(self._object_path(entry["sha1sum"]), path)
+        except FileNotFoundError:
+            return False
+        with self.lock:
+            self.hits += 1
+        # persist the use time set by `get`, for the eviction of the next runs
+        self.save()
+        return True
+
+    def put(
+        self, url: str, path: Path, sha1sum: str, etag=None, last_modified=None, digests=None,
+    ):
+        """Store a downloaded file in cache, along with its `digests` if any"""
+        with self.lock:
+            previous = self.index.get(url)
+            if previous and previous["sha1sum"] != sha1sum and \
+                    self._object_path(previous["sha1sum"]).exists():
+                # `get` returned a stale entry
+                self.misses += 1
+        if not etag and not last_modified:
+            # can not be revalidated, no use caching it
+            return
+        obj = self._object_path(sha1sum)
+        obj.parent.mkdir(exist_ok=True)
+        if not obj.exists():
+            self._link(path, obj)
+        with self.lock:
+            self.index[url] = {
+                "sha1sum": sha1sum,
+                "size": obj.stat().st_size,
+                "etag": etag,
+                "last_modified": last_modified,
+                "digests": digests,
+                "used_at": time.time(),
+            }
+        self.save()
+
+    def _evict(self):
+        """Remove least recently used files until the cache fits in `max_size`"""
+        objects = {}
+        for entry in self.index.values():
+            sha1sum = entry["sha1sum"]
+            used_at = max(entry["used_at"], objects.get(sha1sum, (0, 0))[0])
+            objects[sha1sum] = (used_at, entry["size"])
+        total = sum(size for _, size in objects.values())
+        for sha1sum, (_, size) in sorted(objects.items(), key=lambda o: o[1][0]):
+            if total <= self.max_size:
+                break
+            log.debug(f"Evicting {sha1sum} from cache")
+            self._object_path(sha1sum).unlink(missing_ok=True)
+            self.index = {u: e for u, e in self.index.items() if e["sha1sum"] != sha1sum}
+            total -= size
+
+    def save(self):
+        """Evict files if needed and write the index, merged with the one on disk"""
+        with self.lock:
+            for url, entry in self._load_index().items():
+                if entry["used_at"] > self.index.get(url, {}).get("used_at", 0):
+                    self.index[url] = entry
+            self._evict()
+            tmp_index = self.root / f"{self.INDEX}.{os.getpid()}.tmp"
+            tmp_index.write_text(json.dumps(self.index))
+            tmp_index.replace(self.root / self.INDEX)
@@ -0,0 +1,42 @@
+import time
+import typing
+
+
+class AdaptiveChunkSize():
+    """
+    Size of the next read of a stream, adapted to the link speed.
+
+    It doubles (up to `max_size`) when a read is filled in less than half `target`
+    seconds and halves (down to `min_size`) when it takes more than twice `target`,
+    so that fast links are read by a few big chunks and slow ones still
+    report progress regularly.
+    """
+    MIN_SIZE = 64 * 1024
+    MAX_SIZE = 8 * 1024 * 1024
+    TARGET = 0.2
+
+    def __init__(self, min_size: int = MIN_SIZE, max_size: int = MAX_SIZE, target=TARGET):
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        self.target = target
+        self.size = min_size
+
+    def update(self, read: int, elapsed: float):
+        """Adapt the size after `read` bytes have been read in `elapsed` seconds"""
+        if read >= self.size and elapsed < self.target / 2:
+            self.size = min(self.size * 2, self.max_size)
+        elif elapsed > self.target * 2:
+            self.size = max(self.size // 2, self.min_size)
+
+
+def iter_chunks(
+    read: typing.Callable[[int], bytes], chunk_size: AdaptiveChunkSize
+) -> typing.Iterator[bytes]:
+    """Iterate over the chunks returned by `read(size)` until it returns nothing"""
+    while True:
+        start = time.monotonic()
+        chunk = read(chunk_size.size)
+        if not chunk:
+            return
+        chunk_size.update(len(chunk), time.monotonic() - start)
+        yield chunk
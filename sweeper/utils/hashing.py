@@ -0,0 +1,113 @@
+import hashlib
+import queue
+import threading
+import typing
+import zlib
+
+from pathlib import Path
+
+DEFAULT_DIGESTS = ("sha1",)
+"""Digests computed by default, `sha1` is always computed since it is used to detect changes"""
+
+
+class _CRC32():
+    """`hashlib`-like wrapper around `zlib.crc32`"""
+    name = "crc32"
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self) -> str:
+        return f"{self.value:08x}"
+
+
+class _CRC32C(_CRC32):
+    """`hashlib`-like wrapper around `crc32c.crc32c` (optional `crc32c` package)"""
+    name = "crc32c"
+
+    def __init__(self):
+        try:
+            import crc32c
+        except ImportError:
+            raise ValueError("crc32c digest requires the crc32c package")
+        self._crc32c = crc32c.crc32c
+        super().__init__()
+
+    def update(self, data):
+        self.value = self._crc32c(data, self.value)
+
+
+def new_digest(name: str):
+    """A `hashlib` hash object for `name`, also supporting `crc32` and `crc32c`"""
+    if name == "crc32":
+        return _CRC32()
+    if name == "crc32c":
+        return _CRC32C()
+    return hashlib.new(name)
+
+
+class MultiHasher():
+    """
+    Compute several digests (eg `md5`, `sha1`, `sha256`, `crc32c`) of a stream in a
+    single pass, in a separate thread so that hashing overlaps with reading.
+
+    Chunks are passed to the thread as `memoryview`s through a queue of at most
+    `queue_size` chunks: `MultiHasher.update` blocks when hashing lags behind.
+    Chunks must not be modified once passed (`bytes` are fine).
+
+    `sha1` is always computed (cf `sweeper.pipelines.base.BasePipeline.file_has_changed`).
+    """
+    QUEUE_SIZE = 16
+
+    def __init__(self, algorithms: typing.Iterable[str] = DEFAULT_DIGESTS, queue_size=QUEUE_SIZE):
+        self.digests = {name: new_digest(name) for name in ["sha1", *algorithms]}
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._thread = threading.Thread(target=self._hash, name="sweeper-hasher", daemon=True)
+        self._thread.start()
+
+    def _hash(self):
+        while (chunk := self._queue.get()) is not None:
+            if self._error:
+                # keep draining so that update() does not block
+                continue
+            try:
+                for digest in self.digests.values():
+                    digest.update(chunk)
+            except Exception as e:
+                self._error = e
+
+    def update(self, data):
+        if self._error:
+            raise self._error
+        if not self._thread.is_alive():
+            raise ValueError("Hasher is closed")
+        self._queue.put(memoryview(data))
+
+    def update_from_file(self, path: Path, chunk_size: int = 1024 * 1024):
+        """Hash the content of a local file"""
+        with open(path, "rb") as f:
+            while chunk := f.read(chunk_size):
+                self.update(chunk)
+
+    def close(self):
+        """Wait for queued chunks to be hashed and stop the thread"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def hexdigests(self) -> dict:
+        """Digests of the whole stream, by algorithm name"""
+        self.close()
+        if self._error:
+            raise self._error
+        return {name: digest.hexdigest() for name, digest in self.digests.items()}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
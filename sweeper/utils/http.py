@@ -0,0 +1,33 @@
+import requests
+
+from requests.adapters import HTTPAdapter
+
+
+def make_session(pool_size: int = 10, keep_alive: bool = True) -> requests.Session:
+    """
+    Build a `requests.Session` to be shared by HTTP gateways.
+
+    `pool_size` is the number of connections kept per host, it should be at least
+    the number of concurrent requests made to a host (eg `max_workers`).
+    Connections are reused between requests unless `keep_alive` is false.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if not keep_alive:
+        session.headers["Connection"] = "close"
+    return session
+
+
+def make_async_session(pool_size: int = 10, keep_alive: bool = True):
+    """
+    Build an `aiohttp.ClientSession` to be shared by async HTTP gateways,
+    cf `make_session` for the parameters.
+
+    Requires the `async` extra and must be called from a running event loop.
+    """
+    import aiohttp
+
+    connector = aiohttp.TCPConnector(limit_per_host=pool_size, force_close=not keep_alive)
+    return aiohttp.ClientSession(connector=connector)
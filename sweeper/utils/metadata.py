@@ -8,8 +8,17 @@ class Metadata():
     table = None
 
     def __init__(self):
-        db = get_db()
-        self.table = db["metadata"]
+        self.db = get_db()
+        self.table = self.db["metadata"]
+
+    def create_table(self):
+        """Create the table and its columns, before jobs run concurrently (cf `sweeper run-all`)"""
+        types = self.db.types
+        self.table.create_column("job", types.text)
+        self.table.create_column("started_at", types.datetime)
+        self.table.create_column("ended_at", types.datetime)
+        self.table.create_column("error", types.text)
+        self.table.create_column("has_run_errors", types.boolean)
 
     def start(self, job):
         self.id = self.table.insert({
@@ -17,11 +26,12 @@ class Metadata():
             "job": job,
         })
 
-    def end(self, main_error, run_errors):
+    def end(self, main_error, run_errors, infos=None):
         error = str(main_error) if main_error else None
         self.table.update({
             "id": self.id,
             "ended_at": datetime.utcnow(),
             "error": error,
             "has_run_errors": len(run_errors) > 0,
+            **(infos or {}),
         }, ["id"])
@@ -0,0 +1,79 @@
+import typing
+
+from pathlib import Path
+from uuid import uuid4
+
+
+class FilePart():
+    """A slice of a local file, read lazily by `MultipartEncoder`"""
+
+    def __init__(self, path: Path, offset: int = 0, length: typing.Optional[int] = None):
+        self.path = path
+        self.offset = offset
+        self.length = path.stat().st_size - offset if length is None else length
+
+
+class MultipartEncoder():
+    """
+    Streaming `multipart/form-data` body, to be used as `data` with `requests`.
+
+    `fields` uses the same `{name: (filename, value)}` format as `requests` `files`,
+    `value` being a `str`, `int`, `bytes` or a `FilePart`. Files are read
+    by blocks while the body is sent, so memory usage does not depend on their size.
+    """
+
+    def __init__(self, fields: dict, boundary: typing.Optional[str] = None):
+        self.boundary = boundary or uuid4().hex
+        self._parts = []
+        for name, (filename, value) in fields.items():
+            self._parts.append((
+                f"--{self.boundary}\r\n"
+                f"Content-Disposition: form-data; name=\"{name}\"; filename=\"{filename}\"\r\n"
+                "\r\n"
+            ).encode())
+            if isinstance(value, int):
+                value = str(value)
+            self._parts.append(value.encode() if isinstance(value, str) else value)
+            self._parts.append(b"\r\n")
+        self._parts.append(f"--{self.boundary}--\r\n".encode())
+        self.len = sum(self._part_length(part) for part in self._parts)
+        self._index = 0
+        self._part_pos = 0
+        self._file = None
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return self.len
+
+    def _part_length(self, part) -> int:
+        return part.length if isinstance(part, FilePart) else len(part)
+
+    def read(self, size: typing.Optional[int] = -1) -> bytes:
+        if size is None or size < 0:
+            size = self.len
+        chunks = []
+        while size > 0 and self._index < len(self._parts):
+            part = self._parts[self._index]
+            if isinstance(part, FilePart):
+                if self._file is None:
+                    self._file = part.path.open("rb")
+                    self._file.seek(part.offset)
+                data = self._file.read(min(size, part.length - self._part_pos))
+            else:
+                data = part[self._part_pos:self._part_pos + size]
+            self._part_pos += len(data)
+            size -= len(data)
+            chunks.append(data)
+            if not data or self._part_pos >= self._part_length(part):
+                self.close()
+                self._index += 1
+                self._part_pos = 0
+        return b"".join(chunks)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,112 @@
+"""
+Profiling of job runs, cf `sweeper run --profile`.
+
+- `CProfiler` records every call of the thread running the job with `cProfile`,
+  dumped in `pstats` format (`.prof`, eg for `snakeviz` or `python -m pstats`)
+- `SamplingProfiler` samples the stacks of every thread at a fixed interval,
+  cheap enough to be left on, dumped as folded stacks (`.folded`, eg for `flamegraph.pl`
+  or speedscope). Samples are taken on wall-clock time, waiting threads included.
+"""
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+
+from collections import Counter
+from pathlib import Path
+from typing import Union
+
+MODES = ("cprofile", "sample")
+
+
+class CProfiler():
+    """Deterministic profiler of the calling thread"""
+    extension = ".prof"
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def dump(self, path: Path):
+        self.profile.dump_stats(path)
+
+    def summary(self, top: int) -> str:
+        """The `top` functions by cumulative time"""
+        out = io.StringIO()
+        pstats.Stats(self.profile, stream=out).sort_stats("cumulative").print_stats(top)
+        return out.getvalue()
+
+
+class SamplingProfiler():
+    """Sample the stacks of all threads every `interval` seconds, from a background thread"""
+    extension = ".folded"
+    INTERVAL = 0.01
+
+    def __init__(self, interval: float = INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        """Number of samples by stack, as tuples of `(filename, line, function)` from the root"""
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name="sweeper-profiler", daemon=True)
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def dump(self, path: Path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.items():
+                frames = ";".join(f"{name} ({filename}:{line})" for filename, line, name in stack)
+                f.write(f"{frames} {count}\n")
+
+    def summary(self, top: int) -> str:
+        """The `top` functions by samples where they are running (self) or on the stack (total)"""
+        total = sum(self.stacks.values())
+        own, cumulative = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for function in set(stack):
+                cumulative[function] += count
+        lines = [f"{total} samples, every {self.interval}s", f"{'self':>7} {'total':>7}  function"]
+        for function, count in own.most_common(top):
+            filename, line, name = function
+            lines.append(
+                f"{count / total:>7.1%} {cumulative[function] / total:>7.1%}  "
+                f"{name} ({os.path.basename(filename)}:{line})"
+            )
+        return "\n".join(lines)
+
+
+Profiler = Union[CProfiler, SamplingProfiler]
+
+
+def make_profiler(mode: str, interval: float = SamplingProfiler.INTERVAL) -> Profiler:
+    """A profiler for `mode`, one of `MODES`"""
+    if mode == "cprofile":
+        return CProfiler()
+    if mode == "sample":
+        return SamplingProfiler(interval)
+    raise ValueError(f"Unknown profile mode: {mode}, expected one of {', '.join(MODES)}")
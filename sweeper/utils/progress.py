@@ -1,4 +1,8 @@
 import sys
+import threading
+import time
+import typing
+
 from datetime import timedelta
 
 from progressist import ProgressBar as ProgressistProgressBar
@@ -15,8 +19,68 @@ class ProgressBar(ProgressistProgressBar):
     def __init__(self, **kwargs):
         self.is_terminal = sys.stdout.isatty()
         if not self.is_terminal:
-            throttle = timedelta(seconds=60)
-            kwargs["throttle"] = throttle
+            kwargs.setdefault("throttle", timedelta(seconds=60))
         super().__init__(**kwargs)
         if not self.is_terminal:
             self.template = self.template.replace('\r', '') + '\n'
+
+
+class Progress():
+    """
+    Progress of a transfer in bytes, shared by the gateways.
+
+    `Progress.add` is cheap enough to be called for every chunk read or written:
+    the bar is only rendered every `interval` seconds (`TTY_INTERVAL` in a terminal,
+    `LOG_INTERVAL` otherwise) and when closing. It can be updated from several threads.
+    """
+    TEMPLATE = "|{animation}| {done:B}/{total:B} ({speed:B}/s)"
+    TTY_INTERVAL = 0.5
+    LOG_INTERVAL = 60
+
+    def __init__(self, total: int = 0, done: int = 0, interval=None, **kwargs):
+        kwargs.setdefault("template", self.TEMPLATE)
+        # throttled here, on the hot path
+        self.bar = ProgressBar(total=total, throttle=0, **kwargs)
+        if interval is None:
+            interval = self.TTY_INTERVAL if self.bar.is_terminal else self.LOG_INTERVAL
+        self.interval = interval
+        self.total = total
+        self.done = done
+        self._lock = threading.Lock()
+        self._next_render = 0
+        self._rendered = None
+
+    def _render(self, now: float):
+        self._next_render = now + self.interval
+        self._rendered = self.done
+        self.bar.update(step=0, done=self.done, total=self.total)
+
+    def add(self, count: int):
+        """Count `count` more bytes transfered"""
+        with self._lock:
+            self.done += count
+            now = time.monotonic()
+            if now >= self._next_render:
+                self._render(now)
+
+    def update(self, done: int, total: typing.Optional[int] = None):
+        """Set the bytes transfered so far, and the total if known"""
+        with self._lock:
+            self.done = done
+            if total is not None:
+                self.total = total
+            now = time.monotonic()
+            if now >= self._next_render:
+                self._render(now)
+
+    def close(self):
+        """Render the final state"""
+        with self._lock:
+            if self._rendered != self.done:
+                self._render(time.monotonic())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
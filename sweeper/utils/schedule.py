@@ -0,0 +1,161 @@
+import logging
+import os
+
+from datetime import datetime, timedelta
+from typing import Optional, Union
+
+from sweeper.utils.config import load as load_config
+
+log = logging.getLogger(__name__)
+
+
+class IntervalSchedule():
+    """Run every `seconds` seconds, starting right away"""
+
+    def __init__(self, seconds: Union[int, float]):
+        if seconds <= 0:
+            raise ValueError(f"Invalid interval: {seconds}")
+        self.interval = timedelta(seconds=seconds)
+
+    def first_run(self, now: datetime) -> datetime:
+        return now
+
+    def next_run(self, after: datetime) -> datetime:
+        return after + self.interval
+
+
+class CronSchedule():
+    """
+    Run according to a cron expression (`minute hour day-of-month month day-of-week`).
+
+    Fields support `*`, values, ranges (`a-b`), steps (`*/n`, `a-b/n`) and lists (`a,b`).
+    Days of week go from 0 (sunday) to 6, 7 being sunday too. As with cron,
+    a day matches either field if both day-of-month and day-of-week are restricted.
+    """
+    FIELDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+    MAX_YEARS = 5
+    """Expressions with no run in that many years are considered invalid (eg `0 0 30 2 *`)"""
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != len(self.FIELDS):
+            raise ValueError(f"Invalid cron expression: {expression}")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = [
+            self._parse_field(field, *bounds) for field, bounds in zip(fields, self.FIELDS)
+        ]
+        self.weekdays = {d % 7 for d in weekdays}
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    def _parse_field(self, field: str, low: int, high: int) -> set:
+        values = set()
+        for part in field.split(","):
+            value_range, _, step = part.partition("/")
+            if value_range == "*":
+                start, end = low, high
+            elif "-" in value_range:
+                start, end = map(int, value_range.split("-", 1))
+            else:
+                start = int(value_range)
+                end = high if step else start
+            if not low <= start <= end <= high:
+                raise ValueError(f"Invalid cron field: {field}")
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return values
+
+    def _day_matches(self, t: datetime) -> bool:
+        day = t.day in self.days
+        weekday = (t.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def first_run(self, now: datetime) -> datetime:
+        return self.next_run(now)
+
+    def next_run(self, after: datetime) -> datetime:
+        t = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = after + timedelta(days=366 * self.MAX_YEARS)
+        while t < limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0)
+            elif not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+            else:
+                return t
+        raise ValueError(f"No run for cron expression: {self.expression}")
+
+
+def parse(schedule: Union[str, int, float]):
+    """Build a schedule from a cron expression or an interval in seconds"""
+    if isinstance(schedule, (int, float)):
+        return IntervalSchedule(schedule)
+    return CronSchedule(schedule)
+
+
+class Scheduler():
+    """
+    Next runs of the jobs of a config file having a `schedule`, used by `sweeper daemon`.
+
+    The config file is reloaded when it changes: jobs with a new schedule are rescheduled,
+    others keep their next run. An invalid config is logged and ignored.
+    """
+    POLL_INTERVAL = 5
+    """Max seconds between checks of the config file"""
+
+    def __init__(self, config_path: str, poll_interval: float = POLL_INTERVAL):
+        self.config_path = config_path
+        self.poll_interval = poll_interval
+        self.config = {}
+        self.schedules = {}
+        self.next_runs = {}
+        self._mtime = None
+
+    def reload(self, now: datetime) -> bool:
+        """Reload the config if its file has changed, returns `True` if reloaded"""
+        try:
+            mtime = os.stat(self.config_path).st_mtime
+            if mtime == self._mtime:
+                return False
+            self._mtime = mtime
+            config = load_config(self.config_path, "main")
+            schedules = {
+                job: (section["schedule"], parse(section["schedule"]))
+                for job, section in config.items()
+                if isinstance(section, dict) and "schedule" in section
+            }
+        except (OSError, ValueError, AssertionError) as e:
+            log.error(f"Could not load {self.config_path}, keeping current schedule: {e}")
+            return False
+        self.config = config
+        for job, (value, schedule) in schedules.items():
+            if job not in self.schedules or self.schedules[job][0] != value:
+                self.next_runs[job] = schedule.first_run(now)
+                log.info(f"Job {job} scheduled ({value}), next run at {self.next_runs[job]}")
+        self.next_runs = {job: t for job, t in self.next_runs.items() if job in schedules}
+        self.schedules = schedules
+        return True
+
+    def due(self, now: datetime) -> Optional[str]:
+        """Job that should run now, the most overdue one if several"""
+        if not self.next_runs:
+            return None
+        job = min(self.next_runs, key=self.next_runs.get)
+        return job if self.next_runs[job] <= now else None
+
+    def done(self, job: str, now: datetime):
+        """Schedule the next run of `job`, runs missed while it was running are skipped"""
+        if job in self.schedules:
+            self.next_runs[job] = self.schedules[job][1].next_run(now)
+
+    def wait_time(self, now: datetime) -> float:
+        """Seconds to wait before the next run or config check"""
+        if not self.next_runs:
+            return self.poll_interval
+        next_run = min(self.next_runs.values())
+        return max(0, min(self.poll_interval, (next_run - now).total_seconds()))
@@ -0,0 +1,156 @@
+"""
+Timings and volumes of the transfers of a job run, by stage and file.
+
+Gateways time their transfers with `sweeper.utils.stats.timer`, recording into the
+`Stats` of the current run (cf `sweeper.sync.run`). They are stored in the `stats`
+table at the end of the run, linked to its `metadata` row.
+
+Example usage:
+```python
+with timer("http_download", "monfichier.zip") as t:
+    for chunk in chunks:
+        ofile.write(chunk)
+        t.add(len(chunk))
+```
+"""
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from datetime import datetime
+from pathlib import Path
+
+from sweeper import context, ensure_columns
+
+log = logging.getLogger(__name__)
+
+
+class Timer():
+    """Time a stage of a file transfer and count the bytes moved, cf `Stats.timer`"""
+
+    def __init__(self, stats: "Stats", stage: str, name: str):
+        self.stats = stats
+        self.stage = stage
+        self.name = name
+        self.bytes = 0
+        self.started_at = None
+        self._start = None
+
+    def add(self, count: int):
+        """Count `count` more bytes moved"""
+        self.bytes += count
+
+    def __enter__(self):
+        self.started_at = datetime.utcnow()
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.monotonic() - self._start
+        self.stats.record({
+            "stage": self.stage,
+            "name": self.name,
+            "bytes": self.bytes,
+            "duration": duration,
+            "throughput": self.bytes / duration if duration else None,
+            "started_at": self.started_at,
+            "error": (str(exc) or repr(exc)) if exc else None,
+        })
+
+
+class Stats():
+    """
+    Records of the `Timer`s of a job run.
+
+    Records can be added from several threads.
+    """
+    TABLE = "stats"
+
+    def __init__(self):
+        self.records = []
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def timer(self, stage: str, name: str) -> Timer:
+        """A `Timer` recording into these stats when exiting"""
+        return Timer(self, stage, name)
+
+    def record(self, row: dict):
+        with self._lock:
+            self.records.append(row)
+
+    def summary(self) -> dict:
+        """Transfers count, bytes and total duration by stage"""
+        stages = {}
+        with self._lock:
+            records = list(self.records)
+        for row in records:
+            stage = stages.setdefault(row["stage"], {"count": 0, "bytes": 0, "duration": 0})
+            stage["count"] += 1
+            stage["bytes"] += row["bytes"]
+            stage["duration"] += row["duration"]
+        return stages
+
+    def log_summary(self):
+        for stage, s in self.summary().items():
+            speed = s["bytes"] / s["duration"] / 1024 ** 2 if s["duration"] else 0
+            log.info(
+                f"{stage}: {s['count']} transfer(s), {s['bytes'] / 1024 ** 2:.1f} MB "
+                f"in {s['duration']:.1f}s ({speed:.1f} MB/s)"
+            )
+
+    def save(self, db, metadata_id: int):
+        """Store the records in the `stats` table, linked to the run's `metadata` row"""
+        with self._lock:
+            rows = [dict(row, metadata_id=metadata_id) for row in self.records]
+        if rows:
+            ensure_columns(db[self.TABLE], rows)
+            with db as tx:
+                tx[self.TABLE].insert_many(rows)
+
+    def write_prometheus(self, directory: str, job: str, run: dict):
+        """
+        Write the stats to `<directory>/sweeper_<job>.prom`, for the
+        [textfile collector](https://github.com/prometheus/node_exporter#textfile-collector)
+        of the Prometheus node exporter.
+
+        `run` values are exported as `sweeper_run_<key>` gauges,
+        eg `{"errors": 2}` as `sweeper_run_errors{job="<job>"} 2`.
+        """
+        metrics = {f"run_{key}": {"": value} for key, value in run.items()}
+        for stage, s in self.summary().items():
+            label = f',stage="{stage}"'
+            metrics.setdefault("stage_transfers", {})[label] = s["count"]
+            metrics.setdefault("stage_bytes", {})[label] = s["bytes"]
+            metrics.setdefault("stage_duration_seconds", {})[label] = s["duration"]
+        lines = []
+        for metric, values in metrics.items():
+            lines.append(f"# TYPE sweeper_{metric} gauge")
+            for label, value in values.items():
+                lines.append(f'sweeper_{metric}{{job="{job}"{label}}} {value}')
+        path = Path(directory) / f"sweeper_{job}.prom"
+        # written then renamed so that the collector never reads a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".sweeper_")
+        with os.fdopen(fd, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        # mkstemp creates the file readable by its owner only, the collector may run as another user
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+
+
+def get_stats() -> Stats:
+    """
+    Stats of the current job run, set by `sweeper.sync.run`.
+
+    Outside of a run (eg gateways used as a library), throwaway stats are returned,
+    so that records do not pile up.
+    """
+    stats = context.get("stats")
+    return stats if stats is not None else Stats()
+
+
+def timer(stage: str, name: str) -> Timer:
+    """A `Timer` recording into the current run's stats"""
+    return get_stats().timer(stage, name)